@@ -14,39 +14,250 @@
 import os
 from datetime import datetime
 from datetime import date
+from datetime import timedelta
 import subprocess
-import gzip
-from subprocess import call
 import shutil
 import traceback
 import yaml
 import glob
 import shlex
+import StringIO
+import tempfile
+import threading
+import Queue
+import errno
+import hashlib
+import fnmatch
+import zlib
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import json
+import stat
+import sys
+import argparse
+import sqlite3
+import re
+import time
+import hmac
+import struct
+import string
+import resource
+import pipes
+import fcntl
+import ctypes
+import ctypes.util
 
 
 class ObibaBackup:
     CONFIG_FILE = os.path.join(os.path.dirname(__file__), "backup.conf")
+    CHUNK_SIZE = 1024 * 1024
+    DEFAULT_LIMITS = {'rsync': 1}
+    DEFAULT_COMPRESSION = {'codec': 'gzip', 'level': 6, 'threads': 1}
+    DELETE_THREADS = 4
+    COPY_THREADS = 4
+    COPY_BATCH = 256
+    MANIFEST_EXTENSION = '.manifest.json'
+    CHECKSUMS_FILE = 'checksums.json'
+    SALT_FILE = 'encryption.salt'
+    MTIME_PRECISION = 0.000002
 
-    def run(self):
+    def run(self, resume=False):
         """
-        This is where everything starts
+        This is where everything starts. With resume, the snapshots of an interrupted run are reused and what it
+        completed is skipped, see the journal of SnapshotCatalog.
         """
+        failures = None
+        self.metrics = RunMetrics()
         try:
             print "# Obiba backup started (%s)" % datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             self.__loadConfig()
-            self.__setup()
+            self.__lock()
+            self.__setup(resume)
+            self.__createScheduler()
+            try:
+                self.__openTransfer()
+            except Exception, e:
+                #The local backups still run, the uploads fail
+                self.__reportError("transfer to %s" % self.config['rsync']['destination'])
+                self.transfer = None
             self.__backupRemoteProjects()
             self.__backupProjects()
+            failures = self.scheduler.wait()
+            if self.transfer:
+                failures += self.transfer.wait()
+            if failures:
+                print "# %d backup unit(s) failed: %s" % (len(failures), ', '.join(failures))
+            if 'rsync' in self.config:
+                self.catalog.update(self.config['rsync']['destination'], 'failed' if failures else 'complete')
             self.__rsyncCleanup()
+            self.__collectChunkStores()
         except Exception, e:
-            print '*' * 80
-            print "* ERROR"
-            print
-            print traceback.format_exc()
-            print '*' * 80
+            self.__reportError()
         finally:
+            if getattr(self, 'transfer', None):
+                self.transfer.close()
+            self.__writeMetrics(failures)
+            if getattr(self, 'runLock', None):
+                self.runLock.release()
             print "# Obiba backup completed (%s)" % datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
+
+    def restore(self, snapshot, path=None, target='.'):
+        """
+        Lists the content of the indexed archives (or chunk archives of a repository) of a snapshot folder or, given a
+        path, extracts the files at or under that path to target. Only the requested files are read from the archives.
+        """
+        archives = []
+        for root, folders, files in os.walk(snapshot):
+            for name in sorted(files):
+                if name.endswith(IndexedArchive.INDEX_EXTENSION):
+                    archives.append(IndexedArchive(os.path.join(root, name[:-len(IndexedArchive.INDEX_EXTENSION)])))
+                elif name.endswith(ChunkArchive.INDEX_EXTENSION):
+                    archives.append(ChunkArchive(os.path.join(root, name[:-len(ChunkArchive.INDEX_EXTENSION)]),
+                                                 ChunkStore.find(root)))
+        if not archives:
+            print "No indexed archive found in %s" % snapshot
+            return
+
+        restored = 0
+        folders = []
+        for archive in archives:
+            for entry in archive.entries():
+                if path is None:
+                    print "%s %12d %s %s" % (entry['type'], entry.get('size', 0),
+                                             datetime.fromtimestamp(entry['mtime']).strftime('%Y-%m-%d %H:%M:%S'),
+                                             entry['path'])
+                elif entry['path'] == path or entry['path'].startswith(path.rstrip(os.sep) + os.sep):
+                    print "Restoring %s" % entry['path']
+                    archive.extract(entry, os.path.join(target, entry['path'].lstrip(os.sep)), folders)
+                    restored += 1
+        IndexedArchive.restoreFolders(folders)
+        if path is not None and restored == 0:
+            print "%s not found in %s" % (path, snapshot)
+
+    def verify(self, snapshots=None, remote=False, quick=False, jobs=4):
+        """
+        Checks snapshots, local or remote, against their checksums manifests, jobs files at a time. By default the
+        latest complete snapshot of every project is checked, and the one of the rsync destination with remote. With
+        quick, only the files whose modification time changed are read. Returns the number of files failing the check.
+        """
+        self.__loadConfig()
+        self.__openCatalog()
+        if not snapshots:
+            projects = self.config.get('projects', {}).keys() + (['rsync'] if remote and 'rsync' in self.config else [])
+            snapshots = []
+            for project in projects:
+                complete = [snapshot['path'] for snapshot in self.catalog.snapshots(project)
+                            if snapshot['status'] == 'complete']
+                snapshots += complete[-1:]
+        failures = 0
+        for snapshot in snapshots:
+            failures += self.__verifySnapshot(snapshot, quick, jobs)
+        return failures
+
+    def cleanup(self, dryRun=False):
+        """
+        Applies the retention schedule of every project and of the rsync destination without backing up. With dryRun,
+        only prints what would be deleted.
+        """
+        self.metrics = RunMetrics()
+        self.__loadConfig()
+        self.__openCatalog()
+        for project in self.config.get('projects', {}).iterkeys():
+            print "Cleaning up %s..." % project
+            self.__importSnapshots(project, os.path.join(self.config['destination'], project))
+            self.__cleanup(project, dryRun)
+        if 'rsync' in self.config:
+            print "Cleaning up rsync..."
+            self.__importSnapshots('rsync', self.config['rsync']['destination'])
+            self.__openTransfer()
+            try:
+                self.__cleanup('rsync', dryRun)
+                if not dryRun:
+                    self.__collectChunkStoresAlone()
+            finally:
+                if self.transfer:
+                    self.transfer.close()
+        elif not dryRun:
+            self.__collectChunkStoresAlone()
+
+    def decrypt(self, path, output):
+        """
+        Decrypts a file encrypted by the backup (.gpg, or .enc in delta mode) with the password of the config
+        """
+        stages = [stage for stage in (ChunkEncryptStage, GpgStage) if path.endswith(stage.EXTENSION)]
+        if not stages:
+            raise ValueError("%s is not encrypted, only %s and %s files are" % (path, GpgStage.EXTENSION,
+                                                                                 ChunkEncryptStage.EXTENSION))
+        self.__loadConfig()
+        password = self.__encryptionPassword()
+        if not password:
+            raise ValueError("No encryptionPassword in the rsync encrypt_files section of %s" % self.CONFIG_FILE)
+        with open(path, 'rb') as encrypted:
+            try:
+                with open(output, 'wb') as decrypted:
+                    stages[0].decrypt(encrypted, decrypted, password)
+            except Exception, e:
+                #No partial output
+                os.remove(output)
+                raise
+
+    def restoreDump(self, manifestFile, database=None, jobs=4):
+        """
+        Loads a database dumped table by table (or collection by collection) back, jobs of them at a time, into
+        database or the dumped database by default. The connection settings are the ones of the project in the config.
+        """
+        self.__loadConfig()
+        self.__restoreDump(manifestFile, database, jobs)
+
+    def replay(self, projectName, database, until, target=None, jobs=4):
+        """
+        Restores a database as it was at until (YYYY-MM-DD HH:MM:SS): loads the last full dump made before it, then
+        replays the binlog or oplog segments captured by the following runs up to until
+        """
+        self.__loadConfig()
+        self.__openCatalog()
+        until = datetime.strptime(until, '%Y-%m-%d %H:%M:%S')
+        name = os.path.basename(database)
+        snapshots = [snapshot for snapshot in self.catalog.snapshots(projectName) if snapshot['status'] == 'complete']
+        base = None
+        for index, snapshot in enumerate(snapshots):
+            if datetime.strptime(snapshot['timestamp'], '%Y-%m-%d %H:%M:%S') > until:
+                break
+            if self.__fullDump(snapshot['path'], name):
+                base = index
+        if base is None:
+            print "No full dump of %s made before %s" % (database, until)
+            return
+
+        dumpFile, dumpFormat = self.__fullDump(snapshots[base]['path'], name)
+        print "Loading %s" % dumpFile
+        if dumpFile.endswith(self.MANIFEST_EXTENSION):
+            self.__restoreDump(dumpFile, target, jobs)
+        else:
+            self.__loadArtifact(dumpFile, self.__loadCommand(dumpFormat, projectName, database, target))
+        for snapshot in snapshots[base + 1:]:
+            if self.__replaySegments(snapshot['path'], projectName, name, until, target):
+                break
+
+    def __restoreDump(self, manifestFile, database, jobs):
+        with open(manifestFile, 'r') as manifestInput:
+            manifest = json.load(manifestInput)
+        folder = os.path.dirname(manifestFile)
+        command = self.__loadCommand(manifest['format'], manifest['project'], manifest['database'], database)
+        parts = manifest['tables'] if manifest['format'] == 'mysql' else manifest['collections']
+
+        pool = ThreadPool(max(1, jobs))
+        try:
+            pool.map(lambda part: self.__loadArtifact(os.path.join(folder, part['file']), command), parts)
+        finally:
+            pool.close()
+            pool.join()
+        #Views and routines refer to the tables, they come last
+        if manifest.get('objects'):
+            self.__loadArtifact(os.path.join(folder, manifest['objects']), command)
+
     ####################################################################################################################
     # P R I V A T E     M E T H O D S
     ####################################################################################################################
@@ -57,136 +268,793 @@ class ObibaBackup:
         configFile.close()
 
     ####################################################################################################################
-    def __setup(self):
+    def __lock(self, wait=True):
+        """
+        Takes the lock of the destination, held by a run from start to end. Returns False if another process holds it
+        and not wait.
+        """
+        self.__createBackupFolder(self.config['destination'])
+        self.runLock = RunLock(os.path.join(self.config['destination'], RunLock.FILENAME))
+        if self.runLock.acquire(False):
+            return True
+        if not wait:
+            return False
+        print "Waiting for the backup running in %s to end..." % self.config['destination']
+        self.runLock.acquire()
+        return True
+
+    ####################################################################################################################
+    def __createScheduler(self):
+        """
+        Creates the worker pool running the backup units, see the 'concurrency' section of the config
+        """
+        workers = 1
+        if 'concurrency' in self.config and 'workers' in self.config['concurrency']:
+            workers = int(self.config['concurrency']['workers'])
+        self.scheduler = Scheduler(workers, self.__concurrencyLimits(), self.__reportError)
+        self.unit = threading.local()
+        self.checksums = {}
+        self.checksumsLock = threading.Lock()
+        self.previousChecksums = {}
+        self.throttles = {}
+        self.throttlesLock = threading.Lock()
+
+    ####################################################################################################################
+    def __concurrencyLimits(self):
+        """
+        The maximum number of units running at the same time per resource class, rsync sessions for 'rsync'
+        """
+        limits = dict(self.DEFAULT_LIMITS)
+        if 'concurrency' in self.config and 'limits' in self.config['concurrency']:
+            limits.update(self.config['concurrency']['limits'])
+        return limits
+
+    ####################################################################################################################
+    def __submit(self, snapshot, name, resource, function, args=(), after=()):
+        """
+        Submits a unit writing to a snapshot, its state (pending, running, done or failed) and the size and checksum
+        of the files it wrote are kept in the journal of the snapshot. Units done by an interrupted run are skipped.
+        """
+        if self.catalog.journal(snapshot).get(name, {}).get('state') == 'done':
+            print "\tSkipping %s, done before the interruption" % name
+            return self.scheduler.submit(name, ('journal', None), lambda: None, (), after)
+        self.catalog.record(snapshot, name, 'pending')
+        return self.scheduler.submit(name, resource, self.__runJournaled, (snapshot, name, resource, function, args),
+                                     after)
+
+    ####################################################################################################################
+    def __runJournaled(self, snapshot, name, resource, function, args):
+        self.catalog.record(snapshot, name, 'running')
+        self.unit.resource = resource
+        self.unit.files = []
+        #The reads, copies and commands of the unit are throttled by its project and stage settings
+        projectName = self.__projectOf(snapshot)
+        self.unit.throttle = self.__throttle(projectName, resource[0])
+        try:
+            with self.metrics.measure(resource[0], name, projectName):
+                function(*args)
+        except Exception, e:
+            self.catalog.record(snapshot, name, 'failed')
+            raise
+        finally:
+            self.unit.throttle = None
+        files = self.unit.files
+        self.unit.files = None
+        if len(files) == 1:
+            checksum = files[0][2]
+        else:
+            checksum = hashlib.sha256(''.join(artifact[2] for artifact in files)).hexdigest() if files else None
+        self.catalog.record(snapshot, name, 'done', sum(artifact[1] for artifact in files), checksum)
+
+    ####################################################################################################################
+    def __unitContext(self):
+        """
+        The metrics, journaled files and throttle of the running unit, for the pool threads working for it, see
+        __joinUnit
+        """
+        return StageMetrics.current(), getattr(self.unit, 'files', None), self.__unitThrottle()
+
+    ####################################################################################################################
+    def __joinUnit(self, context):
+        """
+        Makes the current pool thread count in the metrics and the journal of a unit and follow its throttle, or
+        leave it when context is None
+        """
+        StageMetrics.running.current, self.unit.files, self.unit.throttle = context or (None, None, None)
+
+    ####################################################################################################################
+    def __createArtifact(self, path):
+        """
+        Opens a backup file written under a temporary name and renamed to path once complete, so that an interrupted
+        run never leaves a truncated file under a final name. The file is counted in the journal of the running unit.
+        """
+        return AtomicFile(path, self.__artifactWritten)
+
+    ####################################################################################################################
+    def __artifactWritten(self, path, size, checksum):
+        StageMetrics.count(written=size)
+        self.__recordChecksum(path, size, checksum)
+        files = getattr(self.unit, 'files', None)
+        if files is not None:
+            files.append((path, size, checksum))
+
+    ####################################################################################################################
+    def __dumpArtifact(self, command, backupFile, compression, warnings=()):
         """
-        Setup basically creates the daily backup folder for each project
+        Streams the output of command through the compression stage to backupFile, see __createArtifact. The exit
+        codes in warnings keep the file.
+        """
+        artifact = self.__createArtifact(backupFile)
+        compressor = self.__openCompressor(artifact, compression)
+        try:
+            self.__streamCommand(command, compressor, warnings)
+        except Exception, e:
+            artifact.abort()
+            raise
+        finally:
+            compressor.close()
+
+    ####################################################################################################################
+    def __throttleSettings(self, projectName=None, stage=None):
+        """
+        Merges the global and project 'throttle' sections, then the section of the stage (files, tar, mysqldump,
+        mongodump or rsync) in their 'stages'
+        """
+        settings = {}
+        sections = [self.config.get('throttle')]
+        if projectName in self.config.get('projects', {}):
+            sections.append(self.config['projects'][projectName].get('throttle'))
+        for section in [section for section in sections if section]:
+            settings.update(dict((key, value) for key, value in section.iteritems() if key != 'stages'))
+            if stage in section.get('stages', {}):
+                settings.update(section['stages'][stage])
+        return settings
+
+    ####################################################################################################################
+    def __throttle(self, projectName, stage):
+        """
+        Returns the Throttle shared by the units of a project and stage, None when they are not throttled. Throttles
+        are shared so that the rate limit holds for all the units of the stage together.
+        """
+        with self.throttlesLock:
+            if (projectName, stage) not in self.throttles:
+                settings = self.__throttleSettings(projectName, stage)
+                throttle = None
+                if settings:
+                    rate = settings.get('bandwidth' if stage == 'rsync' else 'read')
+                    throttle = Throttle(parseSize(rate) if rate else None, self.__priority(settings),
+                                        self.__busyCheck(settings.get('load'), projectName))
+                self.throttles[(projectName, stage)] = throttle
+            return self.throttles[(projectName, stage)]
+
+    ####################################################################################################################
+    def __priority(self, settings):
+        """
+        Returns the command prefix running child processes at the CPU ('nice') and IO ('ionice') priority of the
+        settings. ionice is 'idle' or a best-effort level from 0 (highest) to 7.
+        """
+        priority = []
+        if 'nice' in settings:
+            priority += ["nice", "-n", str(int(settings['nice']))]
+        if 'ionice' in settings:
+            if str(settings['ionice']) == 'idle':
+                priority += ["ionice", "-c", "3"]
+            else:
+                priority += ["ionice", "-c", "2", "-n", str(int(settings['ionice']))]
+        return priority
+
+    ####################################################################################################################
+    def __busyCheck(self, load, projectName):
+        """
+        Returns the function telling whether the server is too busy for the backups to go on, None when the load
+        aware mode is off. The server is busy when its load average over a minute is above 'max', or when the MySQL
+        replication lag of the project databases is above 'lag' seconds.
+        """
+        if not load:
+            return None
+        maxLoad = float(load['max']) if 'max' in load else None
+        maxLag = int(load['lag']) if 'lag' in load else None
+        databases = self.config['projects'].get(projectName, {}).get('databases') if projectName else None
+
+        def busy():
+            if maxLoad is not None and os.getloadavg()[0] > maxLoad:
+                return True
+            if maxLag is not None and databases:
+                lag = self.__replicationLag(databases)
+                return lag is not None and lag > maxLag
+            return False
+        return busy
+
+    ####################################################################################################################
+    def __replicationLag(self, databases):
+        """
+        Returns the seconds the MySQL server is behind its source, None if it is not a replica or cannot be asked.
+        The query does not go through __streamCommand, which would be throttled by the caller.
+        """
+        try:
+            with open(os.devnull, 'w') as devnull:
+                status = subprocess.check_output(["mysql"] + self.__mysqlOptions(databases) +
+                                                 ["-e", "SHOW SLAVE STATUS\\G"], stderr=devnull)
+        except (OSError, subprocess.CalledProcessError), e:
+            return None
+        match = re.search(r'Seconds_Behind_(?:Master|Source): (\d+)', status)
+        return int(match.group(1)) if match else None
+
+    ####################################################################################################################
+    def __unitThrottle(self):
+        unit = getattr(self, 'unit', None)
+        return getattr(unit, 'throttle', None) if unit else None
+
+    ####################################################################################################################
+    def __copyFile(self, source, target, keepTimes=False):
+        """
+        shutil.copy, or shutil.copy2 with keepTimes, hashing the file as it is copied and reading the source at the
+        rate of the running unit
+        """
+        throttle = self.__unitThrottle()
+        if os.path.isdir(target):
+            target = os.path.join(target, os.path.basename(source))
+        checksum = hashlib.sha256()
+        size = 0
+        with open(source, 'rb') as sourceFile:
+            with open(target, 'wb') as targetFile:
+                while True:
+                    chunk = sourceFile.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if throttle:
+                        throttle.consume(len(chunk))
+                    targetFile.write(chunk)
+                    checksum.update(chunk)
+                    size += len(chunk)
+        (shutil.copystat if keepTimes else shutil.copymode)(source, target)
+        StageMetrics.count(size, size)
+        self.__recordChecksum(target, size, checksum.hexdigest())
+
+    ####################################################################################################################
+    def __writeMetrics(self, failures):
+        """
+        Prints the slowest stages of the run and writes the metrics to the JSON report and the Prometheus textfile of
+        the 'metrics' section. The report path is a strftime pattern, destination/reports/%Y-%m-%d-%H-%M-%S.json by
+        default. failures is None when the run stopped on an error.
+        """
+        if not getattr(self, 'config', None) or 'destination' not in self.config:
+            return
+        report = self.metrics.report(failures)
+        slowest = sorted(report['stages'], key=lambda stage: stage['duration'], reverse=True)[:5]
+        if slowest:
+            print "# Slowest stages:"
+        for stage in slowest:
+            print "\t%-10s %-50s %8.1fs %8.1f MB/s" % (stage['stage'], stage['name'], stage['duration'],
+                                                      (stage['throughput'] or 0) / 1024 / 1024)
+
+        settings = self.config.get('metrics', {})
+        started = datetime.fromtimestamp(self.metrics.started)
+        reportFile = started.strftime(settings.get('report', os.path.join(self.config['destination'], 'reports',
+                                                                          '%Y-%m-%d-%H-%M-%S.json')))
+        try:
+            self.__createBackupFolder(os.path.dirname(reportFile))
+            self.metrics.writeJson(reportFile, report)
+            if 'prometheus' in settings:
+                self.metrics.writePrometheus(settings['prometheus'], report)
+        except Exception, e:
+            self.__reportError("metrics")
+
+    ####################################################################################################################
+    def __reportError(self, unit=None):
+        print '*' * 80
+        print "* ERROR" if unit is None else "* ERROR in %s" % unit
+        print
+        print traceback.format_exc()
+        print '*' * 80
+
+    ####################################################################################################################
+    def __setup(self, resume=False):
+        """
+        Setup basically creates the daily backup folder for each project, or reuses the interrupted one when resuming
         """
         #Local backup folder
         backupFolder = self.config['destination']
         self.__createBackupFolder(backupFolder)
+        self.__openCatalog()
+        self.chunkStore = ChunkStore(backupFolder)
+        if self.__isDelta() and self.__encryptionPassword():
+            self.encryptionSalt = self.__encryptionSalt(backupFolder)
 
         # create the project based backup folder
         today = date.today()
 
         if 'projects' in self.config:
             for project in self.config['projects'].iterkeys():
-                timestamp = datetime.now().strftime('%d-%H-%M-%S')
-                backupDestination = os.path.join(backupFolder, project, str(today.year)+'-'+today.strftime('%m'), timestamp)
-                self.__createBackupFolder(backupDestination)
+                now = datetime.now()
+                timestamp = now.strftime('%d-%H-%M-%S')
+                self.__importSnapshots(project, os.path.join(backupFolder, project))
+                backupDestination = self.__interruptedSnapshot(project) if resume else None
+                if backupDestination:
+                    print "Resuming %s in %s" % (project, backupDestination)
+                    self.__removePartialFiles(backupDestination)
+                    self.catalog.update(backupDestination, 'running')
+                else:
+                    backupDestination = os.path.join(backupFolder, project, str(today.year)+'-'+today.strftime('%m'), timestamp)
+                    self.__createBackupFolder(backupDestination)
+                    self.catalog.add(project, backupDestination, now)
                 self.config['projects'][project]['destination'] = backupDestination
                 
-        #Remote backup folder
+        #Remote backup folder, created by the transfer when on another host
         if 'rsync' in self.config:
             backupFolder = self.config['rsync']['destination']
-            self.__createBackupFolder(backupFolder)
+            #The dated folder replaces the destination, the chunk store stays at the root
+            self.config['rsync']['root'] = backupFolder
+            isLocal = remoteHost(backupFolder) is None
+            if isLocal:
+                self.__createBackupFolder(backupFolder)
+            self.__importSnapshots('rsync', backupFolder)
     
             # create the date based backup folder
             today = date.today()
-            timestamp = datetime.now().strftime('%d-%H%M%S')
-            backupDestination = os.path.join(backupFolder, str(today.year)+'-'+today.strftime('%m'), timestamp)
-            self.__createBackupFolder(backupDestination)
+            now = datetime.now()
+            timestamp = now.strftime('%d-%H%M%S')
+            backupDestination = self.__interruptedSnapshot('rsync') if resume else None
+            if backupDestination:
+                #rsync picks up the files it had not finished sending
+                self.catalog.update(backupDestination, 'running')
+            else:
+                backupDestination = os.path.join(backupFolder, str(today.year)+'-'+today.strftime('%m'), timestamp)
+                if isLocal:
+                    self.__createBackupFolder(backupDestination)
+                self.catalog.add('rsync', backupDestination, now)
             self.config['rsync']['destination'] = backupDestination                
 
+    ####################################################################################################################
+    def __interruptedSnapshot(self, project):
+        """
+        Returns the latest snapshot of a project if its run was interrupted (still 'running'), or failed today. None
+        otherwise: a snapshot which failed on another day is left as it is and a new one is started.
+        """
+        snapshots = self.catalog.snapshots(project)
+        if not snapshots or snapshots[-1]['status'] == 'complete':
+            return None
+        if snapshots[-1]['status'] != 'running' and \
+                snapshots[-1]['timestamp'][:10] != date.today().strftime('%Y-%m-%d'):
+            print "\tThe last snapshot of %s %s on %s, a new one is started" % (project, snapshots[-1]['status'],
+                                                                              snapshots[-1]['timestamp'][:10])
+            return None
+        path = snapshots[-1]['path']
+        if remoteHost(path) is None and not os.path.isdir(path):
+            return None
+        return path
+
+    ####################################################################################################################
+    def __removePartialFiles(self, snapshot):
+        for root, folders, files in os.walk(snapshot):
+            for name in files:
+                if name.endswith(AtomicFile.PART_EXTENSION):
+                    os.remove(os.path.join(root, name))
+
+    ####################################################################################################################
+    def __openTransfer(self):
+        """
+        Opens the transfer to the rsync destination, see Transfer
+        """
+        self.transfer = None
+        if 'rsync' in self.config and 'destination' in self.config['rsync']:
+            rsync = self.config['rsync']
+            previous = None
+            if self.__isDelta() and hasattr(self, 'catalog'):
+                #Seed the new remote snapshot with the previous one, rsync then only sends the changes
+                for snapshot in reversed(self.catalog.snapshots('rsync')):
+                    if snapshot['path'] != rsync['destination'] and snapshot['status'] == 'complete':
+                        previous = snapshot['path']
+                        break
+            self.transfer = Transfer(rsync['destination'], rsync.get('pem'), rsync.get('multiplex', True),
+                                     self.__reportError, previous, rsync.get('seed', 'link'), self.metrics,
+                                     rsync.get('root', rsync['destination']),
+                                     self.__concurrencyLimits().get('rsync'))
+
+    ####################################################################################################################
+    def __openCatalog(self):
+        self.catalog = SnapshotCatalog(self.config['destination'])
+
+    ####################################################################################################################
+    def __importSnapshots(self, project, projectFolder):
+        """
+        Adds the snapshot folders of a project to the catalog, only done once for backups made before the catalog
+        existed
+        """
+        if self.catalog.hasProject(project) or not os.path.isdir(projectFolder):
+            return
+        print "\tAdding the existing %s snapshots to the catalog" % project
+        for month in os.listdir(projectFolder):
+            monthFolder = os.path.join(projectFolder, month)
+            if not os.path.isdir(monthFolder):
+                continue
+            for snapshot in os.listdir(monthFolder):
+                snapshotFolder = os.path.join(monthFolder, snapshot)
+                if os.path.isdir(snapshotFolder):
+                    self.catalog.add(project, snapshotFolder, snapshotTimestamp(snapshotFolder), 'complete')
+
     ####################################################################################################################
     def __backupRemoteProjects(self):
         if 'rsyncs' in self.config:
             for rsync in self.config['rsyncs']:
                 if 'folder' in rsync:
-                    self.__backupToRemoteServer(rsync['folder'])
+                    self.scheduler.submit("rsync %s" % rsync['folder']['path'], ('upload', None),
+                                          self.__backupToRemoteServer, (rsync['folder'],))
 
     ####################################################################################################################
     def __backupProjects(self):
         if 'projects' in self.config:
             for project in self.config['projects'].iterkeys():
                 print "Backing up %s..." % project
-                self.__backupProject(self.config['projects'][project], project)
+                try:
+                    self.__backupProject(self.config['projects'][project], project)
+                except Exception, e:
+                    #Keep scheduling the other projects
+                    self.__reportError(project)
 
     ####################################################################################################################
     def __backupProject(self, project, projectName):
         destination = project['destination']
-        self.__cleanup(os.path.dirname(destination), projectName)
+        with self.metrics.measure('cleanup', projectName, projectName):
+            self.__cleanup(projectName)
+        incremental = self.__incrementalSettings(project)
+        compression = self.__compressionSettings(projectName)
+        archive = project['archive'] if 'archive' in project else self.config.get('archive', 'tar')
+        if 'encryption' in compression:
+            #Every artifact is encrypted as it is written, which hard-linked files and indexed archives cannot be
+            incremental = None
+            archive = 'tar'
+        elif 'repository' in compression:
+            #The chunk store keeps unchanged data once, whichever day or project it comes from
+            incremental = None
+            archive = 'chunks'
+        with self.checksumsLock:
+            self.checksums[destination] = {}
+        units = []
         if 'files' in project:
-            self.__backupFiles(project['files'], destination)
-        if 'folders' in project:           
-            self.__backupFolders(project['folders'], destination)
+            units.append(self.__submit(destination, "%s files" % projectName, ('files', None), self.__backupFiles,
+                                       (project['files'], destination, incremental, compression)))
+        if 'folders' in project:
+            for folder in project['folders']:
+                folderPath = folder['folder']['path'] if 'folder' in folder else folder
+                units.append(self.__submit(destination, "%s folder %s" % (projectName, folderPath), ('tar', None),
+                                           self.__backupFolders,
+                                           ([folder], destination, incremental, compression, archive)))
         if 'mongodbs' in project:
-            self.__backupMongodbs(project['mongodbs'], destination)
+            units += self.__backupMongodbs(project['mongodbs'], destination, projectName, compression)
         if 'databases' in project:
-            self.__backupDatabases(project['databases'], destination)
+            units += self.__backupDatabases(project['databases'], destination, projectName, compression)
+
+        catalog = self.scheduler.submit("%s catalog" % projectName, ('catalog', None),
+                                        self.__completeSnapshot, (destination, units), units)
 
+        #The upload starts once every unit of the project is done and the checksums are written, other projects may
+        #still be running
         source = {}
         source['path'] = destination
-        self.__backupToRemoteServer(source, projectName)
+        self.scheduler.submit("%s upload" % projectName, ('upload', None),
+                              self.__backupToRemoteServer, (source, projectName, 'encryption' in compression),
+                              units + [catalog])
 
     ####################################################################################################################
-    def __backupToRemoteServer(self, source, remote=None):
+    def __backupToRemoteServer(self, source, remote=None, encrypted=False):
         if 'rsync' in self.config: 
             if 'destination' in self.config['rsync']:
-                excludes = []
-                if 'excludes' in source:
-                    for exclude in source['excludes']:
-                        excludes.append('--exclude')
-                        excludes.append('%s' % exclude)
-                        
-                publicKey = ''
-                remove_source_files = ''
+                if not self.transfer:
+                    raise IOError("No transfer to %s, see the error above" % self.config['rsync']['destination'])
+                excludes = source['excludes'] if 'excludes' in source else []
+                remove_source_files = False
+
+                #The upload is journaled in the remote snapshot, done once rsync has sent everything
+                snapshot = self.config['rsync']['destination']
+                name = "upload %s" % source['path']
+                if self.catalog.journal(snapshot).get(name, {}).get('state') == 'done':
+                    print "\tSkipping %s, done before the interruption" % name
+                    return
+                self.catalog.record(snapshot, name, 'running')
 
                 #Encrypt before copying remotely if required
                 if 'encrypt_files' in self.config['rsync']:
-                    if 'encryptionPassword' in self.config['rsync']['encrypt_files']:
-                        encryptionPassword = self.config['rsync']['encrypt_files']['encryptionPassword']
-                    
-                    if encryptionPassword:
-                        encryptedFile=self.__encryptFiles(source, encryptionPassword, remote)
-                        source = encryptedFile
-
-                        #Copying a single file, so make destination a folder
-                        destination = os.path.join(self.config['rsync']['destination'],'')
-                    else:
+                    encryptionPassword = self.__encryptionPassword()
+                    if not encryptionPassword:
                         print "If encrypt_file flag included in rsync, a password must be provided. Aborting rsync." 
                         return
-                    
-                    if 'remove_source_files' in self.config['rsync']['encrypt_files']:
-                        if self.config['rsync']['encrypt_files']['remove_source_files']: remove_source_files = "--remove-source-files"
+
+                    if encrypted:
+                        #The project artifacts were encrypted as they were written, they are the local backup too
+                        path = source['path']
+                        folder = remote if remote else os.path.basename(source['path'])
+                    else:
+                        with self.metrics.measure('encrypt', source['path'], remote):
+                            encryptedFile = self.__encryptFiles(source, encryptionPassword, remote)
+
+                        #Copying a single file to the destination folder
+                        path = encryptedFile
+                        folder = os.path.basename(encryptedFile)
+                        excludes = []
+                        if 'remove_source_files' in self.config['rsync']['encrypt_files']:
+                            remove_source_files = bool(self.config['rsync']['encrypt_files']['remove_source_files'])
 
                 else:
+                    path = source['path']
                     folder = remote if remote else os.path.basename(source['path'])
-                    source = os.path.join(source['path'], '')
-                    destination = os.path.join(self.config['rsync']['destination'], folder,'')
-        
-                if 'pem' in self.config['rsync']:
-                    publicKey = "ssh -i %s" % self.config['rsync']['pem']
-
-                print "Backing up %s to remote server %s..." % (source, self.config['rsync']['destination'])
-                print "rsync %s -Atrave '%s' %s %s %s" % (remove_source_files,publicKey, ' '.join(str(x) for x in excludes), source, destination)
-                print str(excludes)
-                result = subprocess.check_output(
-                  [
-                      'rsync',
-                      remove_source_files,
-                      '-Atrave',
-                      publicKey,
-                      source,
-                      destination
-                  ] + excludes
-                )
-        
-                print result
+
+                #The transfer uploads in the background, the failures are reported at the end of the run
+                throttle = self.__throttle(remote if remote in self.config.get('projects', {}) else None, 'rsync')
+                upload = lambda: self.transfer.upload(path, folder, excludes, remove_source_files,
+                                                      lambda: self.catalog.record(snapshot, name, 'done'), throttle)
+                if not encrypted and remote in self.config.get('projects', {}) and self.__isRepository(remote):
+                    #The snapshot only holds chunk indexes, it is queued once the chunks the remote store lacks are sent
+                    self.transfer.share(self.chunkStore.folder, self.__snapshotChunks(path), upload, throttle)
+                else:
+                    upload()
             else:
                 print "No destination specified in rysnc. Aborting rsync."
 
+    ####################################################################################################################
+    def __recordChecksum(self, path, size, checksum):
+        """
+        Records the size, modification time and sha256 of a file written to a snapshot of the run
+        """
+        with self.checksumsLock:
+            for destination, checksums in self.checksums.iteritems():
+                if path.startswith(destination + os.sep):
+                    checksums[os.path.relpath(path, destination)] = {'size': size, 'mtime': os.stat(path).st_mtime,
+                                                                     'sha256': checksum}
+                    return
+
+    ####################################################################################################################
+    def __previousChecksum(self, snapshot, path):
+        with self.checksumsLock:
+            if snapshot not in self.previousChecksums:
+                self.previousChecksums[snapshot] = self.__readChecksums(snapshot)
+            return self.previousChecksums[snapshot].get(path)
+
+    ####################################################################################################################
+    def __readChecksums(self, snapshot):
+        checksumsFile = os.path.join(snapshot, self.CHECKSUMS_FILE)
+        if not os.path.isfile(checksumsFile):
+            return {}
+        with open(checksumsFile) as checksums:
+            return json.load(checksums)['files']
+
+    ####################################################################################################################
+    def __writeChecksums(self, destination):
+        """
+        Writes the checksums manifest of a snapshot. Its files were hashed as they were written, the others (MongoDB
+        dump folders, files written before a resumed run) are read now.
+        """
+        with self.checksumsLock:
+            recorded = self.checksums.pop(destination, {})
+        previous = self.__readChecksums(destination)
+        checksums = {}
+        for root, folders, files in os.walk(destination):
+            for name in files:
+                path = os.path.join(root, name)
+                relativePath = os.path.relpath(path, destination)
+                if relativePath == self.CHECKSUMS_FILE or name.endswith(AtomicFile.PART_EXTENSION) or \
+                        os.path.islink(path):
+                    continue
+                fileStat = os.stat(path)
+                entry = recorded.get(relativePath) or previous.get(relativePath)
+                if not entry or entry['size'] != fileStat.st_size or entry['mtime'] != fileStat.st_mtime:
+                    entry = {'size': fileStat.st_size, 'mtime': fileStat.st_mtime,
+                             'sha256': self.__fileChecksum(path)}
+                checksums[relativePath] = entry
+        manifest = AtomicFile(os.path.join(destination, self.CHECKSUMS_FILE))
+        try:
+            json.dump({'files': checksums}, manifest, indent=0, separators=(',', ': '), sort_keys=True)
+        finally:
+            manifest.close()
+
+    ####################################################################################################################
+    def __verifySnapshot(self, snapshot, quick, jobs):
+        """
+        Checks every checksums manifest found in a snapshot folder, a project snapshot has one, a remote snapshot one
+        per project. Returns the number of files failing the check.
+        """
+        host = remoteHost(snapshot)
+        if host:
+            ssh = sshCommand(self.config['rsync'].get('pem')) + [host]
+            path = snapshot.split(':', 1)[1]
+            manifests = subprocess.check_output(remoteCommand(ssh, ["find", path, "-name",
+                                                                    self.CHECKSUMS_FILE])).split()
+        else:
+            ssh = None
+            manifests = [os.path.join(root, self.CHECKSUMS_FILE) for root, folders, files in os.walk(snapshot)
+                         if self.CHECKSUMS_FILE in files]
+        if not manifests:
+            print "No %s found in %s" % (self.CHECKSUMS_FILE, snapshot)
+            return 0
+
+        failures = 0
+        for manifestFile in manifests:
+            print "Verifying %s..." % os.path.dirname(manifestFile)
+            if ssh:
+                checksums = json.loads(subprocess.check_output(remoteCommand(ssh, ["cat", manifestFile])))['files']
+            else:
+                with open(manifestFile) as manifest:
+                    checksums = json.load(manifest)['files']
+            folder = os.path.dirname(manifestFile)
+            entries = sorted(checksums.iteritems())
+            #Remote files are checked by batches, one ssh session each
+            batches = [entries[index::jobs] for index in range(jobs)] if ssh else [[entry] for entry in entries]
+            pool = ThreadPool(max(1, jobs))
+            try:
+                results = pool.map(lambda batch: verifyFiles(folder, batch, quick, ssh), batches)
+            finally:
+                pool.close()
+                pool.join()
+            problems = sorted(problem for result in results for problem in result[0])
+            read = sum(result[1] for result in results)
+            for problem in problems:
+                print "\t%s %s" % problem
+            print "\t%s: %d files, %d read, %d failed" % ('FAILED' if problems else 'OK', len(entries), read,
+                                                         len(problems))
+            failures += len(problems)
+        if not ssh:
+            failures += self.__verifyChunks(snapshot, quick, jobs)
+        return failures
+
+    ####################################################################################################################
+    def __isRepository(self, projectName=None):
+        """
+        In repository mode, the artifacts of a project are cut in chunks kept once in the chunk store of the
+        destination, see ChunkStore
+        """
+        project = self.config.get('projects', {}).get(projectName) or {}
+        return bool(project['repository'] if 'repository' in project else self.config.get('repository', False))
+
+    ####################################################################################################################
+    def __snapshotChunks(self, snapshot):
+        """
+        Returns the paths, relative to the chunk store, of the chunks referenced by the chunk archives of a snapshot
+        """
+        chunks = set()
+        for root, folders, files in os.walk(snapshot):
+            for name in files:
+                if name.endswith(ChunkArchive.INDEX_EXTENSION):
+                    with open(os.path.join(root, name)) as index:
+                        chunks.update(ChunkArchive.references(index))
+        return sorted(os.path.relpath(self.chunkStore.path(chunk), self.chunkStore.folder) for chunk in chunks)
+
+    ####################################################################################################################
+    def __collectChunkStores(self):
+        """
+        Collects the local chunk store and, in repository mode, the remote one, once the snapshots past their
+        retention are deleted
+        """
+        if os.path.isdir(os.path.join(self.config['destination'], ChunkStore.FOLDER)):
+            with self.metrics.measure('cleanup', 'chunks'):
+                self.__collectChunks(self.config['destination'])
+        repository = self.__isRepository() or any(self.__isRepository(project)
+                                                  for project in self.config.get('projects', {}))
+        if repository and getattr(self, 'transfer', None):
+            with self.metrics.measure('cleanup', 'rsync chunks'):
+                self.__collectChunks(self.config['rsync'].get('root', self.config['rsync']['destination']))
+
+    ####################################################################################################################
+    def __collectChunkStoresAlone(self):
+        """
+        Collects the chunk stores outside of a run, unless a run is going on: it may be storing chunks its indexes do
+        not list yet
+        """
+        if not self.__lock(False):
+            print "\tA backup is running in %s, the chunk stores are collected at its end" % self.config['destination']
+            return
+        try:
+            self.__collectChunkStores()
+        finally:
+            self.runLock.release()
+
+    ####################################################################################################################
+    def __collectChunks(self, root):
+        """
+        Deletes the chunks of the store under root (local, or remote through ssh) which no chunk archive of any
+        snapshot under root refers to any more, and the partial chunks left by an interrupted run. The references are
+        counted from the archives themselves, so a snapshot deleted by hand releases its chunks as well.
+        """
+        host = remoteHost(root)
+        path = root.split(':', 1)[1] if host else root
+        store = os.path.join(path, ChunkStore.FOLDER)
+
+        def run(command):
+            return subprocess.check_output(remoteCommand(self.transfer.ssh + [host], command) if host else command)
+        if host and subprocess.call(remoteCommand(self.transfer.ssh + [host], ["test", "-d", store])) != 0:
+            return
+        if not host and not os.path.isdir(store):
+            return
+
+        #Every index is read before anything is deleted, a failure leaves the store untouched. The indexes of an
+        #interrupted run count too, their last line may be incomplete.
+        indexes = ["find", path, "-path", store, "-prune", "-o", "-name"]
+        references = collections.Counter(ChunkArchive.references(
+            run(indexes + ["*" + ChunkArchive.INDEX_EXTENSION, "-exec", "cat", "{}", "+"]).splitlines()))
+        references.update(ChunkArchive.references(
+            run(indexes + ["*" + ChunkArchive.INDEX_EXTENSION + AtomicFile.PART_EXTENSION, "-exec", "cat", "{}",
+                           "+"]).splitlines(), False))
+        unreferenced = []
+        freed = 0
+        stored = 0
+        for line in run(["find", store, "-type", "f", "-printf", "%s %p\n"]).splitlines():
+            size, chunkPath = line.split(' ', 1)
+            stored += 1
+            if os.path.basename(chunkPath) not in references:
+                unreferenced.append(chunkPath)
+                freed += int(size)
+        for index in range(0, len(unreferenced), self.COPY_BATCH):
+            batch = unreferenced[index:index + self.COPY_BATCH]
+            if host:
+                run(["rm", "-f", "--"] + batch)
+            else:
+                for chunkPath in batch:
+                    os.remove(chunkPath)
+        print "\tChunk store %s: %d chunks, %d references, %d unreferenced deleted (%.1f MB)" % (
+            root, stored - len(unreferenced), sum(references.values()), len(unreferenced), freed / 1024.0 / 1024)
+
+    ####################################################################################################################
+    def __verifyChunks(self, snapshot, quick, jobs):
+        """
+        Checks that the chunks referenced by the chunk archives of a local snapshot are in the store and, unless
+        quick, that their content matches their name. Returns the number of chunks failing the check.
+        """
+        indexes = [os.path.join(root, name) for root, folders, files in os.walk(snapshot) for name in files
+                   if name.endswith(ChunkArchive.INDEX_EXTENSION)]
+        if not indexes:
+            return 0
+        store = ChunkStore.find(snapshot)
+        chunks = set()
+        for indexFile in indexes:
+            with open(indexFile) as index:
+                chunks.update(ChunkArchive.references(index))
+
+        def check(chunk):
+            if not os.path.isfile(store.path(chunk)):
+                return 'MISSING', store.path(chunk)
+            if not quick:
+                try:
+                    store.get(chunk)
+                except (IOError, zlib.error), e:
+                    return 'CHECKSUM', store.path(chunk)
+            return None
+        pool = ThreadPool(max(1, jobs))
+        try:
+            problems = sorted(problem for problem in pool.map(check, sorted(chunks)) if problem)
+        finally:
+            pool.close()
+            pool.join()
+        for problem in problems:
+            print "\t%s %s" % problem
+        print "\t%s: %d chunks in %s, %d failed" % ('FAILED' if problems else 'OK', len(chunks), store.folder,
+                                                   len(problems))
+        return len(problems)
+
+    ####################################################################################################################
+    def __completeSnapshot(self, destination, units):
+        self.__writeChecksums(destination)
+        size = 0
+        for root, folders, files in os.walk(destination):
+            for name in files:
+                size += os.lstat(os.path.join(root, name)).st_size
+        failed = [unit for unit in units if unit.failed]
+        self.catalog.update(destination, 'failed' if failed else 'complete', size)
+
     ####################################################################################################################
     def __rsyncCleanup(self):
         if 'rsync' in self.config:
-            destination = self.config['rsync']['destination']
-            self.__cleanup(os.path.dirname(destination), 'rsync')
+            if not self.transfer and remoteHost(self.config['rsync']['destination']):
+                print "\tThe remote snapshots are not cleaned up, the transfer could not be opened"
+                return
+            with self.metrics.measure('cleanup', 'rsync'):
+                self.__cleanup('rsync')
 
     ####################################################################################################################
-    def __cleanup(self, destination, cleanType):
+    def __cleanup(self, cleanType, dryRun=False):
         # This is a significant rework of the Maelstrom code, the enhancements include: 
         # Enable clean up on the rsync remote folder
         # Enable clean up to roll round the year end and month end
         # Enable specific dates to be retained in the rolling month.
+        # Snapshots are read from the catalog, in timestamp order, rather than from the folder modification times.
         month = self.config['keep']['month']
         days = self.config['keep']['days']
         dates_to_keep = []
@@ -208,51 +1076,257 @@ class ObibaBackup:
                     days = self.config['projects'][project]['keep']['days']
                 if 'dates' in self.config['projects'][project]['keep']:
                     dates_to_keep = self.config['projects'][project]['keep']['dates'] 
-        
-        #Clean up year-month folders
-        folders = []
-        folders.append(os.path.dirname(destination))
-        self.__cleanupFolders(folders, month, [])
-        
-        #Get name of previous months folder. Assume the folder format is yyyy-mm
-        year_previous_month = os.path.basename(os.path.normpath(destination))
-        if year_previous_month[:-2] == "12":
-            year_previous_month = str(year_previous_month[:4]+1)+'-01' #Subtract one from the year and set month to Jan
-        else:
-            year_previous_month = year_previous_month[:-2]+str(int(year_previous_month[-2:])-1).zfill(2) #Add one to the month
 
-        #Format dates_to_keep as a list of 2 digit dates, add trailing hyphen to each item in dates_to_keep
-        dates_to_keep = [str(date).zfill(2)+"-" for date in dates_to_keep] 
-        
-        #Clean-up days in current and previous month folder. 
-        folders = []
-        folders.append(destination)
-        if os.path.exists(os.path.dirname(destination)+os.sep+year_previous_month):
-            folders.append(os.path.dirname(destination)+os.sep+year_previous_month)
-        self.__cleanupFolders(folders, days, dates_to_keep)
+        snapshots = self.catalog.snapshots(cleanType)
+        toDelete = self.__retentionPlan(snapshots, month, days, [int(day) for day in dates_to_keep], date.today())
+        if dryRun:
+            for snapshot in toDelete:
+                print "\tWould delete %s" % snapshot['path']
+            return
+        if not toDelete:
+            return
+
+        paths = [snapshot['path'] for snapshot in toDelete]
+        if cleanType == 'rsync' and remoteHost(self.config['rsync']['destination']):
+            self.transfer.remove(paths)
+            self.catalog.remove(paths)
+            return
+        pool = ThreadPool(self.DELETE_THREADS)
+        try:
+            deleted = pool.map(deleteSnapshot, paths)
+        finally:
+            pool.close()
+            pool.join()
+        #A snapshot which could not be deleted stays in the catalog, the next cleanup tries again
+        self.catalog.remove([path for path, isDeleted in zip(paths, deleted) if isDeleted])
+        failed = [path for path, isDeleted in zip(paths, deleted) if not isDeleted]
+        if failed:
+            print "\tWarning: %d snapshots of %s could not be deleted: %s" % (len(failed), cleanType, ', '.join(failed))
+
+    ####################################################################################################################
+    def __retentionPlan(self, snapshots, month, days, dates_to_keep, today):
+        """
+        Returns the snapshots to delete: every snapshot outside the 'month' most recent months, then the oldest ones
+        of the current and previous months beyond the 'days' most recent, ignoring the days of the month to keep
+        """
+        months = sorted(set(snapshot['timestamp'][:7] for snapshot in snapshots), reverse=True)
+        toDelete = [snapshot for snapshot in snapshots if snapshot['timestamp'][:7] not in months[:month]]
+
+        currentMonth = today.strftime('%Y-%m')
+        previousMonth = (today.replace(day=1) - timedelta(days=1)).strftime('%Y-%m')
+        recent = [snapshot for snapshot in snapshots
+                  if snapshot not in toDelete and snapshot['timestamp'][:7] in (currentMonth, previousMonth)
+                  and int(snapshot['timestamp'][8:10]) not in dates_to_keep]
+        if len(recent) > days:
+            toDelete += recent[:len(recent) - days]
+        return toDelete
+
+    ####################################################################################################################
+    def __incrementalSettings(self, project):
+        """
+        Returns None unless the project (or the whole config) asks for incremental snapshots, in which case files and
+        folders unchanged since the previous snapshot are hard-linked from it instead of being copied again
+        """
+        incremental = project['incremental'] if 'incremental' in project else self.config.get('incremental', False)
+        if not incremental:
+            return None
+
+        settings = {}
+        settings['checksum'] = isinstance(incremental, dict) and incremental.get('checksum', False)
+        settings['previous'] = self.__previousSnapshot(project['destination'])
+        if settings['previous']:
+            print "\tIncremental snapshot against %s" % settings['previous']
+        return settings
 
+    ####################################################################################################################
+    def __previousSnapshot(self, destination):
+        for snapshot in reversed(self.catalog.snapshots(self.__projectOf(destination))):
+            if snapshot['path'] != destination and snapshot['status'] == 'complete' and os.path.isdir(snapshot['path']):
+                return snapshot['path']
+        return None
 
     ####################################################################################################################
-    def __cleanupFolders(self, destination, keep, exclude_folders_begining_with):
-        sortedFolders = self.__getSortedFolderList(destination, exclude_folders_begining_with)
-        self.__deleteFolders(len(sortedFolders) - keep, sortedFolders)
+    def __projectOf(self, destination):
+        # destination/project/yyyy-mm/dd-HH-MM-SS
+        return os.path.basename(os.path.dirname(os.path.dirname(destination)))
 
     ####################################################################################################################
-    def __backupFiles(self, files, destination):
+    def __backupFiles(self, files, destination, incremental=None, compression=None):
+        if compression and 'repository' in compression:
+            self.__archiveFiles(files, destination, compression)
+            return
+        #Plain copies are made in bulk, the others file by file
+        bulk = not incremental and not (compression and 'encryption' in compression) and not self.__unitThrottle()
         for file in files:
             print "\tBacking up file %s to %s" % (file, destination)
-            for fileItem in glob.glob(file):
+            if bulk:
+                self.__copyFiles([path for path in expandPattern(file) if os.path.isfile(path)], destination)
+                continue
+            for fileItem in expandPattern(file):
                 if os.path.isfile(fileItem):
                     destinationPath = os.path.join(destination, os.path.dirname(fileItem)[1:])
-                    if not os.path.exists(destinationPath):
-                        os.makedirs(destinationPath)
-                    shutil.copy(fileItem, destinationPath)
+                    self.__createBackupFolder(destinationPath)
+                    if incremental:
+                        self.__snapshotFile(fileItem, destination, incremental)
+                    elif compression and 'encryption' in compression:
+                        encryptedFile = os.path.join(destinationPath, os.path.basename(fileItem))
+                        self.__encryptFile(fileItem, encryptedFile + compression['encryptionExtension'],
+                                           compression['encryption'])
+                    else:
+                        self.__copyFile(fileItem, destinationPath)
+
+    ####################################################################################################################
+    def __archiveFiles(self, files, destination, compression):
+        """
+        Writes the files of the project to a single chunk archive, see ChunkArchive
+        """
+        archive = ChunkArchive(os.path.join(destination, 'files'), self.chunkStore)
+        archive.create(int(compression['level']), self.__unitThrottle(), self.__createArtifact)
+        try:
+            for file in files:
+                print "\tBacking up file %s to %s" % (file, destination)
+                for fileItem in expandPattern(file):
+                    archive.add(fileItem)
+        finally:
+            archive.close()
+
+    ####################################################################################################################
+    def __copyFiles(self, paths, destination, threads=None):
+        """
+        Copies files into the snapshot, under their absolute path, by batches run in parallel. Each file is hashed
+        as it is copied, see __copyFile, the sources are read once.
+        """
+        started = time.time()
+        batches = collections.OrderedDict()
+        for path in paths:
+            batches.setdefault(os.path.join(destination, os.path.dirname(path)[1:]), []).append(path)
+        jobs = []
+        for folder, sources in batches.iteritems():
+            #Each target folder is created once
+            self.__createBackupFolder(folder)
+            jobs += [(folder, sources[index:index + self.COPY_BATCH])
+                     for index in range(0, len(sources), self.COPY_BATCH)]
+        unit = self.__unitContext()
+        pool = ThreadPool(threads or self.COPY_THREADS)
+        try:
+            pool.map(lambda job: self.__copyBatch(job[0], job[1], unit), jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        size = sum(os.path.getsize(path) for path in paths)
+        elapsed = max(time.time() - started, 0.001)
+        print "\tCopied %d files, %d bytes in %.1fs (%d files/s, %.1f MB/s)" % (len(paths), size, elapsed,
+                                                                             len(paths) / elapsed,
+                                                                             size / elapsed / 1024 / 1024)
+
+    ####################################################################################################################
+    def __copyBatch(self, folder, sources, unit=None):
+        self.__joinUnit(unit)
+        try:
+            for source in sources:
+                self.__copyFile(source, folder)
+        finally:
+            self.__joinUnit(None)
+
+    ####################################################################################################################
+    def __snapshotFolder(self, folder_path, excludes, destination, incremental):
+        """
+        Mirrors a folder into the snapshot, hard-linking the files unchanged since the previous snapshot
+        """
+        for path, isFolder in self.__walkFolder(folder_path, excludes):
+            if isFolder:
+                self.__createBackupFolder(os.path.join(destination, path[1:]))
+            else:
+                self.__snapshotFile(path, destination, incremental)
+
+    ####################################################################################################################
+    def __walkFolder(self, folder_path, excludes):
+        """
+        Yields (path, isFolder) for the folder and everything under it which is not excluded, folders first
+        """
+        for root, folders, files in os.walk(folder_path):
+            relativeRoot = os.path.relpath(root, folder_path)
+            for name in list(folders):
+                if self.__isExcluded(os.path.normpath(os.path.join(relativeRoot, name)), excludes):
+                    folders.remove(name)
+                elif os.path.islink(os.path.join(root, name)):
+                    #os.walk does not follow links to folders, keep them as links
+                    files.append(name)
+            yield root, True
+            for name in files:
+                if not self.__isExcluded(os.path.normpath(os.path.join(relativeRoot, name)), excludes):
+                    yield os.path.join(root, name), False
+
+    ####################################################################################################################
+    def __isExcluded(self, relativePath, excludes):
+        # Same spirit as tar --exclude: a pattern matches the relative path, one of its parents or the file name
+        for exclude in excludes:
+            exclude = exclude.strip(os.sep)
+            if relativePath == exclude or relativePath.startswith(exclude + os.sep):
+                return True
+            if fnmatch.fnmatch(os.path.basename(relativePath), exclude):
+                return True
+        return False
+
+    ####################################################################################################################
+    def __snapshotFile(self, source, destination, incremental):
+        target = os.path.join(destination, source[1:])
+        if os.path.lexists(target):
+            os.remove(target)
+        mode = os.lstat(source).st_mode
+        if stat.S_ISLNK(mode):
+            os.symlink(os.readlink(source), target)
+            return
+        if not stat.S_ISREG(mode):
+            #Sockets, pipes, devices... cannot be copied, a pipe would block the copy
+            print "\tSkipping %s, not a regular file" % source
+            return
+
+        if incremental['previous']:
+            previous = os.path.join(incremental['previous'], source[1:])
+            if self.__isUnchanged(source, previous, incremental['checksum']):
+                try:
+                    os.link(previous, target)
+                    #Same file, same checksum
+                    entry = self.__previousChecksum(incremental['previous'], source[1:])
+                    if entry:
+                        self.__recordChecksum(target, entry['size'], entry['sha256'])
+                    return
+                except OSError, e:
+                    #Different file system or too many links, fall back to a copy
+                    pass
+        #The modification time is kept, it is used to detect changes on the next run
+        self.__copyFile(source, target, True)
+
+    ####################################################################################################################
+    def __isUnchanged(self, source, previous, checksum):
+        if not os.path.isfile(previous) or os.path.islink(previous):
+            return False
+        sourceStat = os.stat(source)
+        previousStat = os.stat(previous)
+        if sourceStat.st_size != previousStat.st_size:
+            return False
+        if hasattr(sourceStat, 'st_mtime_ns'):
+            if sourceStat.st_mtime_ns != previousStat.st_mtime_ns:
+                return False
+        elif abs(sourceStat.st_mtime - previousStat.st_mtime) >= self.MTIME_PRECISION:
+            #The copies keep the modification time to the microsecond (utimes), read back as float seconds
+            return False
+        if checksum:
+            return self.__fileChecksum(source) == self.__fileChecksum(previous)
+        return True
+
+    ####################################################################################################################
+    def __fileChecksum(self, path):
+        return fileChecksum(path)
 
     #################################################################################################################### 
-    def __backupFolders(self, folders, destination):
+    def __backupFolders(self, folders, destination, incremental=None, compression=None, archive='tar'):
         
         for folder_item in folders:
             excludes = []
+            excludePaths = []
             if 'folder' in folder_item:
                 #Using hierarchical folder structure 
                 if 'path' in folder_item['folder']:
@@ -263,83 +1337,792 @@ class ObibaBackup:
                             if not (os.path.exists(exclude) or os.path.exists(os.path.join(folder_path,exclude))):
                                 print "\tExclude path %s not found, check the config entry is correct" % exclude 
                             excludes.append('--exclude=%s' % exclude)
+                            excludePaths.append(exclude)
             else:
                 #Using simple folder list
                 folder_path = folder_item
                 
             print "\tBacking up folder %s to %s" % (folder_path, destination)
-            filename = "%s.tar.gz" % (os.path.basename(folder_path))
+            if incremental:
+                self.__snapshotFolder(folder_path, excludePaths, destination, incremental)
+                continue
+
+            compression = compression or self.__compressionSettings()
+            filename = "%s.tar%s" % (os.path.basename(folder_path), compression['extension'])
     
             destinationPath = os.path.join(destination, folder_path[1:])
-            if not os.path.exists(destinationPath):
-                os.makedirs(destinationPath)
+            self.__createBackupFolder(destinationPath)
+            if archive in ('indexed', 'chunks'):
+                self.__archiveFolder(folder_path, excludePaths, destinationPath, compression)
+                continue
             backupFile = os.path.join(destinationPath, filename)
-            #print ' '.join(str(x) for x in ["tar", "czfP", backupFile, folder_path] + excludes)
-            result = call(["tar", "czfP", backupFile, folder_path] + excludes) 
-            if result != 0:
-                print "Failed to tar %s" % backupFile
+            #tar only archives, compression is done by the compression stage. It exits with 1 when a file changed
+            #while it was read, routine on a live folder: the archive is kept, any other failure fails the unit
+            self.__dumpArtifact(["tar", "cfP", "-"] + excludes + [folder_path], backupFile, compression, (1,))
 
     ####################################################################################################################
-    def __backupMongodbs(self, mongodbs, destination):
-        #Build the mongodump command based on the config. Config file struture assumes settings are the same for all databases
-        mongocommand = 'mongodump --host ' + str(mongodbs['host']) + ' --port ' +  str(mongodbs['port']) + ' '
-        if 'usr' in mongodbs and 'pwd' in mongodbs:
-            mongocommand += '--username ' + str(mongodbs['usr']) + ' --password ' +  str(mongodbs['pwd']) + ' '
-        if 'authenticationDatabase' in mongodbs:
-            mongocommand += '--authenticationDatabase ' + str(mongodbs['authenticationDatabase']) + ' '
-        if 'sslPEMKeyFile' in mongodbs:
-            mongocommand += '--ssl --sslPEMKeyFile ' + str(mongodbs['sslPEMKeyFile']) + ' '
-        output_type = '--archive=' if ('output' in mongodbs and 'archive' == mongodbs['output']) else '--out='
+    def __archiveFolder(self, folder_path, excludes, destinationPath, compression):
+        """
+        Writes the folder to an indexed archive, or to a chunk archive in repository mode, see IndexedArchive and
+        ChunkArchive
+        """
+        path = os.path.join(destinationPath, os.path.basename(folder_path))
+        archive = ChunkArchive(path, self.chunkStore) if 'repository' in compression else IndexedArchive(path)
+        archive.create(int(compression['level']), self.__unitThrottle(), self.__createArtifact)
+        try:
+            for path, isFolder in self.__walkFolder(folder_path, excludes):
+                archive.add(path)
+        finally:
+            archive.close()
+
+    ####################################################################################################################
+    def __backupMongodbs(self, mongodbs, destination, projectName, compression):
+        #Build the mongodump command based on the config. Config file struture assumes settings are the same for all databases
+        mongocommand = 'mongodump ' + self.__mongoOptions(mongodbs)
+        archive = ('output' in mongodbs and 'archive' == mongodbs['output']) or 'encryption' in compression
+        #A dump folder cannot go through the compression and encryption stages, encrypted, incremental and repository
+        #backups use archives
+        archive = archive or bool(mongodbs.get('incremental')) or 'repository' in compression
+        output_type = '--archive=' if archive else '--out='
         output_type += destination
-        #Run command for each database in the config file
+        #Schedule the command for each database in the config file
+        units = []
         for mongodb in mongodbs['names']:
-            print "\tBacking up mongodb %s to %s" % (mongodb, destination)
-            self.__backupMongodb(mongodb, mongocommand, output_type)
+            position = self.__capturePosition(mongodbs, projectName, 'mongodb', mongodb)
+            if position and self.catalog.position(position) and not self.__isFullDumpDay(mongodbs):
+                units.append(self.__submit(destination, "%s mongodb %s oplog" % (projectName, mongodb),
+                                           ('mongodump', mongodbs['host']), self.__captureOplog,
+                                           (mongodb, mongodbs, destination, compression, projectName, position)))
+            elif mongodbs.get('parallel'):
+                units += self.__backupCollections(mongodb, mongodbs, mongocommand, destination, projectName,
+                                                  compression, position)
+            else:
+                units.append(self.__submit(destination, "%s mongodb %s" % (projectName, mongodb),
+                                           ('mongodump', mongodbs['host']), self.__backupMongodb,
+                                           (mongodb, mongocommand, output_type, compression, mongodbs, position)))
+        return units
+
+    ####################################################################################################################
+    def __mongoOptions(self, mongodbs):
+        options = '--host ' + str(mongodbs['host']) + ' --port ' +  str(mongodbs['port']) + ' '
+        if 'usr' in mongodbs and 'pwd' in mongodbs:
+            options += '--username ' + str(mongodbs['usr']) + ' --password ' +  str(mongodbs['pwd']) + ' '
+        if 'authenticationDatabase' in mongodbs:
+            options += '--authenticationDatabase ' + str(mongodbs['authenticationDatabase']) + ' '
+        if 'sslPEMKeyFile' in mongodbs:
+            options += '--ssl --sslPEMKeyFile ' + str(mongodbs['sslPEMKeyFile']) + ' '
+        return options
 
     ####################################################################################################################
-    def __backupMongodb(self, mongodb, mongocommand, output_type):
+    def __backupCollections(self, mongodb, mongodbs, mongocommand, destination, projectName, compression,
+                            position=None):
+        """
+        Schedules one mongodump archive per collection, so the collections of a database are dumped in parallel, and
+        the manifest listing them once they are done
+        """
+        self.__createBackupFolder(os.path.join(destination, mongodb))
+        #Replaying the oplog from before the dump is harmless, its entries are idempotent
+        oplog = (position, self.__oplogTimestamps(mongodbs)[1]) if position else None
+        collections = []
+        units = []
+        for collection in self.__listCollections(mongodb, mongodbs):
+            backupFile = os.path.join(mongodb, collection + '.archive' + compression['extension'])
+            collections.append({'name': collection, 'file': backupFile})
+            #The collection name is passed as is, it may hold spaces or quotes
+            collectioncommand = shlex.split(mongocommand) + ["--archive", "--db", mongodb, "--collection", collection]
+            units.append(self.__submit(destination, "%s mongodb %s.%s" % (projectName, mongodb, collection),
+                                       ('mongodump', mongodbs['host']), self.__backupCollection,
+                                       (collectioncommand, os.path.join(destination, backupFile), compression)))
+        manifest = {'format': 'mongodb', 'project': projectName, 'database': mongodb, 'collections': collections}
+        manifestFile = os.path.join(destination, mongodb + self.MANIFEST_EXTENSION)
+        units.append(self.__submit(destination, "%s mongodb %s manifest" % (projectName, mongodb), ('manifest', None),
+                                   self.__writeManifest, (manifestFile, manifest, list(units), oplog), units))
+        return units
+
+    ####################################################################################################################
+    def __compressFolder(self, folder, compression):
+        """
+        Compresses every file of a dump folder through the compression stage, the file being replaced by
+        file.<extension>
+        """
+        throttle = self.__unitThrottle()
+        for root, folders, files in os.walk(folder):
+            for name in files:
+                path = os.path.join(root, name)
+                artifact = self.__createArtifact(path + compression['extension'])
+                compressor = self.__openCompressor(artifact, compression)
+                try:
+                    with open(path, 'rb') as source:
+                        while True:
+                            chunk = source.read(self.CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            if throttle:
+                                throttle.consume(len(chunk))
+                            StageMetrics.count(len(chunk))
+                            compressor.write(chunk)
+                except Exception, e:
+                    artifact.abort()
+                    raise
+                finally:
+                    compressor.close()
+                os.remove(path)
+
+    ####################################################################################################################
+    def __listCollections(self, mongodb, mongodbs):
+        listCommand = ["mongo", "--quiet"] + shlex.split(self.__mongoOptions(mongodbs)) + \
+                      [mongodb, "--eval", "db.getCollectionNames().forEach(function(name) { print(name) })"]
+        listOutput = StringIO.StringIO()
+        self.__streamCommand(listCommand, listOutput)
+        return [name for name in listOutput.getvalue().split('\n') if name and not name.startswith('system.')]
+
+    ####################################################################################################################
+    def __backupCollection(self, dumpCommand, backupFile, compression):
+        print "\tBacking up mongodb collection to %s" % backupFile
+        self.__dumpArtifact(dumpCommand, backupFile, compression)
+
+    ####################################################################################################################
+    def __writeManifest(self, manifestFile, manifest, units=(), position=None):
+        """
+        Writes the manifest of a dump split in several files, listing the units which failed if any. position is the
+        (key, value) of the oplog position to record once every unit succeeded.
+        """
+        manifest = dict(manifest)
+        manifest['created'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        manifest['failed'] = [unit.name for unit in units if unit.failed]
+        manifestOutput = self.__createArtifact(manifestFile)
+        try:
+            json.dump(manifest, manifestOutput, indent=2, separators=(',', ': '), sort_keys=True)
+        finally:
+            manifestOutput.close()
+        if position and not manifest['failed']:
+            self.catalog.setPosition(*position)
+
+    ####################################################################################################################
+    def __backupMongodb(self, mongodb, mongocommand, output_type, compression, mongodbs=None, position=None):
+        print "\tBacking up mongodb %s to %s" % (mongodb, output_type.split('=', 1)[1])
+        #Replaying the oplog from before the dump is harmless, its entries are idempotent
+        oplog = self.__oplogTimestamps(mongodbs)[1] if position else None
         #Complete the database specific commands
         if output_type[:9] == "--archive":
-            output_type += os.sep + mongodb + '.tar.gz '
+            #Archives are written to stdout and compressed by the compression stage
+            backupFile = output_type[10:] + os.sep + mongodb + '.archive' + compression['extension']
+            mongocommand += '--archive --db ' + mongodb + ' '
         else:
             output_type += os.sep + mongodb + ' '
-        mongocommand += output_type + ' --gzip ' + ' --db ' + mongodb + ' '
+            mongocommand += output_type + ' --db ' + mongodb + ' '
         #Convert command string to list
         safe_args = shlex.split(mongocommand)
         #Execute os command
-        subprocess.check_output(safe_args)    
+        if output_type[:9] == "--archive":
+            self.__dumpArtifact(safe_args, backupFile, compression)
+        else:
+            dumpFolder = output_type.split('=', 1)[1].strip()
+            #Files left by an earlier attempt would be compressed once more
+            if os.path.exists(dumpFolder):
+                shutil.rmtree(dumpFolder)
+            #mongodump writes the files itself, its stdout only holds messages
+            self.__streamCommand(safe_args, StringIO.StringIO())
+            self.__compressFolder(dumpFolder, compression)
+        if position:
+            self.catalog.setPosition(position, oplog)
 
     ####################################################################################################################
-    def __backupDatabases(self, databases, destination):
+    def __backupDatabases(self, databases, destination, projectName, compression):
         if 'prefix' in databases:
-            names = self.__listDatabases(databases['prefix'], databases['usr'], databases['pwd'])
+            names = self.__listDatabases(databases['prefix'], databases)
         else:
             names = databases['names']
 
+        units = []
+        host = databases['host'] if 'host' in databases else 'localhost'
         for database in names:
-            self.__backupDatabase(database, destination, databases['usr'], databases['pwd'])
+            position = self.__capturePosition(databases, projectName, 'mysql', database)
+            if position and self.catalog.position(position) and not self.__isFullDumpDay(databases):
+                function = self.__captureBinlog
+                args = (database, destination, databases, compression, projectName, position)
+            elif int(databases.get('parallel', 1)) > 1:
+                function = self.__backupDatabaseTables
+                args = (database, destination, databases, compression, projectName, position)
+            else:
+                function = self.__backupDatabase
+                args = (database, destination, databases, compression, position)
+            units.append(self.__submit(destination, "%s database %s" % (projectName, database), ('mysqldump', host),
+                                       function, args))
+        return units
+
+    ####################################################################################################################
+    def __mysqlOptions(self, databases):
+        options = ["-u", databases['usr'], "-p" + databases['pwd']]
+        if 'host' in databases:
+            options += ["-h", str(databases['host'])]
+        if 'port' in databases:
+            options += ["-P", str(databases['port'])]
+        return options
 
     ####################################################################################################################
-    def __listDatabases(self, prefix, usr, pwd):
+    def __listDatabases(self, prefix, databases):
         matchingCommand = "SHOW DATABASES LIKE '" + prefix + "'"
-        listCommand = ["mysql", "-u", usr, "-p" + pwd, "-B", "-N", "-e", matchingCommand]
-        listProcess = subprocess.Popen(listCommand, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        listOutput = listProcess.communicate()[0]
-        return listOutput.rstrip().split('\n')
+        listCommand = ["mysql"] + self.__mysqlOptions(databases) + ["-B", "-N", "-e", matchingCommand]
+        listOutput = StringIO.StringIO()
+        self.__streamCommand(listCommand, listOutput)
+        return listOutput.getvalue().rstrip().split('\n')
 
     ####################################################################################################################
-    def __backupDatabase(self, database, destination, usr, pwd):
+    def __backupDatabase(self, database, destination, databases, compression, position=None):
         print "\tBacking up database %s to %s" % (database, destination)
-        filename = "%s.sql.gz" % (os.path.basename(database))
+        filename = "%s.sql%s" % (os.path.basename(database), compression['extension'])
         backupFile = os.path.join(destination, filename)
 
-        dumpCommand = ["mysqldump", "-u", usr, "-p" + pwd, database]
-        dumpProcess = subprocess.Popen(dumpCommand, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        dumpOutput = dumpProcess.communicate()[0]
+        dumpCommand = ["mysqldump"] + self.__mysqlOptions(databases) + [database]
+        artifact = self.__createArtifact(backupFile)
+        compressor = self.__openCompressor(artifact, compression)
+        if position:
+            #The binlog position of the dump, where the next capture starts, is written in its header
+            dumpCommand[1:1] = ["--single-transaction", "--master-data=2"]
+            compressor = DumpPosition(compressor)
+        try:
+            self.__streamCommand(dumpCommand, compressor)
+        except Exception, e:
+            artifact.abort()
+            raise
+        finally:
+            compressor.close()
+        if position:
+            self.catalog.setPosition(position, compressor.position)
+
+    ####################################################################################################################
+    def __backupDatabaseTables(self, database, destination, databases, compression, projectName, position=None):
+        """
+        Dumps a database to one file per table and a manifest. The tables are shared out by size between 'parallel'
+        mysqldump connections, all started while a global read lock is held, so that their transactions
+        (--single-transaction) see the same point in time. The lock is released as soon as they all have started.
+        The connections beyond the first one take slots of the mysqldump limit of the host, as many as are free.
+        """
+        extra = self.scheduler.reserve(self.unit.resource, int(databases['parallel']) - 1)
+        try:
+            self.__dumpDatabaseTables(database, destination, databases, compression, projectName, position, extra + 1)
+        finally:
+            self.scheduler.release(self.unit.resource, extra)
+
+    ####################################################################################################################
+    def __dumpDatabaseTables(self, database, destination, databases, compression, projectName, position, connections):
+        print "\tBacking up database %s to %s with %d connections" % (database, destination, connections)
+        name = os.path.basename(database)
+        folder = os.path.join(destination, name)
+        self.__createBackupFolder(folder)
+        tables, views = self.__listTables(database, databases)
+        dumpCommand = ["mysqldump"] + self.__mysqlOptions(databases) + ["--single-transaction", database]
+
+        artifacts = []
 
-        zipFile = gzip.open(backupFile, "wb")
-        zipFile.write(dumpOutput)
-        zipFile.close()
+        def openTable(table):
+            artifacts.append(self.__createArtifact(os.path.join(folder, table + ".sql" + compression['extension'])))
+            return self.__openCompressor(artifacts[-1], compression)
+        splitters = []
+        results = []
+        lock, status = self.__lockTables(databases, position is not None)
+        pool = ThreadPool(max(1, min(connections, len(tables))))
+        try:
+            for tableBin in self.__shareOut(tables, connections):
+                splitters.append(TableSplitter(openTable, threading.Event()))
+                results.append(pool.apply_async(self.__dumpTables, (dumpCommand + tableBin, splitters[-1],
+                                                                    self.__unitContext())))
+            for splitter in splitters:
+                splitter.started.wait()
+        finally:
+            self.__unlockTables(lock)
+        pool.close()
+        try:
+            for result in results:
+                result.get()
+        except Exception, e:
+            #The tables are only consistent with each other, drop them all
+            pool.join()
+            for artifact in artifacts:
+                artifact.abort()
+            raise
+        pool.join()
+
+        #Views, routines and events are definitions only, they do not need to be part of the snapshot
+        objectsFile = name + ".objects.sql" + compression['extension']
+        objectsCommand = ["mysqldump"] + self.__mysqlOptions(databases) + \
+                         ["--single-transaction", "--no-data", "--skip-triggers", "--routines", "--events"]
+        objectsCommand += [database] + views if views else ["--no-create-info", database]
+        self.__dumpArtifact(objectsCommand, os.path.join(destination, objectsFile), compression)
+
+        files = [{'name': table, 'file': os.path.join(name, table + ".sql" + compression['extension'])}
+                 for splitter in splitters for table in splitter.tables]
+        manifest = {'format': 'mysql', 'project': projectName, 'database': database, 'tables': files,
+                    'objects': objectsFile}
+        self.__writeManifest(os.path.join(destination, name + self.MANIFEST_EXTENSION), manifest)
+        if position:
+            self.catalog.setPosition(position, {'file': status[0][0], 'position': int(status[0][1])})
+
+    ####################################################################################################################
+    def __listTables(self, database, databases):
+        """
+        Returns the (name, size) of the tables of a database, biggest first, and the names of its views
+        """
+        listCommand = ["mysql"] + self.__mysqlOptions(databases) + ["-B", "-N", "-e",
+                       "SELECT table_name, table_type, IFNULL(data_length + index_length, 0) FROM "
+                       "information_schema.tables WHERE table_schema = '%s'" % database.replace("'", "''")]
+        listOutput = StringIO.StringIO()
+        self.__streamCommand(listCommand, listOutput)
+        tables = []
+        views = []
+        for line in listOutput.getvalue().splitlines():
+            name, tableType, size = line.split('\t')
+            if tableType == 'VIEW':
+                views.append(name)
+            else:
+                tables.append((name, int(size)))
+        return sorted(tables, key=lambda table: -table[1]), views
+
+    ####################################################################################################################
+    def __shareOut(self, tables, count):
+        """
+        Shares the (name, size) tables out between at most count lists of names, each table going to the smallest list
+        so far, biggest table first
+        """
+        bins = [[] for i in range(min(count, len(tables)))]
+        sizes = [0] * len(bins)
+        for name, size in sorted(tables, key=lambda table: -table[1]):
+            smallest = sizes.index(min(sizes))
+            bins[smallest].append(name)
+            sizes[smallest] += size
+        return bins
+
+    ####################################################################################################################
+    def __lockTables(self, databases, masterStatus=False):
+        """
+        Starts a mysql session holding a global read lock, released by __unlockTables. Returns the session and, with
+        masterStatus, the rows of SHOW MASTER STATUS read under the lock.
+        """
+        lock = subprocess.Popen(["mysql"] + self.__mysqlOptions(databases) + ["--unbuffered", "-B", "-N"],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        lock.stdin.write("FLUSH TABLES WITH READ LOCK;\n")
+        if masterStatus:
+            lock.stdin.write("SHOW MASTER STATUS;\n")
+        lock.stdin.write("SELECT 'locked';\n")
+        lock.stdin.flush()
+        rows = []
+        for line in iter(lock.stdout.readline, ''):
+            if line.strip() == 'locked':
+                return lock, rows
+            rows.append(line.rstrip('\n').split('\t'))
+        self.__unlockTables(lock)
+        raise subprocess.CalledProcessError(lock.returncode, "mysql")
+
+    ####################################################################################################################
+    def __unlockTables(self, lock):
+        try:
+            lock.stdin.write("UNLOCK TABLES;\n")
+            lock.stdin.close()
+        except IOError, e:
+            #The session is gone, and its lock with it
+            pass
+        lock.stdout.read()
+        lock.wait()
+
+    ####################################################################################################################
+    def __capturePosition(self, section, projectName, kind, database):
+        """
+        Returns the catalog key of the binlog or oplog position of a database when its section is 'incremental'
+        """
+        if not section.get('incremental'):
+            return None
+        return "%s/%s/%s" % (projectName, kind, database)
+
+    ####################################################################################################################
+    def __isFullDumpDay(self, section):
+        """
+        Full dumps of incremental databases are made on the 'full' day of the week, sunday by default
+        """
+        incremental = section['incremental'] if isinstance(section['incremental'], dict) else {}
+        return date.today().strftime('%A').lower() == str(incremental.get('full', 'sunday')).lower()
+
+    ####################################################################################################################
+    def __mysqlQuery(self, databases, query):
+        queryOutput = StringIO.StringIO()
+        self.__streamCommand(["mysql"] + self.__mysqlOptions(databases) + ["-B", "-N", "-e", query], queryOutput)
+        return [line.split('\t') for line in queryOutput.getvalue().splitlines()]
+
+    ####################################################################################################################
+    def __captureBinlog(self, database, destination, databases, compression, projectName, position):
+        """
+        Writes the binlog events of a database since the previous dump or capture to compressed segments, one per
+        binlog file, and the manifest listing them
+        """
+        start = self.catalog.position(position)
+        status = self.__mysqlQuery(databases, "SHOW MASTER STATUS")
+        until = datetime.now()
+        end = {'file': status[0][0], 'position': int(status[0][1])}
+        logs = [row[0] for row in self.__mysqlQuery(databases, "SHOW BINARY LOGS")]
+        if start['file'] not in logs:
+            #The next run makes a full dump
+            self.catalog.setPosition(position, None)
+            raise ValueError("Binlog %s has been purged, events of %s were lost" % (start['file'], database))
+
+        print "\tCapturing the binlog of database %s from %s:%d" % (database, start['file'], start['position'])
+        name = os.path.basename(database)
+        self.__createBackupFolder(os.path.join(destination, name + '.binlog'))
+        segments = []
+        for log in logs[logs.index(start['file']):logs.index(end['file']) + 1]:
+            command = ["mysqlbinlog", "--read-from-remote-server"] + self.__mysqlOptions(databases) + \
+                      ["--database=" + database]
+            if log == start['file']:
+                command.append("--start-position=%d" % start['position'])
+            if log == end['file']:
+                command.append("--stop-position=%d" % end['position'])
+            segment = os.path.join(name + '.binlog', "%s.sql%s" % (log, compression['extension']))
+            self.__dumpArtifact(command + [log], os.path.join(destination, segment), compression)
+            segments.append(segment)
+
+        manifest = {'format': 'mysql-binlog', 'project': projectName, 'database': database, 'start': start,
+                    'end': end, 'until': until.strftime('%Y-%m-%d %H:%M:%S'), 'segments': segments}
+        self.__writeManifest(os.path.join(destination, name + '.binlog' + self.MANIFEST_EXTENSION), manifest)
+        self.catalog.setPosition(position, end)
+
+    ####################################################################################################################
+    def __oplogTimestamps(self, mongodbs):
+        """
+        Returns the timestamps of the first and last entries of the oplog, as {'t': seconds, 'i': ordinal}
+        """
+        listCommand = ["mongo", "--quiet"] + shlex.split(self.__mongoOptions(mongodbs)) + ["local", "--eval",
+                       "[1, -1].forEach(function(order) { var ts = db.oplog.rs.find().sort({$natural: order})"
+                       ".limit(1).next().ts; print(ts.t + ' ' + ts.i) })"]
+        listOutput = StringIO.StringIO()
+        self.__streamCommand(listCommand, listOutput)
+        return [{'t': int(line.split()[0]), 'i': int(line.split()[1])} for line in listOutput.getvalue().splitlines()]
+
+    ####################################################################################################################
+    def __captureOplog(self, mongodb, mongodbs, destination, compression, projectName, position):
+        """
+        Writes the oplog entries of a database since the previous dump or capture to a compressed segment and the
+        manifest listing it
+        """
+        start = self.catalog.position(position)
+        until = datetime.now()
+        first, end = self.__oplogTimestamps(mongodbs)
+        if (first['t'], first['i']) > (start['t'], start['i']):
+            #The next run makes a full dump
+            self.catalog.setPosition(position, None)
+            raise ValueError("The oplog does not go back to the previous capture, entries of %s were lost" % mongodb)
+
+        print "\tCapturing the oplog of mongodb %s from %d:%d" % (mongodb, start['t'], start['i'])
+        self.__createBackupFolder(os.path.join(destination, mongodb + '.oplog'))
+        query = json.dumps({'ts': {'$gt': {'$timestamp': start}, '$lte': {'$timestamp': end}},
+                            'ns': {'$regex': '^' + re.escape(mongodb) + '\\.'}})
+        command = ["mongodump"] + shlex.split(self.__mongoOptions(mongodbs)) + \
+                  ["--db", "local", "--collection", "oplog.rs", "--query", query, "--out", "-"]
+        segment = os.path.join(mongodb + '.oplog', "%d-%d.bson%s" % (start['t'], start['i'], compression['extension']))
+        self.__dumpArtifact(command, os.path.join(destination, segment), compression)
+
+        manifest = {'format': 'mongodb-oplog', 'project': projectName, 'database': mongodb, 'start': start,
+                    'end': end, 'until': until.strftime('%Y-%m-%d %H:%M:%S'), 'segments': [segment]}
+        self.__writeManifest(os.path.join(destination, mongodb + '.oplog' + self.MANIFEST_EXTENSION), manifest)
+        self.catalog.setPosition(position, end)
+
+    ####################################################################################################################
+    def __dumpTables(self, dumpCommand, splitter, unit=None):
+        self.__joinUnit(unit)
+        try:
+            self.__streamCommand(dumpCommand, splitter)
+        finally:
+            splitter.close()
+            self.__joinUnit(None)
+
+    ####################################################################################################################
+    def __loadArtifact(self, path, command, until=None):
+        """
+        Runs command with the content of a backup file, decrypted and decompressed, on its standard input. Binlog
+        segments are cut at until, and True is returned when it is reached.
+        """
+        print "\tRestoring %s" % path
+        process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        output = BinlogUntil(process.stdin, until) if until else process.stdin
+        self.__readArtifact(path, output)
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, command[0])
+        return until is not None and output.reached
+
+    ####################################################################################################################
+    def __readArtifact(self, path, output):
+        """
+        Writes the content of a backup file to output, going back through the encryption and compression stages, and
+        closes output
+        """
+        if path.endswith(ChunkArchive.INDEX_EXTENSION):
+            #Streamed back chunk by chunk from the store
+            archive = ChunkArchive(path[:-len(ChunkArchive.INDEX_EXTENSION)], ChunkStore.find(os.path.dirname(path)))
+            try:
+                for entry in archive.entries():
+                    archive.readFile(entry, output)
+            finally:
+                output.close()
+            return
+        name = path
+        encryption = None
+        for stage in (ChunkEncryptStage, GpgStage):
+            if name.endswith(stage.EXTENSION):
+                encryption = stage
+                name = name[:-len(stage.EXTENSION)]
+        for codec, extension in COMPRESSION_EXTENSIONS.iteritems():
+            if name.endswith(extension):
+                output = CommandStage([codec, "-d", "-c", "-q"], output)
+        if encryption is GpgStage:
+            output = GpgStage(output, self.__encryptionPassword(), True)
+        try:
+            with open(path, 'rb') as source:
+                if encryption is ChunkEncryptStage:
+                    ChunkEncryptStage.decrypt(source, output, self.__encryptionPassword())
+                else:
+                    while True:
+                        chunk = source.read(self.CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        output.write(chunk)
+        finally:
+            output.close()
+
+    ####################################################################################################################
+    def __loadCommand(self, dumpFormat, projectName, database, target=None):
+        """
+        Returns the command loading a dump of database read on its standard input into target (database by default),
+        the MySQL database being created if needed
+        """
+        project = self.config['projects'][projectName]
+        target = target or database
+        if dumpFormat == 'mysql':
+            options = self.__mysqlOptions(project['databases'])
+            createCommand = "CREATE DATABASE IF NOT EXISTS `%s`" % target.replace('`', '``')
+            self.__streamCommand(["mysql"] + options + ["-e", createCommand], sys.stdout)
+            return ["mysql"] + options + [target]
+        command = ["mongorestore"] + shlex.split(self.__mongoOptions(project['mongodbs'])) + ["--archive"]
+        if target != database:
+            command += ["--nsFrom", database + ".*", "--nsTo", target + ".*"]
+        return command
+
+    ####################################################################################################################
+    def __fullDump(self, snapshot, name):
+        """
+        Returns the (file, format) of the full dump of a database in a snapshot folder, None if there is none
+        """
+        for pattern, dumpFormat in [(name + '.sql.*', 'mysql'), (name + '.archive.*', 'mongodb'),
+                                    (name + self.MANIFEST_EXTENSION, None)]:
+            for dumpFile in glob.glob(os.path.join(snapshot, pattern)):
+                if dumpFormat is None:
+                    with open(dumpFile, 'r') as manifestInput:
+                        dumpFormat = json.load(manifestInput)['format']
+                return dumpFile, dumpFormat
+        return None
+
+    ####################################################################################################################
+    def __replaySegments(self, snapshot, projectName, name, until, target=None):
+        """
+        Replays the binlog or oplog segments of a database captured in a snapshot, up to until. Returns True once
+        until is reached.
+        """
+        for kind in ('binlog', 'oplog'):
+            manifestFile = os.path.join(snapshot, "%s.%s%s" % (name, kind, self.MANIFEST_EXTENSION))
+            if not os.path.exists(manifestFile):
+                continue
+            with open(manifestFile, 'r') as manifestInput:
+                manifest = json.load(manifestInput)
+            if target and target != manifest['database']:
+                raise ValueError("%s segments replay into the database they were captured from only" % kind)
+            project = self.config['projects'][projectName]
+            for segment in manifest['segments']:
+                segmentFile = os.path.join(snapshot, segment)
+                if kind == 'binlog':
+                    if self.__loadArtifact(segmentFile, ["mysql"] + self.__mysqlOptions(project['databases']), until):
+                        return True
+                else:
+                    self.__replayOplog(segmentFile, project['mongodbs'], until)
+            if datetime.strptime(manifest['until'], '%Y-%m-%d %H:%M:%S') >= until:
+                return True
+        return False
+
+    ####################################################################################################################
+    def __replayOplog(self, segmentFile, mongodbs, until):
+        print "\tReplaying %s" % segmentFile
+        folder = tempfile.mkdtemp()
+        try:
+            oplogFile = os.path.join(folder, 'oplog.bson')
+            self.__readArtifact(segmentFile, open(oplogFile, 'wb'))
+            #mongorestore wants a dump folder, an empty one restores nothing but the oplog
+            dumpFolder = os.path.join(folder, 'dump')
+            os.mkdir(dumpFolder)
+            #The limit is exclusive, entries of the until second are replayed
+            limit = int(time.mktime(until.timetuple())) + 1
+            self.__streamCommand(["mongorestore"] + shlex.split(self.__mongoOptions(mongodbs)) +
+                                 ["--oplogReplay", "--oplogFile", oplogFile, "--oplogLimit", str(limit), dumpFolder],
+                                 sys.stdout)
+        finally:
+            shutil.rmtree(folder)
+
+    ####################################################################################################################
+    def __compressionSettings(self, projectName=None):
+        """
+        Merges the default, global and project 'compression' sections
+        """
+        settings = dict(self.DEFAULT_COMPRESSION)
+        if 'compression' in self.config:
+            settings.update(self.config['compression'])
+        if projectName in self.config.get('projects', {}) and 'compression' in self.config['projects'][projectName]:
+            settings.update(self.config['projects'][projectName]['compression'])
+        if settings['codec'] not in COMPRESSION_EXTENSIONS:
+            raise ValueError("Unknown compression codec %s" % settings['codec'])
+        if not settings['threads']:
+            settings['threads'] = multiprocessing.cpu_count()
+        if self.__isDelta():
+            if settings['codec'] == 'lz4':
+                raise ValueError("lz4 has no rsyncable mode, use gzip or zstd")
+            settings['rsyncable'] = True
+        settings['extension'] = COMPRESSION_EXTENSIONS[settings['codec']]
+        password = self.__encryptionPassword()
+        if password:
+            #Artifacts go through the encryption stage after the compression one
+            settings['encryption'] = password
+            settings['encryptionExtension'] = ChunkEncryptStage.EXTENSION if self.__isDelta() else GpgStage.EXTENSION
+            settings['extension'] += settings['encryptionExtension']
+        elif self.__isRepository(projectName):
+            #Chunks are stored gzip compressed at the configured level, whatever the codec
+            settings['repository'] = True
+            settings['extension'] = ChunkArchive.INDEX_EXTENSION
+        return settings
+
+    ####################################################################################################################
+    def __encryptionPassword(self):
+        """
+        The password of the rsync 'encrypt_files' section, None when the backups are not encrypted
+        """
+        if 'rsync' not in self.config or not self.config['rsync'].get('encrypt_files'):
+            return None
+        password = self.config['rsync']['encrypt_files'].get('encryptionPassword')
+        return str(password) if password else None
+
+    ####################################################################################################################
+    def __encryptionSalt(self, backupFolder):
+        """
+        The salt of the keys encrypting in delta mode, kept in the destination so that the chunks encrypt to the same
+        bytes from one day to the next
+        """
+        path = os.path.join(backupFolder, self.SALT_FILE)
+        if not os.path.exists(path):
+            saltFile = AtomicFile(path)
+            try:
+                saltFile.write(os.urandom(ChunkEncryptStage.SALT_SIZE).encode('hex') + '\n')
+            finally:
+                saltFile.close()
+        with open(path) as saltFile:
+            return saltFile.read().strip().decode('hex')
+
+    ####################################################################################################################
+    def __isDelta(self):
+        """
+        In delta mode, compressed and encrypted artifacts are laid out so that rsync only sends what changed
+        """
+        return 'rsync' in self.config and bool(self.config['rsync'].get('delta', False))
+
+    ####################################################################################################################
+    def __openCompressor(self, output, compression):
+        """
+        Returns the file object compressing, and encrypting if required, what is written to it into output, closing it
+        closes output
+        """
+        level = int(compression['level'])
+        if 'repository' in compression:
+            #output is the index of the chunks, holding a single entry named after it
+            name = os.path.basename(output.path)[:-len(ChunkArchive.INDEX_EXTENSION)]
+            return ChunkWriter(self.chunkStore, level, output, {'path': name, 'type': 'f', 'mode': 0600,
+                                                                'mtime': time.time()})
+        threads = int(compression['threads'])
+        rsyncable = compression.get('rsyncable', False)
+        throttle = self.__unitThrottle()
+        priority = throttle.priority if throttle else []
+        if 'encryption' in compression:
+            output = self.__openEncryptor(output, compression['encryption'])
+        if compression['codec'] == 'zstd':
+            return CommandStage(["zstd", "-q", "-c", "-%d" % level, "-T%d" % threads] +
+                                (["--rsyncable"] if rsyncable else []), output, priority)
+        if compression['codec'] == 'lz4':
+            return CommandStage(["lz4", "-q", "-c", "-%d" % level], output, priority)
+        return GzipStage(output, level, threads, rsyncable)
+
+    ####################################################################################################################
+    def __openEncryptor(self, output, password):
+        """
+        Returns the file object encrypting what is written to it into output, see GpgStage and ChunkEncryptStage
+        """
+        if self.__isDelta():
+            return ChunkEncryptStage(output, password, self.encryptionSalt)
+        throttle = self.__unitThrottle()
+        return GpgStage(output, password, priority=throttle.priority if throttle else [])
+
+    ####################################################################################################################
+    def __encryptFile(self, path, encryptedFile, password):
+        artifact = self.__createArtifact(encryptedFile)
+        encryptor = self.__openEncryptor(artifact, password)
+        throttle = self.__unitThrottle()
+        try:
+            with open(path, 'rb') as source:
+                while True:
+                    chunk = source.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if throttle:
+                        throttle.consume(len(chunk))
+                    StageMetrics.count(len(chunk))
+                    encryptor.write(chunk)
+        except Exception, e:
+            artifact.abort()
+            raise
+        finally:
+            encryptor.close()
+
+    ####################################################################################################################
+    def __streamCommand(self, command, output, warnings=()):
+        """
+        Runs a command and copies its stdout to the output file object in CHUNK_SIZE blocks, so memory use does not
+        depend on the size of the output. stderr is collected apart and printed once the command has exited. A non
+        zero exit code raises CalledProcessError, unless it is one of warnings.
+
+        In a throttled unit the command starts once the server is not busy, runs at the priority of the unit and its
+        output is read at the rate of the unit: the command blocks on the full pipe, so it reads from the disk or the
+        database at that rate too.
+        """
+        throttle = self.__unitThrottle()
+        if throttle:
+            throttle.wait()
+        errors = tempfile.TemporaryFile()
+        process = subprocess.Popen((throttle.priority if throttle else []) + command, stdout=subprocess.PIPE,
+                                   stderr=errors)
+        try:
+            while True:
+                #Whatever is in the pipe, up to CHUNK_SIZE: a stage waiting for the first lines gets them at once
+                chunk = os.read(process.stdout.fileno(), self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                if throttle:
+                    throttle.consume(len(chunk))
+                StageMetrics.count(len(chunk))
+                output.write(chunk)
+        finally:
+            process.stdout.close()
+            returnCode = waitProcess(process)
+            errors.seek(0)
+            errorOutput = errors.read()
+            errors.close()
+
+        if errorOutput:
+            print "\t" + errorOutput.rstrip().replace("\n", "\n\t")
+        if returnCode in warnings:
+            print "\tWarning: %s exited with %d" % (command[0], returnCode)
+        elif returnCode != 0:
+            # Only the program name is reported, the arguments may hold passwords
+            raise subprocess.CalledProcessError(returnCode, command[0])
 
     ####################################################################################################################
     def __encryptFiles(self, source, password, remote=None):
@@ -351,15 +2134,16 @@ class ObibaBackup:
         if os.path.isfile(source['path']):
             archiveRequired = False
             fileToEncrypt = source['path']
-            encryptedFile = fileToEncrypt + ".gpg"
+            encryptedFile = fileToEncrypt + (ChunkEncryptStage.EXTENSION if self.__isDelta() else GpgStage.EXTENSION)
         else:
             archiveRequired = True
             folderToArchive = source['path']
+            compression = self.__compressionSettings(remote)
             if remote:
                 remote = os.sep + str(remote)
             else:
                 remote = ""
-            encryptedFile = source['path'] + str(remote) + ".tar.gz.gpg"
+            encryptedFile = source['path'] + str(remote) + ".tar" + compression['extension']
         
         #Delete the file if it already exists
         try:
@@ -371,58 +2155,1686 @@ class ObibaBackup:
             excludes = []
             if 'excludes' in source:
                 for exclude in source['excludes']:
-                    excludes.append("--exclude='" + folderToArchive + exclude + "' ")
+                    excludes.append("--exclude=" + folderToArchive + exclude)
 
             #tar is picky about the position of the Exclude list, see 
             #https://www.linuxquestions.org/questions/showthread.php?threadid=194476&highlight=exclude+directories+recursively+tar
-            compressCommand = "tar --create --gzip " + " ".join(excludes) + " " + folderToArchive + " --file - " 
-            compressSafeArgs = shlex.split(compressCommand)
-            
-            #Create two processes (one to archive and one to encrypt) pass the stdout of the archive as the stdin of the encrypt
-            compressProcess = subprocess.Popen(compressSafeArgs, stdout=subprocess.PIPE)
-            encryptProcess = subprocess.Popen(["gpg", "--symmetric", "-o", encryptedFile, "--batch", "--passphrase", str(password)], stdin=compressProcess.stdout, stdout=subprocess.PIPE)
-            compressProcess.stdout.close()  # Allow compressProcess to receive a SIGPIPE if encryptProcess exits.
+            archiveCommand = ["tar", "--create"] + excludes + [folderToArchive, "--file", "-"]
+
+            #tar output goes through the compression stage then the encryption one, which writes the encrypted file
+            self.__dumpArtifact(archiveCommand, encryptedFile, compression, (1,))
         else:
-            #create a single process to encrypt
-            encryptCommand = ["gpg", "--symmetric", "--batch", "--passphrase", password, fileToEncrypt]
-            encryptProcess = subprocess.Popen(encryptCommand, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        encryptOutput = encryptProcess.communicate()[0]    
+            self.__encryptFile(fileToEncrypt, encryptedFile, str(password))
         return encryptedFile
     
-    ####################################################################################################################
-    def __deleteFolders(self, deleteCount, sortedFolders):
-        if deleteCount > 0:
-            foldersToDelete = sortedFolders[:deleteCount]
-            for folder in foldersToDelete:
-                print "\tDeleting %s" % folder[0]
-                shutil.rmtree(folder[0])
-
-    ####################################################################################################################
-    def __getSortedFolderList(self, destinations, ignore_folders_begining_with):
-        #Build a folder list and sort by last modified date. 
-        #Excluded any folder from the list if they begin with any of the values in ignore_folders_begining_with
-        dir_file_date_list = []
-        for destination in destinations:
-            for folder in os.listdir(destination):
-                #Check if folder begins with a value that we want to ignore
-                bln_ignore = False
-                for ignore in ignore_folders_begining_with:
-                    if folder[:len(ignore)] == ignore:
-                        bln_ignore = True
-                        break
-                
-                #Add the folder to the list
-                if not bln_ignore:
-                    file_attributes = [os.path.join(destination, folder),folder, os.path.getmtime(os.path.join(destination, folder))]
-                    dir_file_date_list.append(file_attributes)
-        
-        dir_file_date_list.sort(key=lambda x: x[2]) #Sort by third item (date)
-        return dir_file_date_list
-
     ####################################################################################################################
     def __createBackupFolder(self, path):
         if not os.path.exists(path):
-            os.makedirs(path)
+            try:
+                os.makedirs(path)
+            except OSError, e:
+                #Another unit may have created it in the meantime
+                if e.errno != errno.EEXIST:
+                    raise
+
+
+####################################################################################################################
+# H E L P E R S
+####################################################################################################################
+
+class Scheduler:
+    """
+    Runs backup units on a pool of worker threads.
+
+    Each unit names a resource as a (class, key) tuple, e.g. ('mysqldump', 'localhost'). At most limits[class] units
+    of the same resource run at the same time, units waiting for a busy resource do not hold a worker. A unit can be
+    made to wait for other units, and a failing unit is reported without stopping the others.
+    """
+
+    def __init__(self, workers, limits, reportError):
+        self.limits = limits
+        self.reportError = reportError
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.running = {}
+        self.blocked = {}
+        self.pending = 0
+        self.failures = []
+        for i in range(max(1, workers)):
+            worker = threading.Thread(target=self.__work)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, name, resource, function, args=(), after=()):
+        unit = SchedulerUnit(name, resource, function, args)
+        with self.lock:
+            self.pending += 1
+            for other in after:
+                if not other.done:
+                    unit.waitingFor += 1
+                    other.dependents.append(unit)
+            ready = unit.waitingFor == 0
+        if ready:
+            self.queue.put(unit)
+        return unit
+
+    def wait(self):
+        """
+        Blocks until every submitted unit has run and returns the names of the failed ones
+        """
+        with self.lock:
+            while self.pending > 0:
+                self.idle.wait(1)
+            return list(self.failures)
+
+    def __work(self):
+        while True:
+            unit = self.queue.get()
+            if not self.__acquire(unit):
+                continue
+            try:
+                unit.function(*unit.args)
+            except Exception, e:
+                unit.failed = True
+                self.reportError(unit.name)
+                with self.lock:
+                    self.failures.append(unit.name)
+            finally:
+                self.__release(unit)
+
+    def reserve(self, resource, count):
+        """
+        Takes up to count more slots of resource for a running unit without waiting, returns how many were taken
+        """
+        with self.lock:
+            limit = self.limits.get(resource[0])
+            taken = min(count, limit - self.running.get(resource, 0)) if limit else count
+            taken = max(0, taken)
+            self.running[resource] = self.running.get(resource, 0) + taken
+            return taken
+
+    def release(self, resource, count):
+        """
+        Gives back slots taken by reserve
+        """
+        ready = []
+        with self.lock:
+            self.running[resource] -= count
+            blocked = self.blocked.get(resource, [])
+            while blocked and len(ready) < count:
+                ready.append(blocked.pop(0))
+        for unit in ready:
+            self.queue.put(unit)
+
+    def __acquire(self, unit):
+        with self.lock:
+            limit = self.limits.get(unit.resource[0])
+            if limit and self.running.get(unit.resource, 0) >= limit:
+                self.blocked.setdefault(unit.resource, []).append(unit)
+                return False
+            self.running[unit.resource] = self.running.get(unit.resource, 0) + 1
+            return True
+
+    def __release(self, unit):
+        ready = []
+        with self.lock:
+            self.running[unit.resource] -= 1
+            if self.blocked.get(unit.resource):
+                ready.append(self.blocked[unit.resource].pop(0))
+            unit.done = True
+            for dependent in unit.dependents:
+                dependent.waitingFor -= 1
+                if dependent.waitingFor == 0:
+                    ready.append(dependent)
+            self.pending -= 1
+            self.idle.notifyAll()
+        for other in ready:
+            self.queue.put(other)
+
+
+class SchedulerUnit:
+    def __init__(self, name, resource, function, args):
+        self.name = name
+        self.resource = resource
+        self.function = function
+        self.args = args
+        self.waitingFor = 0
+        self.dependents = []
+        self.done = False
+        self.failed = False
+
+
+class GzipStage:
+    """
+    File object writing a gzip stream to output. With more than one thread, the data is cut in BLOCK_SIZE blocks
+    compressed in parallel, each block being a gzip member of its own: the result is still read by gzip/gunzip.
+
+    When rsyncable, blocks are cut by a ContentChunker instead, so unchanged data gives the same gzip members from one
+    day to the next and rsync can reuse them.
+    """
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, output, level=6, threads=1, rsyncable=False):
+        self.output = output
+        self.level = level
+        self.chunker = ContentChunker() if rsyncable else None
+        self.compressor = None
+        self.pool = None
+        self.buffer = []
+        self.buffered = 0
+        if threads > 1:
+            self.pool = ThreadPool(threads)
+            self.maxPending = threads * 2
+            self.results = collections.deque()
+        elif not rsyncable:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def write(self, data):
+        if self.compressor is not None:
+            self.output.write(self.compressor.compress(data))
+        elif self.chunker:
+            for block in self.chunker.split(data):
+                self.__submit(block)
+        else:
+            self.buffer.append(data)
+            self.buffered += len(data)
+            if self.buffered >= self.BLOCK_SIZE:
+                self.__submit(''.join(self.buffer))
+                self.buffer = []
+                self.buffered = 0
+
+    def close(self):
+        try:
+            if self.compressor is not None:
+                self.output.write(self.compressor.flush())
+            else:
+                block = self.chunker.flush() if self.chunker else ''.join(self.buffer)
+                if block:
+                    self.__submit(block)
+                if self.pool:
+                    while self.results:
+                        self.output.write(self.results.popleft().get())
+                    self.pool.close()
+                    self.pool.join()
+        finally:
+            self.output.close()
+
+    def __submit(self, block):
+        if self.pool is None:
+            self.output.write(compressGzipMember(block, self.level))
+            return
+        self.results.append(self.pool.apply_async(compressGzipMember, (block, self.level)))
+        #Keep the memory bounded, blocks are written in order
+        while len(self.results) > self.maxPending:
+            self.output.write(self.results.popleft().get())
+
+
+def compressGzipMember(block, level):
+    # zlib releases the GIL while compressing, so the blocks of a GzipStage use several cores. The member header
+    # holds no name nor time, the same block always gives the same bytes.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush()
+
+
+class CommandStage:
+    """
+    File object piping what is written to it through an external command (zstd, gpg...) into output. The command is
+    prefixed with priority (nice, ionice), see Throttle.
+    """
+
+    def __init__(self, command, output, priority=()):
+        self.command = command
+        self.output = output
+        self.errors = tempfile.TemporaryFile()
+        self.pump = None
+        self.pumpError = None
+        command = list(priority) + command
+        if isinstance(output, file):
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=output, stderr=self.errors)
+        else:
+            #The output is another stage, copy the command output to it
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.errors)
+            self.pump = threading.Thread(target=self.__pump)
+            self.pump.daemon = True
+            self.pump.start()
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            if self.pump:
+                self.pump.join()
+                if self.pumpError:
+                    raise self.pumpError
+            returnCode = waitProcess(self.process)
+            self.errors.seek(0)
+            errorOutput = self.errors.read()
+            self.errors.close()
+            if errorOutput:
+                print "\t" + errorOutput.rstrip().replace("\n", "\n\t")
+            if returnCode != 0:
+                raise subprocess.CalledProcessError(returnCode, self.command[0])
+        finally:
+            self.output.close()
+
+    def __pump(self):
+        try:
+            while True:
+                chunk = self.process.stdout.read(ObibaBackup.CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.output.write(chunk)
+        except Exception, e:
+            self.pumpError = e
+        finally:
+            self.process.stdout.close()
+
+
+class GpgStage(CommandStage):
+    """
+    File object encrypting (or decrypting) what is written to it with gpg into output. The data is already
+    compressed, so gpg does not compress it again, and the password is passed on a file descriptor.
+    """
+    EXTENSION = '.gpg'
+
+    def __init__(self, output, password, decrypt=False, priority=()):
+        passwordRead = passwordPipe(password)
+        if decrypt:
+            command = ["gpg", "--decrypt", "--batch", "--quiet"]
+        else:
+            command = ["gpg", "--symmetric", "--batch", "--quiet", "--compress-algo", "none"]
+        try:
+            CommandStage.__init__(self, command + ["--passphrase-fd", str(passwordRead), "--output", "-"], output,
+                                  priority)
+        finally:
+            os.close(passwordRead)
+
+    @staticmethod
+    def decrypt(encrypted, output, password):
+        passwordRead = passwordPipe(password)
+        try:
+            process = subprocess.Popen(["gpg", "--decrypt", "--batch", "--quiet", "--passphrase-fd", str(passwordRead)],
+                                       stdin=encrypted, stdout=output)
+        finally:
+            os.close(passwordRead)
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, "gpg")
+
+
+def passwordPipe(password):
+    """
+    Returns the read end of a pipe holding the password, for the commands reading it from a file descriptor so that
+    it never appears on their command line. The caller closes it once the command is started.
+    """
+    passwordRead, passwordWrite = os.pipe()
+    os.write(passwordWrite, password + '\n')
+    os.close(passwordWrite)
+    return passwordRead
+
+
+class Throttle:
+    """
+    Limits the rate, in bytes per second, of the data going through the units sharing it, and holds them back while
+    busy() tells the server is overloaded. priority is the command prefix (nice, ionice) of their child processes.
+    """
+    CHECK_INTERVAL = 5
+
+    def __init__(self, rate=None, priority=(), busy=None):
+        self.rate = rate
+        self.priority = list(priority)
+        self.busy = busy
+        self.lock = threading.Lock()
+        self.next = time.time()
+        self.checked = 0
+        self.overloaded = False
+
+    def consume(self, size):
+        """
+        Blocks until size more bytes can go through
+        """
+        self.wait()
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            #Idle time is not saved up for later bursts
+            self.next = max(self.next, now) + float(size) / self.rate
+            delay = self.next - now
+        time.sleep(delay)
+
+    def wait(self):
+        """
+        Blocks while the server is busy, checked at most every CHECK_INTERVAL seconds
+        """
+        while self.busy:
+            with self.lock:
+                if time.time() - self.checked >= self.CHECK_INTERVAL:
+                    self.checked = time.time()
+                    overloaded = self.overloaded
+                    try:
+                        self.overloaded = self.busy()
+                    except Exception, e:
+                        self.overloaded = False
+                    if self.overloaded and not overloaded:
+                        print "\tServer busy, throttled backups paused"
+                overloaded = self.overloaded
+            if not overloaded:
+                return
+            time.sleep(self.CHECK_INTERVAL)
+
+
+def parseSize(size):
+    # 1048576, '512K', '20M' or '1G'
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*$', str(size), re.IGNORECASE)
+    if not match:
+        raise ValueError("Invalid size %s" % size)
+    return int(float(match.group(1)) * 1024 ** ' KMG'.index(match.group(2).upper() or ' '))
+
+
+class RunMetrics:
+    """
+    Collects the StageMetrics of a run, reported as JSON or as a Prometheus textfile collector file
+    """
+    PROMETHEUS_PREFIX = 'obiba_backup_'
+    STAGE_METRICS = [('duration', 'duration_seconds', "Wall time of the stage"),
+                     ('cpu', 'cpu_seconds', "CPU time of the stage and of the commands it ran"),
+                     ('read', 'read_bytes', "Bytes read by the stage"),
+                     ('written', 'written_bytes', "Bytes written or sent by the stage"),
+                     ('ratio', 'compression_ratio', "Bytes read per byte written"),
+                     ('throughput', 'throughput_bytes_per_second', "Bytes read per second of wall time"),
+                     ('peakRss', 'peak_rss_bytes', "Peak resident memory of the script or of its biggest command"),
+                     ('failed', 'failed', "1 if the stage failed")]
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = []
+        self.lock = threading.Lock()
+
+    def measure(self, stage, name, project=None):
+        """
+        Returns the StageMetrics measuring a stage, run it within a with statement
+        """
+        metrics = StageMetrics(stage, name, project)
+        with self.lock:
+            self.stages.append(metrics)
+        return metrics
+
+    def report(self, failures=None):
+        with self.lock:
+            stages = [metrics.report() for metrics in self.stages if metrics.duration is not None]
+        totals = {}
+        for stage in stages:
+            total = totals.setdefault(stage['stage'], {'count': 0, 'duration': 0.0, 'cpu': 0.0, 'read': 0,
+                                                       'written': 0})
+            total['count'] += 1
+            for key in ['duration', 'cpu', 'read', 'written']:
+                total[key] += stage[key]
+        finished = time.time()
+        return {'started': datetime.fromtimestamp(self.started).strftime('%Y-%m-%d %H:%M:%S'),
+                'finished': datetime.fromtimestamp(finished).strftime('%Y-%m-%d %H:%M:%S'),
+                'startedTimestamp': self.started, 'duration': finished - self.started,
+                'status': 'error' if failures is None else 'failed' if failures else 'complete',
+                'failures': failures or [], 'stages': stages, 'totals': totals}
+
+    def writeJson(self, path, report):
+        output = AtomicFile(path)
+        try:
+            json.dump(report, output, indent=2, separators=(',', ': '), sort_keys=True)
+        finally:
+            output.close()
+
+    def writePrometheus(self, path, report):
+        # The collector may read the file at any time, it is renamed into place once written
+        output = AtomicFile(path)
+        try:
+            run = [('run_start_timestamp_seconds', "Start of the last backup run", report['startedTimestamp']),
+                   ('run_duration_seconds', "Wall time of the last backup run", report['duration']),
+                   ('run_success', "1 if every unit of the last backup run succeeded",
+                    int(report['status'] == 'complete')),
+                   ('run_failed_units', "Units which failed in the last backup run", len(report['failures']))]
+            for name, description, value in run:
+                self.__writeMetric(output, name, description, [('', value)])
+            for key, name, description in self.STAGE_METRICS:
+                samples = []
+                for stage in report['stages']:
+                    if stage[key] is not None:
+                        labels = '{stage="%s",project="%s",name="%s"}' % tuple(
+                            escapeLabel(stage[label] or '') for label in ['stage', 'project', 'name'])
+                        samples.append((labels, int(stage[key]) if key == 'failed' else stage[key]))
+                self.__writeMetric(output, 'stage_' + name, description, samples)
+        finally:
+            output.close()
+
+    def __writeMetric(self, output, name, description, samples):
+        output.write("# HELP %s%s %s\n# TYPE %s%s gauge\n" % (self.PROMETHEUS_PREFIX, name, description,
+                                                             self.PROMETHEUS_PREFIX, name))
+        for labels, value in samples:
+            output.write("%s%s%s %.17g\n" % (self.PROMETHEUS_PREFIX, name, labels, value))
+
+
+def escapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class StageMetrics:
+    """
+    Wall time, CPU time, bytes read and written and peak RSS of a backup stage, measured within a with statement.
+    Meanwhile, the data counted (see count) and the commands waited for (see waitProcess) by its thread are added to
+    it. The CPU time is the one of the thread, the gzip threads are not counted, and of the commands.
+    """
+    running = threading.local()
+
+    def __init__(self, stage, name, project=None):
+        self.stage = stage
+        self.name = name
+        self.project = project
+        self.read = 0
+        self.written = 0
+        self.commandCpu = 0.0
+        self.peakRss = 0
+        self.duration = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.parent = StageMetrics.current()
+        StageMetrics.running.current = self
+        self.started = time.time()
+        self.threadCpu = threadCpuTime()
+        return self
+
+    def __exit__(self, errorType, error, trace):
+        self.cpu = threadCpuTime() - self.threadCpu + self.commandCpu
+        # ru_maxrss is in KB on Linux
+        self.peakRss = max(self.peakRss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+        self.failed = errorType is not None
+        self.duration = time.time() - self.started
+        StageMetrics.running.current = self.parent
+        if self.parent:
+            self.parent.commandCpu += self.commandCpu
+            self.parent.peakRss = max(self.parent.peakRss, self.peakRss)
+        return False
+
+    @staticmethod
+    def current():
+        return getattr(StageMetrics.running, 'current', None)
+
+    @staticmethod
+    def count(read=0, written=0):
+        """
+        Adds to the bytes read and written by the stage running in this thread, if any
+        """
+        current = StageMetrics.current()
+        if current:
+            with current.lock:
+                current.read += read
+                current.written += written
+
+    @staticmethod
+    def countCommand(usage):
+        current = StageMetrics.current()
+        if current:
+            with current.lock:
+                current.commandCpu += usage.ru_utime + usage.ru_stime
+                current.peakRss = max(current.peakRss, usage.ru_maxrss * 1024)
+
+    def report(self):
+        return {'stage': self.stage, 'name': self.name, 'project': self.project,
+                'started': datetime.fromtimestamp(self.started).strftime('%Y-%m-%d %H:%M:%S'),
+                'duration': self.duration, 'cpu': self.cpu, 'read': self.read, 'written': self.written,
+                'ratio': float(self.read) / self.written if self.read and self.written else None,
+                'throughput': self.read / self.duration if self.duration else None,
+                'peakRss': self.peakRss, 'failed': self.failed}
+
+
+def threadCpuTime():
+    # RUSAGE_THREAD (1 on Linux) is missing from the resource module of Python 2
+    try:
+        usage = resource.getrusage(getattr(resource, 'RUSAGE_THREAD', 1))
+    except (ValueError, resource.error), e:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def waitProcess(process):
+    """
+    process.wait(), also counting the CPU time and peak RSS of the process in the running StageMetrics
+    """
+    while process.returncode is None:
+        try:
+            pid, status, usage = os.wait4(process.pid, 0)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                return process.wait()
+            raise
+        process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        StageMetrics.countCommand(usage)
+    return process.returncode
+
+
+class AtomicFile:
+    """
+    File object writing to path + PART_EXTENSION, renamed to path once closed, so that a file under its final name is
+    always complete. written(path, size, sha256) is called once it is renamed. An aborted file is deleted.
+    """
+    PART_EXTENSION = '.part'
+
+    def __init__(self, path, written=None):
+        self.path = path
+        self.written = written
+        self.file = open(path + self.PART_EXTENSION, 'wb')
+        self.size = 0
+        self.checksum = hashlib.sha256()
+        self.aborted = False
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+        self.checksum.update(data)
+
+    def tell(self):
+        return self.size
+
+    def abort(self):
+        self.aborted = True
+        if self.file.closed and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        if self.aborted:
+            os.remove(self.file.name)
+            return
+        os.rename(self.file.name, self.path)
+        if self.written:
+            self.written(self.path, self.size, self.checksum.hexdigest())
+
+
+class RunLock:
+    """
+    Exclusive lock (flock) on a file of the destination, released when the process ends in any case
+    """
+    FILENAME = 'backup.lock'
+
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def acquire(self, wait=True):
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+            return True
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+
+    def release(self):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+class TableSplitter:
+    """
+    File object splitting the output of mysqldump into one file per table, opened by openTable(name). Every file starts
+    with the header of the dump, which holds the session settings. started is set at the first table: with
+    --single-transaction, mysqldump has started its transaction by then.
+    """
+    MARKER = '-- Table structure for table '
+
+    def __init__(self, openTable, started):
+        self.openTable = openTable
+        self.started = started
+        self.tables = []
+        self.header = []
+        self.output = None
+        self.rest = ''
+
+    def write(self, data):
+        lines = (self.rest + data).split('\n')
+        self.rest = lines.pop()
+        for line in lines:
+            self.__writeLine(line + '\n')
+
+    def close(self):
+        try:
+            if self.rest:
+                self.__writeLine(self.rest)
+                self.rest = ''
+        finally:
+            self.started.set()
+            if self.output:
+                self.output.close()
+                self.output = None
+
+    def __writeLine(self, line):
+        if line.startswith(self.MARKER):
+            self.started.set()
+            if self.output:
+                self.output.close()
+            table = line[len(self.MARKER):].strip()[1:-1].replace('``', '`')
+            self.tables.append(table)
+            self.output = self.openTable(table)
+            self.output.write(''.join(self.header))
+        if self.output is None:
+            self.header.append(line)
+        else:
+            self.output.write(line)
+
+
+class DumpPosition:
+    """
+    File object passing the output of mysqldump --master-data=2 on to output, reading the binlog position of the dump
+    from its header
+    """
+    PATTERN = re.compile(r"CHANGE (?:MASTER|REPLICATION SOURCE) TO (?:MASTER|SOURCE)_LOG_FILE='([^']+)', "
+                         r"(?:MASTER|SOURCE)_LOG_POS=(\d+)")
+    HEADER_SIZE = 64 * 1024
+
+    def __init__(self, output):
+        self.output = output
+        self.position = None
+        self.header = ''
+
+    def write(self, data):
+        if self.position is None and len(self.header) < self.HEADER_SIZE:
+            self.header += data[:self.HEADER_SIZE]
+            match = self.PATTERN.search(self.header)
+            if match:
+                self.position = {'file': match.group(1), 'position': int(match.group(2))}
+        self.output.write(data)
+
+    def close(self):
+        self.output.close()
+        if self.position is None:
+            raise ValueError("No binlog position in the dump, is the binlog enabled?")
+
+
+class BinlogUntil:
+    """
+    File object passing the output of mysqlbinlog on to output up to the first event logged after until. The
+    transaction that event may belong to is rolled back.
+    """
+    EVENT = re.compile(r'#(\d{6}) +(\d{1,2}:\d\d:\d\d) server id ')
+
+    def __init__(self, output, until):
+        self.output = output
+        self.until = until
+        self.reached = False
+        self.rest = ''
+
+    def write(self, data):
+        if self.reached:
+            return
+        lines = (self.rest + data).split('\n')
+        self.rest = lines.pop()
+        for index, line in enumerate(lines):
+            match = self.EVENT.match(line)
+            if match and datetime.strptime(' '.join(match.groups()), '%y%m%d %H:%M:%S') > self.until:
+                lines = lines[:index]
+                self.reached = True
+                break
+        if lines:
+            self.output.write('\n'.join(lines) + '\n')
+        if self.reached:
+            self.output.write("DELIMITER ;\nROLLBACK;\n")
+
+    def close(self):
+        try:
+            if self.rest and not self.reached:
+                self.output.write(self.rest)
+        finally:
+            self.output.close()
+
+
+class IndexedArchive:
+    """
+    Archive in which every file is compressed as a gzip member of its own, so the whole archive is still a valid
+    gzip file. The sidecar index holds one JSON line per entry with the offset and length of its member, its size,
+    sha256, mode and modification time. A single file is extracted by reading its member only.
+    """
+    DATA_EXTENSION = '.blocks.gz'
+    INDEX_EXTENSION = '.blocks.index'
+
+    def __init__(self, path):
+        self.dataPath = path + self.DATA_EXTENSION
+        self.indexPath = path + self.INDEX_EXTENSION
+
+    def create(self, level=6, throttle=None, openFile=None):
+        """
+        openFile(path) opens the data and index files, for writing in binary mode by default
+        """
+        openFile = openFile or (lambda path: open(path, 'wb'))
+        self.level = level
+        self.throttle = throttle
+        self.data = openFile(self.dataPath)
+        self.index = openFile(self.indexPath)
+
+    def add(self, path):
+        fileStat = os.lstat(path)
+        entry = {'path': path, 'mode': stat.S_IMODE(fileStat.st_mode), 'mtime': fileStat.st_mtime}
+        if stat.S_ISDIR(fileStat.st_mode):
+            entry['type'] = 'd'
+        elif stat.S_ISLNK(fileStat.st_mode):
+            entry['type'] = 'l'
+            entry['link'] = os.readlink(path)
+        elif stat.S_ISREG(fileStat.st_mode):
+            entry['type'] = 'f'
+            entry.update(self.addFile(path))
+        else:
+            #Sockets, devices...
+            return
+        self.index.write(json.dumps(entry) + '\n')
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+    def entries(self):
+        with open(self.indexPath, 'r') as index:
+            for line in index:
+                yield json.loads(line)
+
+    def extract(self, entry, target, folders=None):
+        """
+        Extracts an entry to target. The mode and modification time of a folder are applied at once, or appended to
+        folders for restoreFolders once the files under it are extracted: a read-only folder could not receive them,
+        and each of them would change its modification time.
+        """
+        targetFolder = os.path.dirname(target)
+        if targetFolder and not os.path.isdir(targetFolder):
+            os.makedirs(targetFolder)
+        if entry['type'] == 'd':
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            if folders is not None:
+                folders.append((target, entry))
+                return
+        elif entry['type'] == 'l':
+            if os.path.lexists(target):
+                os.remove(target)
+            os.symlink(entry['link'], target)
+            return
+        else:
+            with open(target, 'wb') as output:
+                self.readFile(entry, output)
+        os.chmod(target, entry['mode'])
+        os.utime(target, (entry['mtime'], entry['mtime']))
+
+    @staticmethod
+    def restoreFolders(folders):
+        """
+        Applies the modes and modification times of the folders deferred by extract, deepest first
+        """
+        for target, entry in sorted(folders, key=lambda folder: folder[0].rstrip(os.sep).count(os.sep), reverse=True):
+            os.chmod(target, entry['mode'])
+            os.utime(target, (entry['mtime'], entry['mtime']))
+
+    def addFile(self, path):
+        """
+        Stores the content of a file, returns what the index entry needs to read it back
+        """
+        offset = self.data.tell()
+        checksum = hashlib.sha256()
+        size = 0
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        with open(path, 'rb') as source:
+            while True:
+                chunk = source.read(ObibaBackup.CHUNK_SIZE)
+                if not chunk:
+                    break
+                if self.throttle:
+                    self.throttle.consume(len(chunk))
+                StageMetrics.count(len(chunk))
+                checksum.update(chunk)
+                size += len(chunk)
+                self.data.write(compressor.compress(chunk))
+        self.data.write(compressor.flush())
+        return {'offset': offset, 'length': self.data.tell() - offset, 'size': size, 'sha256': checksum.hexdigest()}
+
+    def readFile(self, entry, output):
+        """
+        Writes the content of a file entry to output
+        """
+        checksum = hashlib.sha256()
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        remaining = entry['length']
+        with open(self.dataPath, 'rb') as data:
+            data.seek(entry['offset'])
+            while remaining > 0:
+                chunk = data.read(min(remaining, ObibaBackup.CHUNK_SIZE))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                chunk = decompressor.decompress(chunk)
+                checksum.update(chunk)
+                output.write(chunk)
+            chunk = decompressor.flush()
+            checksum.update(chunk)
+            output.write(chunk)
+        if checksum.hexdigest() != entry['sha256']:
+            raise IOError("Checksum mismatch for %s" % entry['path'])
+
+
+class ChunkArchive(IndexedArchive):
+    """
+    Indexed archive whose files are cut by a ContentChunker and kept in a ChunkStore: the index lists the chunks of
+    every file instead of its place in a data file, so data already stored by any snapshot of any project takes no
+    space again. The index is the whole snapshot artifact.
+    """
+    INDEX_EXTENSION = '.chunks.index'
+
+    def __init__(self, path, store):
+        IndexedArchive.__init__(self, path)
+        self.store = store
+
+    def create(self, level=6, throttle=None, openFile=None):
+        openFile = openFile or (lambda path: open(path, 'wb'))
+        self.level = level
+        self.throttle = throttle
+        self.index = openFile(self.indexPath)
+
+    def close(self):
+        self.index.close()
+
+    def addFile(self, path):
+        writer = ChunkWriter(self.store, self.level)
+        with open(path, 'rb') as source:
+            while True:
+                chunk = source.read(ObibaBackup.CHUNK_SIZE)
+                if not chunk:
+                    break
+                if self.throttle:
+                    self.throttle.consume(len(chunk))
+                StageMetrics.count(len(chunk))
+                writer.write(chunk)
+        writer.close()
+        return writer.result()
+
+    def readFile(self, entry, output):
+        checksum = hashlib.sha256()
+        for chunk, size in entry['chunks']:
+            data = self.store.get(chunk)
+            checksum.update(data)
+            output.write(data)
+        if checksum.hexdigest() != entry['sha256']:
+            raise IOError("Checksum mismatch for %s" % entry['path'])
+
+    @staticmethod
+    def references(lines, complete=True):
+        """
+        Yields the chunks referenced by the lines of chunk indexes, once per reference. Unless complete, the lines
+        which cannot be read, being written, are skipped.
+        """
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError, e:
+                if complete:
+                    raise
+                continue
+            for chunk, size in entry.get('chunks', []):
+                yield chunk
+
+
+class ChunkWriter:
+    """
+    File object cutting what is written to it in chunks kept in a ChunkStore. Closing it with an output writes entry,
+    completed with the size, sha256 and chunks of the data, to output as a chunk index line and closes output.
+    """
+
+    def __init__(self, store, level=6, output=None, entry=None):
+        self.store = store
+        self.level = level
+        self.output = output
+        self.entry = entry
+        self.chunker = ContentChunker()
+        self.chunks = []
+        self.size = 0
+        self.checksum = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        self.checksum.update(data)
+        for chunk in self.chunker.split(data):
+            self.chunks.append([self.store.put(chunk, self.level), len(chunk)])
+
+    def close(self):
+        chunk = self.chunker.flush()
+        if chunk:
+            self.chunks.append([self.store.put(chunk, self.level), len(chunk)])
+        if self.output is not None:
+            try:
+                entry = dict(self.entry)
+                entry.update(self.result())
+                self.output.write(json.dumps(entry) + '\n')
+            finally:
+                self.output.close()
+
+    def result(self):
+        return {'size': self.size, 'sha256': self.checksum.hexdigest(), 'chunks': self.chunks}
+
+
+class ChunkStore:
+    """
+    Content-addressed store shared by the snapshots of every project: a chunk is kept once, as a gzip file named after
+    the sha256 of its content, under FOLDER of the destination. Chunks are written under a temporary name and renamed,
+    so units storing the same chunk at the same time do not get in each other's way.
+    """
+    FOLDER = 'chunk-store'
+
+    def __init__(self, root):
+        self.folder = os.path.join(root, self.FOLDER)
+
+    def path(self, chunk):
+        return os.path.join(self.folder, chunk[:2], chunk)
+
+    def put(self, chunk, level=6):
+        """
+        Stores a chunk unless it is already there, returns its name
+        """
+        name = hashlib.sha256(chunk).hexdigest()
+        path = self.path(name)
+        if os.path.exists(path):
+            return name
+        data = compressGzipMember(chunk, level)
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        handle, temporary = tempfile.mkstemp(suffix=AtomicFile.PART_EXTENSION, dir=folder)
+        with os.fdopen(handle, 'wb') as output:
+            output.write(data)
+        os.rename(temporary, path)
+        StageMetrics.count(written=len(data))
+        return name
+
+    def get(self, chunk):
+        with open(self.path(chunk), 'rb') as stored:
+            data = zlib.decompress(stored.read(), 16 + zlib.MAX_WBITS)
+        if hashlib.sha256(data).hexdigest() != chunk:
+            raise IOError("Chunk %s is corrupted" % chunk)
+        return data
+
+    @staticmethod
+    def find(path):
+        """
+        Returns the store of the destination a snapshot folder, local or copied from the remote server, belongs to
+        """
+        folder = os.path.abspath(path)
+        while True:
+            if os.path.isdir(os.path.join(folder, ChunkStore.FOLDER)):
+                return ChunkStore(folder)
+            if os.path.dirname(folder) == folder:
+                raise IOError("No %s found above %s" % (ChunkStore.FOLDER, path))
+            folder = os.path.dirname(folder)
+
+
+class SnapshotCatalog:
+    """
+    SQLite catalog of the snapshot folders with their project ('rsync' for the remote ones), timestamp, size and
+    status (running, complete or failed). The retention schedule is computed from it instead of walking the folders.
+    It also holds the binlog and oplog positions up to which the incremental databases were captured, and the journal
+    of the backup units of every snapshot, from which an interrupted run is resumed.
+    """
+    FILENAME = 'catalog.db'
+
+    def __init__(self, folder):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(folder, self.FILENAME), check_same_thread=False)
+        with self.lock:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS snapshots (path TEXT PRIMARY KEY, project TEXT NOT NULL, "
+                                    "timestamp TEXT NOT NULL, size INTEGER, status TEXT NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS snapshots_project ON snapshots (project, timestamp)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS positions (name TEXT PRIMARY KEY, position TEXT NOT NULL, "
+                                    "timestamp TEXT NOT NULL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS journal (snapshot TEXT NOT NULL, name TEXT NOT NULL, "
+                                    "state TEXT NOT NULL, size INTEGER, checksum TEXT, PRIMARY KEY (snapshot, name))")
+            self.connection.commit()
+
+    def add(self, project, path, timestamp, status='running'):
+        self.__execute("INSERT OR REPLACE INTO snapshots (path, project, timestamp, status) VALUES (?, ?, ?, ?)",
+                       (path, project, timestamp.strftime('%Y-%m-%d %H:%M:%S'), status))
+
+    def update(self, path, status, size=None):
+        if size is None:
+            self.__execute("UPDATE snapshots SET status = ? WHERE path = ?", (status, path))
+        else:
+            self.__execute("UPDATE snapshots SET status = ?, size = ? WHERE path = ?", (status, size, path))
+
+    def remove(self, paths):
+        self.__execute("DELETE FROM snapshots WHERE path = ?", [(path,) for path in paths], True)
+        self.__execute("DELETE FROM journal WHERE snapshot = ?", [(path,) for path in paths], True)
+
+    def record(self, snapshot, name, state, size=None, checksum=None):
+        """
+        Records the state of a backup unit of a snapshot in the journal
+        """
+        self.__execute("INSERT OR REPLACE INTO journal (snapshot, name, state, size, checksum) VALUES (?, ?, ?, ?, ?)",
+                       (snapshot, name, state, size, checksum))
+
+    def journal(self, snapshot):
+        with self.lock:
+            rows = self.connection.execute("SELECT name, state, size, checksum FROM journal WHERE snapshot = ?",
+                                           (snapshot,)).fetchall()
+        return dict((row[0], {'state': row[1], 'size': row[2], 'checksum': row[3]}) for row in rows)
+
+    def hasProject(self, project):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM snapshots WHERE project = ? LIMIT 1",
+                                           (project,)).fetchone() is not None
+
+    def snapshots(self, project):
+        with self.lock:
+            rows = self.connection.execute("SELECT path, timestamp, size, status FROM snapshots WHERE project = ? "
+                                           "ORDER BY timestamp, path", (project,)).fetchall()
+        return [{'path': row[0], 'timestamp': row[1], 'size': row[2], 'status': row[3]} for row in rows]
+
+    def position(self, name):
+        """
+        Returns the binlog or oplog position recorded for name, None if there is none
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT position FROM positions WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def setPosition(self, name, position):
+        if position is None:
+            self.__execute("DELETE FROM positions WHERE name = ?", (name,))
+        else:
+            self.__execute("INSERT OR REPLACE INTO positions (name, position, timestamp) VALUES (?, ?, ?)",
+                           (name, json.dumps(position, sort_keys=True), datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+    def __execute(self, statement, parameters, many=False):
+        with self.lock:
+            if many:
+                self.connection.executemany(statement, parameters)
+            else:
+                self.connection.execute(statement, parameters)
+            self.connection.commit()
+
+
+def expandPattern(pattern):
+    """
+    Returns the files matching a glob pattern, in which ** matches any number of folders. Every folder is listed once.
+    """
+    if not glob.has_magic(pattern):
+        return [pattern] if os.path.isfile(pattern) else []
+    parts = [part for part in pattern.split(os.sep) if part]
+    candidates = [os.sep if os.path.isabs(pattern) else os.curdir]
+    for index, part in enumerate(parts):
+        last = index == len(parts) - 1
+        matches = []
+        for folder in candidates:
+            if part == '**':
+                #The folder itself and everything under it, its files too when ** ends the pattern
+                for root, folders, files in os.walk(folder):
+                    matches.append(root)
+                    if last:
+                        matches += [os.path.join(root, name) for name in files]
+            elif not glob.has_magic(part):
+                matches.append(os.path.join(folder, part))
+            else:
+                try:
+                    names = os.listdir(folder)
+                except OSError, e:
+                    #Not a folder or not readable
+                    continue
+                if not part.startswith('.'):
+                    names = [name for name in names if not name.startswith('.')]
+                matches += [os.path.join(folder, name) for name in fnmatch.filter(names, part)]
+        candidates = matches
+    return sorted(path for path in set(candidates) if os.path.isfile(path))
+
+
+def verifyFiles(folder, entries, quick=False, ssh=None):
+    """
+    Checks (relative path, manifest entry) files of folder, locally or through the ssh command. Returns the list of
+    (problem, path) found and the number of files read. With quick, the files which kept their size and modification
+    time are not read.
+    """
+    paths = [os.path.join(folder, path) for path, entry in entries]
+    if ssh:
+        #GNU stat on the remote host, missing files are not listed
+        output = ''
+        if paths:
+            output = subprocess.Popen(remoteCommand(ssh, ["stat", "-c", "%s %Y %n", "--"] + paths),
+                                      stdout=subprocess.PIPE, stderr=open(os.devnull, 'w')).communicate()[0]
+        stats = dict((line.split(' ', 2)[2], (int(line.split(' ')[0]), int(line.split(' ')[1])))
+                     for line in output.splitlines())
+    else:
+        stats = {}
+        for path in paths:
+            if os.path.isfile(path):
+                fileStat = os.stat(path)
+                stats[path] = (fileStat.st_size, int(fileStat.st_mtime))
+
+    problems = []
+    toRead = []
+    for path, (relativePath, entry) in zip(paths, entries):
+        if path not in stats:
+            problems.append(('MISSING', path))
+        elif stats[path][0] != entry['size']:
+            problems.append(('SIZE', path))
+        elif not quick or stats[path][1] != int(entry['mtime']):
+            toRead.append((path, entry))
+
+    if ssh and toRead:
+        output = subprocess.Popen(remoteCommand(ssh, ["sha256sum", "--"] + [path for path, entry in toRead]),
+                                  stdout=subprocess.PIPE, stderr=open(os.devnull, 'w')).communicate()[0]
+        checksums = dict((line[66:], line[:64]) for line in output.splitlines())
+    else:
+        checksums = dict((path, fileChecksum(path)) for path, entry in toRead)
+    problems += [('CHECKSUM', path) for path, entry in toRead if checksums.get(path) != entry['sha256']]
+    return problems, len(toRead)
+
+
+def fileChecksum(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as fileToHash:
+        while True:
+            chunk = fileToHash.read(ObibaBackup.CHUNK_SIZE)
+            if not chunk:
+                break
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def sshCommand(pem=None):
+    return ["ssh", "-i", pem] if pem else ["ssh"]
+
+
+def remoteCommand(ssh, command):
+    # ssh joins its arguments into a single shell command line on the remote host
+    return ssh + [" ".join(pipes.quote(argument) for argument in command)]
+
+
+def snapshotTimestamp(snapshotFolder):
+    # yyyy-mm/dd-HH-MM-SS for projects, yyyy-mm/dd-HHMMSS for rsync, the modification time if neither
+    digits = re.sub(r'\D', '', os.path.basename(os.path.dirname(snapshotFolder)) + os.path.basename(snapshotFolder))
+    try:
+        return datetime.strptime(digits, '%Y%m%d%H%M%S')
+    except ValueError:
+        return datetime.fromtimestamp(os.path.getmtime(snapshotFolder))
+
+
+def deleteSnapshot(path):
+    """
+    Deletes a snapshot folder, printing what could not be deleted. Returns True if the folder is gone.
+    """
+    print "\tDeleting %s" % path
+
+    def reportError(function, failedPath, error):
+        print "\tCould not delete %s: %s" % (failedPath, error[1])
+    if os.path.exists(path):
+        shutil.rmtree(path, onerror=reportError)
+        if os.path.exists(path):
+            return False
+    #Remove the month folder with its last snapshot
+    try:
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+    return True
+
+
+class Transfer:
+    """
+    Uploads to the rsync destination from a background thread, so a project is sent while the next ones are still
+    being backed up. Uploads queued within BATCH_WAIT seconds of each other go in as few rsync sessions as possible,
+    at most sessions rsync running at the same time, and every ssh session to a remote destination goes through a
+    single multiplexed connection opened for the whole run.
+    """
+    BATCH_WAIT = 2
+
+    def __init__(self, destination, pem=None, multiplex=True, reportError=None, previous=None, seed='link',
+                 metrics=None, root=None, sessions=1):
+        self.destination = destination
+        self.sessions = max(1, int(sessions or 1))
+        self.root = root or destination
+        self.reportError = reportError
+        self.metrics = metrics or RunMetrics()
+        self.previous = previous
+        self.seed = seed
+        self.host = remoteHost(destination)
+        self.ssh = sshCommand(pem)
+        self.controlFolder = None
+        #The remote folder is created by the first session, an unreachable host only fails the uploads
+        self.prepared = not self.host
+        self.prepareLock = threading.Lock()
+        if self.host and multiplex:
+            self.controlFolder = tempfile.mkdtemp(prefix='obiba-backup-ssh-')
+            self.ssh += ["-o", "ControlPath=" + os.path.join(self.controlFolder, "%r@%h:%p")]
+            #-f returns once authenticated, the master then serves every following ssh and rsync
+            try:
+                if subprocess.call(self.ssh + ["-o", "ControlMaster=yes", "-o", "ControlPersist=yes", "-f", "-N",
+                                               self.host]) != 0:
+                    print "\tCould not open a shared ssh connection to %s, each rsync will connect" % self.host
+            except Exception, e:
+                self.__closeMaster()
+                raise
+
+        self.queue = Queue.Queue()
+        self.failures = []
+        self.uploader = threading.Thread(target=self.__upload)
+        self.uploader.daemon = True
+        self.uploader.start()
+
+    def upload(self, path, name, excludes=(), removeSourceFiles=False, done=None, throttle=None):
+        """
+        Queues the upload of path (file or folder) to destination/name, done is called once it is sent. With a
+        Throttle, rsync is limited to its rate, runs at its priority and waits while the server is busy.
+        """
+        self.queue.put({'path': path.rstrip(os.sep), 'name': name, 'excludes': list(excludes),
+                        'removeSourceFiles': removeSourceFiles, 'done': done, 'throttle': throttle, 'files': None})
+
+    def share(self, path, files, done=None, throttle=None):
+        """
+        Queues the upload of files, relative to the folder path, to the folder of the same name at the root of the
+        destination, shared by all the snapshots. The files already there are not sent again.
+        """
+        self.queue.put({'path': path.rstrip(os.sep), 'name': os.path.basename(path.rstrip(os.sep)), 'excludes': [],
+                        'removeSourceFiles': False, 'done': done, 'throttle': throttle, 'files': list(files)})
+
+    def wait(self):
+        """
+        Waits for the queued uploads and returns the names of the failed ones
+        """
+        self.queue.join()
+        return list(self.failures)
+
+    def remove(self, paths):
+        for path in paths:
+            print "\tDeleting %s" % path
+        subprocess.check_call(self.ssh + [self.host, "rm", "-rf"] + [self.__remotePath(path) for path in paths])
+
+    def close(self):
+        if self.uploader.is_alive():
+            self.queue.put(None)
+            self.uploader.join()
+        self.__closeMaster()
+
+    def __closeMaster(self):
+        if self.controlFolder:
+            subprocess.call(self.ssh + ["-O", "exit", self.host], stderr=open(os.devnull, 'w'))
+            shutil.rmtree(self.controlFolder, ignore_errors=True)
+            self.controlFolder = None
+
+    def __prepare(self):
+        """
+        Creates the destination folder on the remote host, once
+        """
+        with self.prepareLock:
+            if not self.prepared:
+                subprocess.check_call(self.ssh + [self.host, "mkdir", "-p", self.__remotePath(self.destination)])
+                self.prepared = True
+
+    def __upload(self):
+        #The sessions run on a pool, the next uploads are gathered meanwhile
+        pool = ThreadPool(self.sessions)
+        sent = 0
+        try:
+            while True:
+                batch = [self.queue.get()]
+                #Gather the uploads queued right after this one
+                while batch[-1] is not None:
+                    try:
+                        batch.append(self.queue.get(timeout=self.BATCH_WAIT))
+                    except Queue.Empty:
+                        break
+                for session in self.__sessions([item for item in batch if item is not None]):
+                    sent += 1
+                    pool.apply_async(self.__send, (session, sent))
+                if batch[-1] is None:
+                    self.queue.task_done()
+                    return
+        finally:
+            pool.close()
+            pool.join()
+
+    def __send(self, session, index):
+        try:
+            self.__prepare()
+            #Sources of the same name, or shares of the chunk store, are told apart by the session number
+            name = "%s (session %d)" % (', '.join(item['name'] for item in session), index)
+            with self.metrics.measure('rsync', name):
+                self.__rsync(session)
+            for item in session:
+                if item['done']:
+                    item['done']()
+        except Exception, e:
+            if self.reportError:
+                self.reportError("upload of %s" % ', '.join(item['path'] for item in session))
+            self.failures.extend("upload %s" % item['name'] for item in session)
+        finally:
+            for item in session:
+                self.queue.task_done()
+
+    def __sessions(self, batch):
+        # Items keeping their own name (destination/basename) share a session, the renamed ones go on their own
+        sessions = []
+        shared = {}
+        for item in batch:
+            session = shared.setdefault((item['removeSourceFiles'], item['throttle']), [])
+            if item['name'] != os.path.basename(item['path']) or item['files'] is not None or \
+                    item['name'] in [other['name'] for other in session]:
+                sessions.append([item])
+            else:
+                session.append(item)
+        return sessions + [session for session in shared.values() if session]
+
+    def __rsync(self, session):
+        throttle = session[0]['throttle']
+        command = []
+        if throttle:
+            throttle.wait()
+            command += throttle.priority
+        #An interrupted transfer leaves its partial files aside, the next run resumes them
+        command += ["rsync", "-Atrav", "--partial-dir=.rsync-partial"]
+        if throttle and throttle.rate:
+            command.append("--bwlimit=%d" % max(1, throttle.rate / 1024))
+        if self.host:
+            command += ["-e", " ".join(self.ssh)]
+        if session[0]['removeSourceFiles']:
+            command.append("--remove-source-files")
+        if self.previous and not self.host:
+            #rsync skips the delta algorithm between local paths unless told otherwise
+            command.append("--no-whole-file")
+
+        fileList = None
+        if session[0]['files'] is not None:
+            #Listed files only, anything already at the root is left as it is
+            item = session[0]
+            fileList = tempfile.NamedTemporaryFile(prefix='obiba-backup-files-')
+            fileList.write(''.join(path + '\n' for path in item['files']))
+            fileList.flush()
+            command += ["--files-from=" + fileList.name, "--ignore-existing"]
+            command += [os.path.join(item['path'], ''), os.path.join(self.root, item['name'], '')]
+        elif len(session) == 1 and session[0]['name'] != os.path.basename(session[0]['path']):
+            item = session[0]
+            command += self.__seedOptions(item['name'])
+            command += ["--exclude=%s" % exclude for exclude in item['excludes']]
+            command += [os.path.join(item['path'], ''), os.path.join(self.destination, item['name'], '')]
+        else:
+            command += self.__seedOptions()
+            # Without the trailing slash each source lands in destination/basename, anchored excludes are
+            # relative to that basename
+            for item in session:
+                for exclude in item['excludes']:
+                    name = os.path.basename(item['path'])
+                    if exclude.startswith(os.sep):
+                        command.append("--exclude=/%s%s" % (name, exclude))
+                    else:
+                        command += ["--exclude=/%s/%s" % (name, exclude), "--exclude=/%s/**/%s" % (name, exclude)]
+            command += [item['path'] for item in session] + [os.path.join(self.destination, '')]
+
+        print "Backing up %s to remote server %s...\n%s" % (', '.join(item['path'] for item in session),
+                                                           self.destination, ' '.join(command))
+        try:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE)
+            output = process.stdout.read()
+            process.stdout.close()
+            if waitProcess(process) != 0:
+                raise subprocess.CalledProcessError(process.returncode, "rsync")
+        finally:
+            if fileList:
+                fileList.close()
+        print output
+        #rsync -v ends with the bytes it sent and the size of what it was given
+        sent = re.search(r'^sent ([\d,]+) bytes', output, re.MULTILINE)
+        total = re.search(r'total size is ([\d,]+)', output)
+        StageMetrics.count(int(total.group(1).replace(',', '')) if total else 0,
+                           int(sent.group(1).replace(',', '')) if sent else 0)
+
+    def __seedOptions(self, name=None):
+        # Unchanged files are linked (or copied) from the previous snapshot, the changed ones use it as delta basis
+        if not self.previous:
+            return []
+        previous = self.__remotePath(self.previous)
+        if name:
+            previous = os.path.join(previous, name)
+        return ["--%s-dest=%s" % (self.seed, previous)]
+
+    def __remotePath(self, destination):
+        return destination.split(':', 1)[1] if self.host else destination
+
+
+def remoteHost(destination):
+    # [user@]host:path is reached through ssh, rsync:// urls and local paths are not
+    match = re.match(r'^([^/:]+):', destination)
+    if match and not destination.startswith('rsync://'):
+        return match.group(1)
+    return None
+
+
+class ContentChunker:
+    """
+    Cuts a stream into chunks whose boundaries depend on the content only, so an insertion or a deletion moves the
+    boundaries around it and nowhere else.
+
+    Every byte is mapped to a bit by a fixed table (str.translate) and each occurrence of PATTERN in these bits is a
+    candidate boundary, kept when the crc32 of the WINDOW bytes before it matches MASK. A chunk ends at the first
+    boundary at least MIN_CHUNK bytes into it, or at MAX_CHUNK. The two steps keep the search in C and the chunks
+    around 256KB for dumps with a skewed alphabet as well as for binary data.
+    """
+    MIN_CHUNK = 64 * 1024
+    MAX_CHUNK = 8 * 1024 * 1024
+    PATTERN = '01101001'
+    WINDOW = 64
+    MASK = 0x3ff
+    BITS = string.maketrans(''.join(chr(byte) for byte in range(256)),
+                            ''.join('01'[(byte * 2654435761 >> 13) & 1] for byte in range(256)))
+
+    def __init__(self):
+        self.buffer = ''
+        self.scanned = 0
+
+    def split(self, data):
+        """
+        Returns the chunks completed by data, the rest is kept for the next call
+        """
+        self.buffer += data
+        chunks = []
+        while len(self.buffer) >= self.MIN_CHUNK:
+            end = self.__boundary()
+            if end is None:
+                if len(self.buffer) < self.MAX_CHUNK:
+                    break
+                end = self.MAX_CHUNK
+            chunks.append(self.buffer[:end])
+            self.buffer = self.buffer[end:]
+            self.scanned = 0
+        return chunks
+
+    def flush(self):
+        chunk = self.buffer
+        self.buffer = ''
+        self.scanned = 0
+        return chunk
+
+    def __boundary(self):
+        start = max(self.scanned, self.MIN_CHUNK - len(self.PATTERN))
+        bits = self.buffer[start:self.MAX_CHUNK].translate(self.BITS)
+        found = bits.find(self.PATTERN)
+        while found >= 0:
+            end = start + found + len(self.PATTERN)
+            if zlib.crc32(self.buffer[end - self.WINDOW:end]) & self.MASK == 0:
+                return end
+            found = bits.find(self.PATTERN, found + 1)
+        #Resume after what was searched, the pattern may still straddle the end of the buffer
+        self.scanned = start + max(0, len(bits) - len(self.PATTERN) + 1)
+        return None
+
+
+class AesGcm:
+    """
+    AES-256-GCM of the OpenSSL library (libcrypto) called through ctypes, to encrypt and authenticate small pieces of
+    data in-process. The library is loaded on first use.
+    """
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+    GET_TAG = 0x10
+    SET_TAG = 0x11
+    library = None
+
+    def __init__(self, key):
+        self.key = key
+        self.library = AesGcm.load()
+
+    @classmethod
+    def load(cls):
+        if cls.library is None:
+            name = ctypes.util.find_library('crypto')
+            if not name:
+                raise IOError("The OpenSSL library (libcrypto) is required to encrypt in delta mode")
+            library = ctypes.CDLL(name)
+            library.EVP_CIPHER_CTX_new.restype = ctypes.c_void_p
+            library.EVP_CIPHER_CTX_free.argtypes = [ctypes.c_void_p]
+            library.EVP_aes_256_gcm.restype = ctypes.c_void_p
+            library.EVP_CIPHER_CTX_ctrl.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_char_p]
+            for step in ['Encrypt', 'Decrypt']:
+                getattr(library, 'EVP_%sInit_ex' % step).argtypes = [ctypes.c_void_p, ctypes.c_void_p,
+                                                                     ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+                getattr(library, 'EVP_%sUpdate' % step).argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+                                                                    ctypes.POINTER(ctypes.c_int), ctypes.c_char_p,
+                                                                    ctypes.c_int]
+                getattr(library, 'EVP_%sFinal_ex' % step).argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+                                                                      ctypes.POINTER(ctypes.c_int)]
+            cls.library = library
+        return cls.library
+
+    def encrypt(self, nonce, data):
+        """
+        Returns the tag and the encrypted data
+        """
+        tag = ctypes.create_string_buffer(self.TAG_SIZE)
+        encrypted = self.__run('Encrypt', nonce, data, tag)
+        if encrypted is None:
+            raise IOError("AES-GCM encryption failed")
+        return tag.raw, encrypted
+
+    def decrypt(self, nonce, tag, data):
+        """
+        Returns the decrypted data, None if it does not match the tag
+        """
+        return self.__run('Decrypt', nonce, data, tag)
+
+    def __run(self, step, nonce, data, tag):
+        library = self.library
+        context = library.EVP_CIPHER_CTX_new()
+        if not context:
+            raise MemoryError()
+        try:
+            output = ctypes.create_string_buffer(max(len(data), 1))
+            length = ctypes.c_int()
+            final = ctypes.c_int()
+            if getattr(library, 'EVP_%sInit_ex' % step)(context, library.EVP_aes_256_gcm(), None, self.key,
+                                                         nonce) != 1:
+                return None
+            if getattr(library, 'EVP_%sUpdate' % step)(context, output, ctypes.byref(length), data, len(data)) != 1:
+                return None
+            if step == 'Decrypt' and library.EVP_CIPHER_CTX_ctrl(context, self.SET_TAG, self.TAG_SIZE, tag) != 1:
+                return None
+            #The tag is checked by the final step when decrypting
+            if getattr(library, 'EVP_%sFinal_ex' % step)(context, output, ctypes.byref(final)) != 1:
+                return None
+            if step == 'Encrypt' and library.EVP_CIPHER_CTX_ctrl(context, self.GET_TAG, self.TAG_SIZE, tag) != 1:
+                return None
+            return output.raw[:length.value]
+        finally:
+            library.EVP_CIPHER_CTX_free(context)
+
+
+class ChunkEncryptStage:
+    """
+    File object encrypting what is written to it chunk by chunk, so that unchanged regions of the data give the same
+    encrypted bytes from one day to the next and rsync only sends the changed chunks.
+
+    The chunks are cut by a ContentChunker and encrypted in-process with AES-256-GCM, see AesGcm. The keys are derived
+    once from the password and the salt by PBKDF2, the nonce of a chunk is a HMAC of its content: the same chunk
+    encrypts to the same bytes and every chunk is authenticated. The file starts with MAGIC and the salt, then a chunk
+    is stored as its 8 byte encrypted length, the nonce, the tag and the encrypted bytes.
+    """
+    EXTENSION = '.enc'
+    MAGIC = 'OBENCGCM'
+    SALT_SIZE = 16
+    ITERATIONS = 100000
+    keys = {}
+
+    def __init__(self, output, password, salt=None):
+        """
+        The same salt must be given every day for the chunks to be reused, a random one is used by default
+        """
+        self.output = output
+        self.salt = salt or os.urandom(self.SALT_SIZE)
+        self.cipher, self.nonceKey = self.deriveKeys(password, self.salt)
+        self.chunker = ContentChunker()
+        self.output.write(self.MAGIC + self.salt)
+
+    def write(self, data):
+        for chunk in self.chunker.split(data):
+            self.__encrypt(chunk)
+
+    def close(self):
+        try:
+            chunk = self.chunker.flush()
+            if chunk:
+                self.__encrypt(chunk)
+        finally:
+            self.output.close()
+
+    def __encrypt(self, chunk):
+        nonce = hmac.new(self.nonceKey, chunk, hashlib.sha256).digest()[:AesGcm.NONCE_SIZE]
+        tag, encrypted = self.cipher.encrypt(nonce, chunk)
+        self.output.write(struct.pack('>Q', len(encrypted)) + nonce + tag + encrypted)
+
+    @classmethod
+    def deriveKeys(cls, password, salt):
+        """
+        Returns the cipher and the nonce key of password and salt, derived once per process
+        """
+        if (password, salt) not in cls.keys:
+            keys = hashlib.pbkdf2_hmac('sha256', password, salt, cls.ITERATIONS, 64)
+            cls.keys[(password, salt)] = (AesGcm(keys[:32]), keys[32:])
+        return cls.keys[(password, salt)]
+
+    @staticmethod
+    def decrypt(encrypted, output, password):
+        """
+        Writes the decrypted chunks to output, each chunk being verified before it is written
+        """
+        header = encrypted.read(len(ChunkEncryptStage.MAGIC) + ChunkEncryptStage.SALT_SIZE)
+        if len(header) != len(ChunkEncryptStage.MAGIC) + ChunkEncryptStage.SALT_SIZE or \
+                not header.startswith(ChunkEncryptStage.MAGIC):
+            raise IOError("Not a file encrypted in delta mode")
+        cipher, nonceKey = ChunkEncryptStage.deriveKeys(password, header[len(ChunkEncryptStage.MAGIC):])
+        recordHeader = 8 + AesGcm.NONCE_SIZE + AesGcm.TAG_SIZE
+        index = 0
+        while True:
+            header = encrypted.read(recordHeader)
+            if not header:
+                break
+            chunk = None
+            if len(header) == recordHeader:
+                length = struct.unpack('>Q', header[:8])[0]
+                data = encrypted.read(length)
+                if len(data) == length:
+                    chunk = cipher.decrypt(header[8:8 + AesGcm.NONCE_SIZE], header[8 + AesGcm.NONCE_SIZE:], data)
+            if chunk is None:
+                raise IOError("Chunk %d is truncated or corrupted, or the password is wrong" % index)
+            output.write(chunk)
+            index += 1
+
+
+COMPRESSION_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst', 'lz4': '.lz4'}
 
 
 ####################################################################################################################
@@ -430,4 +3842,52 @@ class ObibaBackup:
 ####################################################################################################################
 
 if __name__ == "__main__":
-    ObibaBackup().run()
+    parser = argparse.ArgumentParser(description="Backs up Obiba products as specified in backup.conf")
+    commands = parser.add_subparsers(dest='command')
+    runParser = commands.add_parser('run', help="run the backup (default)")
+    runParser.add_argument('--resume', action='store_true', help="resume the interrupted run, skipping what it did")
+    decryptParser = commands.add_parser('decrypt', help="decrypt a file encrypted by the backup (.gpg or .enc)")
+    decryptParser.add_argument('file')
+    decryptParser.add_argument('output')
+    restoreDumpParser = commands.add_parser('restore-dump', help="load a database dumped in parallel back")
+    restoreDumpParser.add_argument('manifest', help="manifest of the dump, e.g. .../12-00-00-01/live_mica.manifest.json")
+    restoreDumpParser.add_argument('--database', help="database to load into, the dumped one by default")
+    restoreDumpParser.add_argument('--jobs', type=int, default=4, help="tables or collections loaded at the same time")
+    replayParser = commands.add_parser('replay', help="restore an incremental database as it was at a point in time")
+    replayParser.add_argument('project')
+    replayParser.add_argument('database')
+    replayParser.add_argument('until', help="YYYY-MM-DD HH:MM:SS")
+    replayParser.add_argument('--database', dest='target', help="database to load into, the dumped one by default")
+    replayParser.add_argument('--jobs', type=int, default=4, help="tables or collections loaded at the same time")
+    verifyParser = commands.add_parser('verify', help="check snapshots against their checksums")
+    verifyParser.add_argument('snapshots', nargs='*', help="snapshot folders, local or remote, the latest ones of "
+                                                          "the projects by default")
+    verifyParser.add_argument('--remote', action='store_true', help="also check the latest remote snapshot")
+    verifyParser.add_argument('--quick', action='store_true', help="only read the files whose size or modification "
+                                                                  "time changed")
+    verifyParser.add_argument('--jobs', type=int, default=4, help="files checked at the same time")
+    cleanupParser = commands.add_parser('cleanup', help="apply the retention schedule without backing up")
+    cleanupParser.add_argument('--dry-run', action='store_true', help="only print the snapshots to delete")
+    restoreParser = commands.add_parser('restore', help="list or extract the content of a snapshot indexed archives")
+    restoreParser.add_argument('snapshot', help="snapshot folder, e.g. /obiba/backups/mica/2017-05/12-00-00-01")
+    restoreParser.add_argument('path', nargs='?', help="file or folder to extract, lists the snapshot when omitted")
+    restoreParser.add_argument('--target', default='.', help="folder to extract to")
+    args = parser.parse_args(sys.argv[1:] or ['run'])
+
+    if args.command == 'restore':
+        ObibaBackup().restore(args.snapshot, args.path, args.target)
+    elif args.command == 'cleanup':
+        ObibaBackup().cleanup(args.dry_run)
+    elif args.command == 'restore-dump':
+        ObibaBackup().restoreDump(args.manifest, args.database, args.jobs)
+    elif args.command == 'replay':
+        ObibaBackup().replay(args.project, args.database, args.until, args.target, args.jobs)
+    elif args.command == 'decrypt':
+        try:
+            ObibaBackup().decrypt(args.file, args.output)
+        except (ValueError, IOError, subprocess.CalledProcessError), e:
+            sys.exit("Cannot decrypt %s: %s" % (args.file, e))
+    elif args.command == 'verify':
+        sys.exit(1 if ObibaBackup().verify(args.snapshots, args.remote, args.quick, args.jobs) else 0)
+    else:
+        ObibaBackup().run(args.resume)
@@ -1,6 +1,44 @@
+__author__ = 'maelstrom'
+import os
+import sys
+import subprocess
+import StringIO
+import gzip
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import time
 import unittest
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
 import yaml
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'main', 'python'))
+from backup import ObibaBackup
+from backup import Scheduler
+from backup import GzipStage
+from backup import IndexedArchive
+from backup import ChunkArchive
+from backup import ChunkStore
+from backup import RunLock
+from backup import Transfer
+from backup import ContentChunker
+from backup import GpgStage
+from backup import ChunkEncryptStage
+from backup import TableSplitter
+from backup import BinlogUntil
+from backup import AtomicFile
+from backup import Throttle
+from backup import parseSize
+from backup import RunMetrics
+from backup import StageMetrics
+from backup import expandPattern
+from backup import verifyFiles
+from backup import fileChecksum
+
 
 class BackupTest(unittest.TestCase):
     @classmethod
@@ -12,6 +50,713 @@ class BackupTest(unittest.TestCase):
         config = yaml.load(stream)
         print config['projects']
 
+    def testStreamCommand(self):
+        output = StringIO.StringIO()
+        command = ["sh", "-c", "echo warning >&2; head -c 3000000 /dev/zero"]
+        ObibaBackup()._ObibaBackup__streamCommand(command, output)
+        self.assertEqual(len(output.getvalue()), 3000000)
+        self.assertNotIn("warning", output.getvalue())
+
+    def testStreamCommandFailure(self):
+        command = ["sh", "-c", "exit 2"]
+        self.assertRaises(subprocess.CalledProcessError,
+                          ObibaBackup()._ObibaBackup__streamCommand, command, StringIO.StringIO())
+
+    def testDumpArtifactKeepsWarnings(self):
+        folder = tempfile.mkdtemp()
+        try:
+            backup = ObibaBackup()
+            backup.config = {}
+            backup._ObibaBackup__createScheduler()
+            compression = {'codec': 'gzip', 'level': 6, 'threads': 1}
+            changed = os.path.join(folder, 'changed.tar.gz')
+            backup._ObibaBackup__dumpArtifact(["sh", "-c", "echo data; exit 1"], changed, compression, (1,))
+            self.assertTrue(os.path.exists(changed))
+            failed = os.path.join(folder, 'failed.tar.gz')
+            self.assertRaises(subprocess.CalledProcessError, backup._ObibaBackup__dumpArtifact,
+                              ["sh", "-c", "echo data; exit 2"], failed, compression, (1,))
+            self.assertEqual(os.listdir(folder), ['changed.tar.gz'])
+        finally:
+            shutil.rmtree(folder)
+
+    def testCompressMongoDumpFolder(self):
+        folder = tempfile.mkdtemp()
+        try:
+            backup = ObibaBackup()
+            backup.config = {}
+            backup._ObibaBackup__createScheduler()
+            os.makedirs(os.path.join(folder, 'mica'))
+            with open(os.path.join(folder, 'mica', 'variable.bson'), 'wb') as dump:
+                dump.write('bson' * 1000)
+            backup._ObibaBackup__compressFolder(folder, {'codec': 'gzip', 'level': 6, 'threads': 1,
+                                                         'extension': '.gz'})
+            self.assertEqual(os.listdir(os.path.join(folder, 'mica')), ['variable.bson.gz'])
+            self.assertEqual(gzip.open(os.path.join(folder, 'mica', 'variable.bson.gz')).read(), 'bson' * 1000)
+        finally:
+            shutil.rmtree(folder)
+
+    def testResumedMongoDumpFolderIsCompressedOnce(self):
+        folder = tempfile.mkdtemp()
+        path = os.environ['PATH']
+        try:
+            with open(os.path.join(folder, 'mongodump'), 'w') as stub:
+                stub.write('#!/bin/sh\nfor arg; do case "$arg" in --out=*) out="${arg#--out=}";; esac; done\n'
+                           'mkdir -p "$out/mica"\necho bson > "$out/mica/variable.bson"\n')
+            os.chmod(os.path.join(folder, 'mongodump'), 0755)
+            os.environ['PATH'] = folder + os.pathsep + path
+            backup = ObibaBackup()
+            backup.config = {}
+            backup._ObibaBackup__createScheduler()
+            destination = os.path.join(folder, 'snapshot')
+            compression = {'codec': 'gzip', 'level': 6, 'threads': 1, 'extension': '.gz'}
+            #The second dump resumes the first one, whose compressed files are still there
+            for attempt in range(2):
+                backup._ObibaBackup__backupMongodb('mica', 'mongodump ', '--out=' + destination, compression)
+            dumpFolder = os.path.join(destination, 'mica', 'mica')
+            self.assertEqual(os.listdir(dumpFolder), ['variable.bson.gz'])
+            self.assertEqual(gzip.open(os.path.join(dumpFolder, 'variable.bson.gz')).read(), 'bson\n')
+
+            #A failed dump names mongodump only, not its password
+            with open(os.path.join(folder, 'mongodump'), 'w') as stub:
+                stub.write('#!/bin/sh\nexit 1\n')
+            try:
+                backup._ObibaBackup__backupMongodb('mica', 'mongodump --password s3cret ', '--out=' + destination,
+                                                   compression)
+                self.fail('mongodump failure not raised')
+            except subprocess.CalledProcessError, e:
+                self.assertEqual(e.cmd, 'mongodump')
+        finally:
+            os.environ['PATH'] = path
+            shutil.rmtree(folder)
+
+    def testSchedulerLimitsAndDependencies(self):
+        lock = threading.Lock()
+        running = {'count': 0, 'peak': 0}
+        finished = []
+
+        def dump(name):
+            with lock:
+                running['count'] += 1
+                running['peak'] = max(running['peak'], running['count'])
+            time.sleep(0.02)
+            with lock:
+                running['count'] -= 1
+                finished.append(name)
+            if name == 'db2':
+                raise ValueError(name)
+
+        scheduler = Scheduler(4, {'mysqldump': 2}, lambda unit: None)
+        dumps = [scheduler.submit('db%d' % i, ('mysqldump', 'localhost'), dump, ('db%d' % i,)) for i in range(5)]
+        scheduler.submit('upload', ('rsync', None), finished.append, ('upload',), dumps)
+        self.assertEqual(scheduler.wait(), ['db2'])
+        self.assertEqual(running['peak'], 2)
+        self.assertEqual(finished[-1], 'upload')
+
+    def testSchedulerReserve(self):
+        started = []
+
+        def dump(name):
+            started.append(name)
+            if name == 'db0':
+                self.assertEqual(scheduler.reserve(('mysqldump', 'localhost'), 4), 2)
+                time.sleep(0.05)
+                self.assertEqual(started, ['db0'])
+                scheduler.release(('mysqldump', 'localhost'), 2)
+
+        scheduler = Scheduler(2, {'mysqldump': 3}, lambda unit: None)
+        scheduler.submit('db0', ('mysqldump', 'localhost'), dump, ('db0',))
+        time.sleep(0.01)
+        scheduler.submit('db1', ('mysqldump', 'localhost'), dump, ('db1',))
+        self.assertEqual(scheduler.wait(), [])
+        self.assertEqual(started, ['db0', 'db1'])
+
+    def testTableSplitterStartsBeforeTheDumpEnds(self):
+        splitter = TableSplitter(lambda table: StringIO.StringIO(), threading.Event())
+        command = ["sh", "-c", "echo '-- Table structure for table `t`'; sleep 2; echo 'INSERT'"]
+        dump = threading.Thread(target=ObibaBackup()._ObibaBackup__streamCommand, args=(command, splitter))
+        dump.start()
+        try:
+            self.assertTrue(splitter.started.wait(1))
+        finally:
+            dump.join()
+
+    def testParallelGzipStage(self):
+        data = ''.join(str(i) for i in range(500000))
+        output = StringIO.StringIO()
+        output.close = lambda: None
+        stage = GzipStage(output, 6, 3)
+        for i in range(0, len(data), 100000):
+            stage.write(data[i:i + 100000])
+        stage.close()
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(output.getvalue())).read(), data)
+
+    def testContentChunkerResynchronises(self):
+        lines = ["INSERT INTO t VALUES (%d,'%s');\n" % (i, hex(i * 7919)) for i in range(150000)]
+        changed = list(lines)
+        changed[1000] = "INSERT INTO t VALUES (1000,'changed');\n"
+
+        def chunks(lines):
+            chunker = ContentChunker()
+            result = chunker.split(''.join(lines))
+            return result + [chunker.flush()]
+        original = chunks(lines)
+        modified = chunks(changed)
+        self.assertEqual(''.join(original), ''.join(lines))
+        self.assertTrue(len(original) > 2)
+        self.assertNotEqual(original[0], modified[0])
+        self.assertEqual(original[1:], modified[1:])
+
+    def testGpgStageRoundTrip(self):
+        folder = tempfile.mkdtemp()
+        try:
+            encryptedFile = os.path.join(folder, 'dump.sql.gz.gpg')
+            stage = GzipStage(GpgStage(open(encryptedFile, 'wb'), 's3cret'))
+            stage.write('INSERT INTO t VALUES (1);\n' * 10000)
+            stage.close()
+            with open(encryptedFile, 'rb') as encrypted:
+                decrypted = tempfile.TemporaryFile()
+                GpgStage.decrypt(encrypted, decrypted, 's3cret')
+            decrypted.seek(0)
+            self.assertEqual(gzip.GzipFile(fileobj=decrypted, mode='rb').read(), 'INSERT INTO t VALUES (1);\n' * 10000)
+        finally:
+            shutil.rmtree(folder)
+
+    def testAtomicFile(self):
+        folder = tempfile.mkdtemp()
+        try:
+            written = []
+            path = os.path.join(folder, 'dump.sql.gz')
+            artifact = AtomicFile(path, lambda *args: written.append(args))
+            artifact.write('INSERT INTO t VALUES (1);\n')
+            self.assertEqual(os.listdir(folder), ['dump.sql.gz' + AtomicFile.PART_EXTENSION])
+            artifact.close()
+            self.assertEqual(os.listdir(folder), ['dump.sql.gz'])
+            self.assertEqual(written[0][:2], (path, 26))
+
+            aborted = AtomicFile(os.path.join(folder, 'other.sql.gz'))
+            aborted.write('partial')
+            aborted.abort()
+            aborted.close()
+            self.assertEqual(os.listdir(folder), ['dump.sql.gz'])
+        finally:
+            shutil.rmtree(folder)
+
+    def testThrottle(self):
+        self.assertEqual(parseSize('20M'), 20 * 1024 * 1024)
+        self.assertEqual(parseSize('512k'), 512 * 1024)
+        self.assertEqual(parseSize(1000), 1000)
+
+        throttle = Throttle(1024 * 1024)
+        started = time.time()
+        for i in range(4):
+            throttle.consume(128 * 1024)
+        self.assertTrue(time.time() - started >= 0.45)
+
+        checks = []
+        busy = Throttle(busy=lambda: len(checks) < 2 and not checks.append(1))
+        busy.CHECK_INTERVAL = 0.01
+        busy.wait()
+        self.assertEqual(len(checks), 2)
+
+    def testRunMetrics(self):
+        metrics = RunMetrics()
+        with metrics.measure('tar', 'mica folder /var/www', 'mica'):
+            StageMetrics.count(4000, 1000)
+            with metrics.measure('encrypt', '/var/www'):
+                StageMetrics.count(1000, 1000)
+        report = metrics.report([])
+        self.assertEqual(report['status'], 'complete')
+        self.assertEqual([stage['ratio'] for stage in report['stages']], [4.0, 1.0])
+
+        folder = tempfile.mkdtemp()
+        try:
+            metrics.writePrometheus(os.path.join(folder, 'backup.prom'), report)
+            with open(os.path.join(folder, 'backup.prom')) as prometheus:
+                lines = prometheus.read().splitlines()
+            self.assertTrue('obiba_backup_stage_read_bytes{stage="tar",project="mica",name="mica folder /var/www"} 4000'
+                            in lines)
+        finally:
+            shutil.rmtree(folder)
+
+    def testExpandPattern(self):
+        folder = tempfile.mkdtemp()
+        try:
+            for path in ['a.csv', 'b.txt', '.hidden.csv', 'x/c.csv', 'x/y/d.csv']:
+                if not os.path.isdir(os.path.dirname(os.path.join(folder, path))):
+                    os.makedirs(os.path.dirname(os.path.join(folder, path)))
+                open(os.path.join(folder, path), 'w').close()
+            relative = lambda pattern: [os.path.relpath(path, folder)
+                                        for path in expandPattern(os.path.join(folder, pattern))]
+            self.assertEqual(relative('*.csv'), ['a.csv'])
+            self.assertEqual(relative('**/*.csv'), ['a.csv', 'x/c.csv', 'x/y/d.csv'])
+            self.assertEqual(relative('x/**'), ['x/c.csv', 'x/y/d.csv'])
+            self.assertEqual(relative('b.txt'), ['b.txt'])
+        finally:
+            shutil.rmtree(folder)
+
+    def testVerifyFiles(self):
+        folder = tempfile.mkdtemp()
+        try:
+            entries = []
+            for name in ['a.sql.gz', 'b.sql.gz', 'c.sql.gz']:
+                path = os.path.join(folder, name)
+                with open(path, 'wb') as artifact:
+                    artifact.write(name * 100)
+                entries.append((name, {'size': 800, 'mtime': os.stat(path).st_mtime, 'sha256': fileChecksum(path)}))
+            self.assertEqual(verifyFiles(folder, entries), ([], 3))
+
+            with open(os.path.join(folder, 'a.sql.gz'), 'r+b') as artifact:
+                artifact.write('x')
+            os.utime(os.path.join(folder, 'a.sql.gz'), (0, int(entries[0][1]['mtime'])))
+            os.remove(os.path.join(folder, 'b.sql.gz'))
+            self.assertEqual(verifyFiles(folder, entries, True), ([('MISSING', os.path.join(folder, 'b.sql.gz'))], 0))
+            self.assertEqual(verifyFiles(folder, entries)[0], [('MISSING', os.path.join(folder, 'b.sql.gz')),
+                                                               ('CHECKSUM', os.path.join(folder, 'a.sql.gz'))])
+        finally:
+            shutil.rmtree(folder)
+
+    def testTableSplitter(self):
+        outputs = {}
+
+        def openTable(name):
+            outputs[name] = StringIO.StringIO()
+            outputs[name].close = lambda: None
+            return outputs[name]
+        splitter = TableSplitter(openTable, threading.Event())
+        dump = "SET NAMES utf8;\n--\n-- Table structure for table `a`\n--\nINSERT INTO `a` VALUES (1);\n" \
+               "--\n-- Table structure for table `b``c`\n--\nINSERT INTO `b``c` VALUES (2);\n"
+        splitter.write(dump[:40])
+        self.assertFalse(splitter.started.is_set())
+        splitter.write(dump[40:])
+        splitter.close()
+        self.assertTrue(splitter.started.is_set())
+        self.assertEqual(splitter.tables, ['a', 'b`c'])
+        self.assertTrue(outputs['b`c'].getvalue().startswith("SET NAMES utf8;\n--\n-- Table structure for table `b``c`"))
+        self.assertTrue(outputs['a'].getvalue().endswith("INSERT INTO `a` VALUES (1);\n--\n"))
+
+    def testBinlogUntil(self):
+        output = StringIO.StringIO()
+        output.close = lambda: None
+        events = BinlogUntil(output, datetime(2017, 5, 12, 11, 0, 0))
+        events.write("DELIMITER /*!*/;\n# at 154\n#170512 10:00:00 server id 1  end_log_pos 219\nBEGIN\n/*!*/;\n"
+                     "INSERT INTO t VALUES (1)\n/*!*/;\nCOMMIT/*!*/;\n# at 300\n#170512 11:")
+        self.assertFalse(events.reached)
+        events.write("00:01 server id 1  end_log_pos 400\nBEGIN\n/*!*/;\nINSERT INTO t VALUES (2)\n")
+        events.close()
+        self.assertTrue(events.reached)
+        self.assertTrue("VALUES (1)" in output.getvalue())
+        self.assertFalse("VALUES (2)" in output.getvalue())
+        self.assertTrue(output.getvalue().endswith("# at 300\nDELIMITER ;\nROLLBACK;\n"))
+
+    def testIndexedArchive(self):
+        folder = tempfile.mkdtemp()
+        try:
+            for name, content in [('a.txt', 'a' * 1000), ('b.txt', 'b' * 3000000)]:
+                with open(os.path.join(folder, name), 'wb') as source:
+                    source.write(content)
+            archive = IndexedArchive(os.path.join(folder, 'archive'))
+            archive.create()
+            archive.add(os.path.join(folder, 'a.txt'))
+            archive.add(os.path.join(folder, 'b.txt'))
+            archive.close()
+
+            entries = list(IndexedArchive(os.path.join(folder, 'archive')).entries())
+            self.assertEqual([entry['size'] for entry in entries], [1000, 3000000])
+            IndexedArchive(os.path.join(folder, 'archive')).extract(entries[1], os.path.join(folder, 'restored'))
+            with open(os.path.join(folder, 'restored'), 'rb') as restored:
+                self.assertEqual(restored.read(), 'b' * 3000000)
+        finally:
+            shutil.rmtree(folder)
+
+    def testRestoreAppliesFolderModesLast(self):
+        folder = tempfile.mkdtemp()
+        try:
+            data = os.path.join(folder, 'data')
+            os.makedirs(os.path.join(data, 'readonly'))
+            with open(os.path.join(data, 'readonly', 'a.txt'), 'w') as source:
+                source.write('a')
+            for path in [os.path.join(data, 'readonly'), data]:
+                os.chmod(path, 0555)
+                os.utime(path, (1500000000, 1500000000))
+            snapshot = os.path.join(folder, 'snapshot')
+            os.makedirs(snapshot)
+            archive = IndexedArchive(os.path.join(snapshot, 'folder'))
+            archive.create()
+            for path in [data, os.path.join(data, 'readonly'), os.path.join(data, 'readonly', 'a.txt')]:
+                archive.add(path)
+            archive.close()
+
+            target = os.path.join(folder, 'restored')
+            ObibaBackup().restore(snapshot, data, target)
+            restored = os.path.join(target, data.lstrip(os.sep))
+            with open(os.path.join(restored, 'readonly', 'a.txt')) as output:
+                self.assertEqual(output.read(), 'a')
+            for path in [restored, os.path.join(restored, 'readonly')]:
+                self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0555)
+                self.assertEqual(os.stat(path).st_mtime, 1500000000)
+        finally:
+            for root, folders, files in os.walk(folder):
+                os.chmod(root, 0755)
+            shutil.rmtree(folder)
+
+    def testChunkArchiveSharesChunks(self):
+        folder = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(folder, 'a.bin'), 'wb') as source:
+                source.write(os.urandom(300000))
+            shutil.copy(os.path.join(folder, 'a.bin'), os.path.join(folder, 'b.bin'))
+            store = ChunkStore(folder)
+            for name in ['a', 'b']:
+                archive = ChunkArchive(os.path.join(folder, name), store)
+                archive.create()
+                archive.add(os.path.join(folder, name + '.bin'))
+                archive.close()
+
+            entries = [list(ChunkArchive(os.path.join(folder, name), store).entries())[0] for name in ['a', 'b']]
+            self.assertEqual(entries[0]['chunks'], entries[1]['chunks'])
+            self.assertEqual(sum(len(files) for root, folders, files in os.walk(store.folder)),
+                             len(entries[0]['chunks']))
+            with open(os.path.join(folder, 'b' + ChunkArchive.INDEX_EXTENSION)) as index:
+                self.assertEqual(list(ChunkArchive.references(index)), [chunk for chunk, size in entries[1]['chunks']])
+
+            restored = os.path.join(folder, 'restored', 'b.bin')
+            ChunkArchive(os.path.join(folder, 'b'), ChunkStore.find(os.path.join(folder, 'restored'))).extract(
+                entries[1], restored)
+            with open(restored, 'rb') as output:
+                with open(os.path.join(folder, 'a.bin'), 'rb') as source:
+                    self.assertEqual(output.read(), source.read())
+        finally:
+            shutil.rmtree(folder)
+
+    def testChunkEncryptStageAuthenticatesChunks(self):
+        data = os.urandom(200000) * 3
+        salt = os.urandom(ChunkEncryptStage.SALT_SIZE)
+        encrypted = []
+        for i in range(2):
+            output = StringIO.StringIO()
+            output.close = lambda: None
+            stage = ChunkEncryptStage(output, 'secret', salt)
+            stage.write(data)
+            stage.close()
+            encrypted.append(output.getvalue())
+        self.assertEqual(encrypted[0], encrypted[1])
+
+        decrypted = StringIO.StringIO()
+        ChunkEncryptStage.decrypt(StringIO.StringIO(encrypted[0]), decrypted, 'secret')
+        self.assertEqual(decrypted.getvalue(), data)
+        tampered = encrypted[0][:-10] + chr(ord(encrypted[0][-10]) ^ 1) + encrypted[0][-9:]
+        self.assertRaises(IOError, ChunkEncryptStage.decrypt, StringIO.StringIO(tampered), StringIO.StringIO(),
+                          'secret')
+        self.assertRaises(IOError, ChunkEncryptStage.decrypt, StringIO.StringIO(encrypted[0]), StringIO.StringIO(),
+                          'wrong')
+
+    def testDecryptLeavesNoOutputOnFailure(self):
+        folder = tempfile.mkdtemp()
+        try:
+            config = os.path.join(folder, 'backup.conf')
+            with open(config, 'w') as configFile:
+                yaml.safe_dump({'destination': folder, 'rsync': {'destination': folder,
+                                                                 'encrypt_files': {'encryptionPassword': 'secret'}}},
+                               configFile)
+            backup = ObibaBackup()
+            backup.CONFIG_FILE = config
+            plain = os.path.join(folder, 'live_mica.sql.gz')
+            with open(plain, 'wb') as plainFile:
+                plainFile.write('not encrypted')
+            output = os.path.join(folder, 'output')
+            self.assertRaises(ValueError, backup.decrypt, plain, output)
+            self.assertFalse(os.path.exists(output))
+            shutil.copy(plain, plain + ChunkEncryptStage.EXTENSION)
+            self.assertRaises(IOError, backup.decrypt, plain + ChunkEncryptStage.EXTENSION, output)
+            self.assertFalse(os.path.exists(output))
+        finally:
+            shutil.rmtree(folder)
+
+    def testPartialIndexReferences(self):
+        lines = ['{"name": "a", "chunks": [["c1", 10], ["c2", 20]]}', '{"name": "b", "chun']
+        self.assertEqual(list(ChunkArchive.references(lines, False)), ['c1', 'c2'])
+        self.assertRaises(ValueError, list, ChunkArchive.references(lines))
+
+    def testRunLockIsExclusive(self):
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, RunLock.FILENAME)
+            lock = RunLock(path)
+            self.assertTrue(lock.acquire(False))
+            self.assertFalse(RunLock(path).acquire(False))
+            lock.release()
+            self.assertTrue(RunLock(path).acquire(False))
+        finally:
+            shutil.rmtree(folder)
+
+    def testTransferBatchesUploads(self):
+        folder = tempfile.mkdtemp()
+        path = os.environ['PATH']
+        try:
+            #Copies the sources to the destination like rsync, logging its start and end
+            with open(os.path.join(folder, 'rsync'), 'w') as stub:
+                stub.write('#!/bin/sh\necho "start $*" >> %s\nargs=""\n'
+                           'for arg; do case "$arg" in -*) ;; *) args="$args $arg";; esac; done\n'
+                           'set -- $args\neval target=\\${$#}\nmkdir -p "$target"\n'
+                           'while [ $# -gt 1 ]; do case "$1" in */) cp -r "$1." "$target";; '
+                           '*) cp -r "$1" "$target";; esac; shift; done\n'
+                           'sleep 0.2\necho end >> %s\n' % ((os.path.join(folder, 'log'),) * 2))
+            os.chmod(os.path.join(folder, 'rsync'), 0755)
+            os.environ['PATH'] = folder + os.pathsep + path
+            for name in ['a', 'b', 'c']:
+                os.makedirs(os.path.join(folder, 'local', name))
+                with open(os.path.join(folder, 'local', name, 'file'), 'w') as data:
+                    data.write(name)
+            done = []
+            transfer = Transfer(os.path.join(folder, 'remote'))
+            transfer.BATCH_WAIT = 0.5
+            try:
+                for name, remote in [('a', 'a'), ('b', 'b'), ('c', 'renamed')]:
+                    transfer.upload(os.path.join(folder, 'local', name), remote, done=lambda name=name: done.append(name))
+                self.assertEqual(transfer.wait(), [])
+            finally:
+                transfer.close()
+            self.assertEqual(sorted(done), ['a', 'b', 'c'])
+            for name, remote in [('a', 'a'), ('b', 'b'), ('c', 'renamed')]:
+                with open(os.path.join(folder, 'remote', remote, 'file')) as data:
+                    self.assertEqual(data.read(), name)
+            with open(os.path.join(folder, 'log')) as log:
+                lines = log.read().splitlines()
+            #a and b share a session, the renamed c goes on its own, one session at a time
+            self.assertEqual([line.split()[0] for line in lines], ['start', 'end', 'start', 'end'])
+            sessions = sorted(sorted(os.path.basename(argument.rstrip(os.sep)) for argument in line.split()
+                                     if argument.startswith(os.path.join(folder, 'local')))
+                              for line in lines if line.startswith('start'))
+            self.assertEqual(sessions, [['a', 'b'], ['c']])
+
+            #With two sessions allowed, the renamed uploads run side by side
+            os.remove(os.path.join(folder, 'log'))
+            transfer = Transfer(os.path.join(folder, 'remote'), sessions=2)
+            transfer.BATCH_WAIT = 0.5
+            try:
+                for name in ['a', 'b']:
+                    transfer.upload(os.path.join(folder, 'local', name), name + '2')
+                self.assertEqual(transfer.wait(), [])
+            finally:
+                transfer.close()
+            with open(os.path.join(folder, 'log')) as log:
+                self.assertEqual([line.split()[0] for line in log.read().splitlines()], ['start', 'start', 'end', 'end'])
+
+            #Two sources of the same name give two distinct stages
+            os.makedirs(os.path.join(folder, 'other', 'a'))
+            transfer = Transfer(os.path.join(folder, 'remote'))
+            try:
+                for source in ['local', 'other']:
+                    transfer.upload(os.path.join(folder, source, 'a'), 'a')
+                self.assertEqual(transfer.wait(), [])
+            finally:
+                transfer.close()
+            self.assertEqual(sorted(stage['name'] for stage in transfer.metrics.report()['stages']),
+                             ['a (session 1)', 'a (session 2)'])
+        finally:
+            os.environ['PATH'] = path
+            shutil.rmtree(folder)
+
+    def testUnreachableRsyncHostOnlyFailsUploads(self):
+        folder = tempfile.mkdtemp()
+        path = os.environ['PATH']
+        try:
+            with open(os.path.join(folder, 'ssh'), 'w') as stub:
+                stub.write('#!/bin/sh\necho "ssh: connect to host backuphost: No route to host" >&2\nexit 255\n')
+            os.chmod(os.path.join(folder, 'ssh'), 0755)
+            os.environ['PATH'] = folder + os.pathsep + path
+            os.makedirs(os.path.join(folder, 'data'))
+            with open(os.path.join(folder, 'data', 'a.csv'), 'w') as data:
+                data.write('1,2\n')
+            config = {'keep': {'days': 3, 'month': 1}, 'destination': os.path.join(folder, 'backups'),
+                      'rsync': {'destination': 'backuphost:/remote'},
+                      'projects': {'mica': {'files': [os.path.join(folder, 'data', '*.csv')]}}}
+            with open(os.path.join(folder, 'backup.conf'), 'w') as configFile:
+                yaml.safe_dump(config, configFile)
+            backup = ObibaBackup()
+            backup.CONFIG_FILE = os.path.join(folder, 'backup.conf')
+            backup.run()
+
+            snapshots = backup.catalog.snapshots('mica')
+            self.assertEqual([snapshot['status'] for snapshot in snapshots], ['complete'])
+            self.assertTrue(os.path.isfile(os.path.join(snapshots[0]['path'], folder.lstrip(os.sep), 'data', 'a.csv')))
+            self.assertEqual([snapshot['status'] for snapshot in backup.catalog.snapshots('rsync')], ['failed'])
+            self.assertIsNone(backup.transfer.controlFolder)
+        finally:
+            os.environ['PATH'] = path
+            shutil.rmtree(folder)
+
+    def testBackupCollectionsKeepsTheirNames(self):
+        folder = tempfile.mkdtemp()
+        path = os.environ['PATH']
+        try:
+            #mongodump writes the name of the collection it was given as its archive
+            with open(os.path.join(folder, 'mongo'), 'w') as stub:
+                stub.write('#!/bin/sh\necho "my \'variables\'"\necho \'back\\\\slash\'\n')
+            with open(os.path.join(folder, 'mongodump'), 'w') as stub:
+                stub.write('#!/bin/sh\nprintf %s "$5"\n')
+            for name in ['mongo', 'mongodump']:
+                os.chmod(os.path.join(folder, name), 0755)
+            os.environ['PATH'] = folder + os.pathsep + path
+            backup = ObibaBackup()
+            backup.config = {'destination': folder}
+            backup.metrics = RunMetrics()
+            backup._ObibaBackup__openCatalog()
+            backup._ObibaBackup__createScheduler()
+            destination = os.path.join(folder, 'snapshot')
+            backup._ObibaBackup__backupCollections('mica', {'host': 'localhost', 'port': 27017}, 'mongodump ',
+                                                   destination, 'mica', {'codec': 'gzip', 'level': 6, 'threads': 1,
+                                                                         'extension': '.gz'})
+            self.assertEqual(backup.scheduler.wait(), [])
+            for collection in ["my 'variables'", 'back\\slash']:
+                archive = os.path.join(destination, 'mica', collection + '.archive.gz')
+                self.assertEqual(gzip.open(archive).read(), collection)
+        finally:
+            os.environ['PATH'] = path
+            shutil.rmtree(folder)
+
+    def testReplayOplogGivesADumpFolder(self):
+        folder = tempfile.mkdtemp()
+        path = os.environ['PATH']
+        try:
+            with open(os.path.join(folder, 'mongorestore'), 'w') as stub:
+                stub.write('#!/bin/sh\nfor last; do :; done\ntest -d "$last" && cat "$7" > %s\n' %
+                           os.path.join(folder, 'replayed'))
+            os.chmod(os.path.join(folder, 'mongorestore'), 0755)
+            with open(os.path.join(folder, 'segment.bson'), 'wb') as segment:
+                segment.write('oplog entries')
+            os.environ['PATH'] = folder + os.pathsep + path
+            ObibaBackup()._ObibaBackup__replayOplog(os.path.join(folder, 'segment.bson'),
+                                                    {'host': 'localhost', 'port': 27017}, datetime.now())
+            with open(os.path.join(folder, 'replayed')) as replayed:
+                self.assertEqual(replayed.read(), 'oplog entries')
+        finally:
+            os.environ['PATH'] = path
+            shutil.rmtree(folder)
+
+    def testIncrementalSnapshotLinksUnchangedFiles(self):
+        folder = tempfile.mkdtemp()
+        try:
+            backup = ObibaBackup()
+            backup.config = {'destination': folder}
+            backup._ObibaBackup__createScheduler()
+            source = os.path.join(folder, 'data', 'file.csv')
+            os.makedirs(os.path.dirname(source))
+            with open(source, 'w') as data:
+                data.write('1,2,3\n')
+            os.utime(source, (1500000000.25, 1500000000.25))
+            snapshots = [os.path.join(folder, 'snapshot%d' % day) for day in range(3)]
+            targets = [os.path.join(snapshot, source[1:]) for snapshot in snapshots]
+            for day, snapshot in enumerate(snapshots):
+                if day == 2:
+                    #Same size, changed within the same second
+                    with open(source, 'w') as data:
+                        data.write('4,5,6\n')
+                    os.utime(source, (1500000000.75, 1500000000.75))
+                os.makedirs(os.path.dirname(targets[day]))
+                backup._ObibaBackup__snapshotFile(source, snapshot, {'previous': snapshots[day - 1] if day else None,
+                                                                     'checksum': False})
+            self.assertEqual(os.stat(targets[1]).st_ino, os.stat(targets[0]).st_ino)
+            self.assertNotEqual(os.stat(targets[2]).st_ino, os.stat(targets[1]).st_ino)
+            with open(targets[2]) as data:
+                self.assertEqual(data.read(), '4,5,6\n')
+        finally:
+            shutil.rmtree(folder)
+
+    def testBulkCopiesAreHashedWhileCopied(self):
+        folder = tempfile.mkdtemp()
+        try:
+            backup = ObibaBackup()
+            backup.config = {}
+            backup._ObibaBackup__createScheduler()
+            sources = [os.path.join(folder, 'data', 'file%d.csv' % index) for index in range(5)]
+            os.makedirs(os.path.dirname(sources[0]))
+            for index, source in enumerate(sources):
+                with open(source, 'w') as data:
+                    data.write('%d,2,3\n' % index)
+            snapshot = os.path.join(folder, 'snapshot')
+            backup.checksums[snapshot] = {}
+
+            def readBack(path):
+                raise AssertionError('%s read back' % path)
+            backup._ObibaBackup__fileChecksum = readBack
+            backup.COPY_BATCH = 2
+            backup._ObibaBackup__copyFiles(sources, snapshot, 2)
+            for source in sources:
+                self.assertEqual(backup.checksums[snapshot][source[1:]]['sha256'], fileChecksum(source))
+                with open(os.path.join(snapshot, source[1:])) as copy:
+                    self.assertEqual(copy.read(), open(source).read())
+        finally:
+            shutil.rmtree(folder)
+
+    def testIncrementalSnapshotSkipsSocketsAndPipes(self):
+        folder = tempfile.mkdtemp()
+        server = socket.socket(socket.AF_UNIX)
+        try:
+            backup = ObibaBackup()
+            backup.config = {'destination': folder}
+            backup._ObibaBackup__createScheduler()
+            data = os.path.join(folder, 'data')
+            os.makedirs(data)
+            with open(os.path.join(data, 'file.csv'), 'w') as source:
+                source.write('1,2,3\n')
+            server.bind(os.path.join(data, 'server.sock'))
+            os.mkfifo(os.path.join(data, 'pipe'))
+            snapshot = os.path.join(folder, 'snapshot')
+            backup._ObibaBackup__snapshotFolder(data, [], snapshot, {'previous': None, 'checksum': False})
+            self.assertEqual(os.listdir(os.path.join(snapshot, data[1:])), ['file.csv'])
+        finally:
+            server.close()
+            shutil.rmtree(folder)
+
+    def testInterruptedSnapshot(self):
+        folder = tempfile.mkdtemp()
+        try:
+            backup = ObibaBackup()
+            backup.config = {'destination': folder}
+            backup._ObibaBackup__openCatalog()
+            snapshot = os.path.join(folder, 'mica', 'snapshot')
+            os.makedirs(snapshot)
+            for timestamp, status, resumed in [(datetime.now(), 'failed', snapshot),
+                                               (datetime.now() - timedelta(days=2), 'failed', None),
+                                               (datetime.now() - timedelta(days=2), 'running', snapshot),
+                                               (datetime.now(), 'complete', None)]:
+                backup.catalog.add('mica', snapshot, timestamp, status)
+                self.assertEqual(backup._ObibaBackup__interruptedSnapshot('mica'), resumed)
+        finally:
+            shutil.rmtree(folder)
+
+    def testCleanupWithRsyncDestination(self):
+        folder = tempfile.mkdtemp()
+        try:
+            today = date.today()
+            month = today.strftime('%Y-%m')
+            for path in ['backups/mica/%s/%s-00-00-01' % (month, today.strftime('%d')),
+                         'backups/mica/%s/%s-00-00-02' % (month, today.strftime('%d')),
+                         'remote/%s/%s-000001' % (month, today.strftime('%d')),
+                         'remote/%s/%s-000002' % (month, today.strftime('%d'))]:
+                os.makedirs(os.path.join(folder, path))
+            config = {'keep': {'days': 1, 'month': 1}, 'destination': os.path.join(folder, 'backups'),
+                      'rsync': {'destination': os.path.join(folder, 'remote')}, 'projects': {'mica': {}}}
+            backup = ObibaBackup()
+            backup.CONFIG_FILE = os.path.join(folder, 'backup.yml')
+            with open(backup.CONFIG_FILE, 'w') as configFile:
+                yaml.safe_dump(config, configFile)
+            backup.cleanup()
+            self.assertEqual(os.listdir(os.path.join(folder, 'backups', 'mica', month)),
+                             ['%s-00-00-02' % today.strftime('%d')])
+            self.assertEqual(os.listdir(os.path.join(folder, 'remote', month)), ['%s-000002' % today.strftime('%d')])
+        finally:
+            shutil.rmtree(folder)
+
+    def testRetentionPlanAcrossYearEnd(self):
+        snapshots = [{'path': timestamp, 'timestamp': timestamp} for timestamp in
+                     ['2016-10-20 00:00:00', '2016-12-01 00:00:00', '2016-12-30 00:00:00', '2016-12-31 00:00:00',
+                      '2017-01-01 00:00:00', '2017-01-02 00:00:00']]
+        plan = ObibaBackup()._ObibaBackup__retentionPlan(snapshots, 2, 2, [1], date(2017, 1, 2))
+        self.assertEqual([snapshot['path'] for snapshot in plan],
+                         ['2016-10-20 00:00:00', '2016-12-30 00:00:00'])
+
 
 
 
@@ -0,0 +1,378 @@
+"""
+Runs the backup end to end on a synthetic project, against stand-ins for mysqldump, mysql, mongodump, mongo, rsync
+and gpg, and prints the time, throughput and memory of every stage for each simulated day.
+
+    python benchmark.py [--days 3] [--small-files 2000] [--huge-files 2] [--huge-size 64M] [--dump-size 200M]
+                        [--mongo-size 50M] [--speed 0] [--bandwidth 0] [--codec gzip] [--encrypt] [--delta]
+                        [--incremental] [--repository] [--parallel 0] [--workers 1] [--output results.json]
+                        [--compare base.json]
+
+The project holds many small files and a few huge ones, a MySQL database and a MongoDB database. Every day a few
+small files change, the huge files grow and a few blocks of the dumps change. The stand-ins emit their data at
+--speed bytes per second (--bandwidth for rsync, 0 for as fast as possible), so the benchmark runs offline and
+gives the same data from one run to the next. With --real-tools, rsync and gpg are used when they are installed.
+
+Each day is a separate run of ObibaBackup.run() in a child process, its metrics are read from the JSON report of the
+run (see RunMetrics), with the disk used by the local and remote backups. --output saves the results, --compare prints
+the change of each stage against saved results.
+"""
+__author__ = 'maelstrom'
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+from distutils.spawn import find_executable
+import yaml
+
+SOURCE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'main', 'python')
+sys.path.insert(0, SOURCE_FOLDER)
+from backup import parseSize
+
+WORDS = ['opal', 'mica', 'agate', 'onyx', 'study', 'variable', 'dataset', 'network', 'population', 'participant']
+PASSWORD = 'benchmark'
+RUNNER = "import sys; sys.path.insert(0, sys.argv[1]); from backup import ObibaBackup; " \
+         "ObibaBackup.CONFIG_FILE = sys.argv[2]; ObibaBackup().run()"
+
+# The stand-ins share this preamble: their settings come from the BENCHMARK_STUBS environment variable and they
+# write at most 'speed' bytes per second
+STUB_PREAMBLE = '''
+import os, sys, json, time, random
+settings = json.loads(os.environ['BENCHMARK_STUBS'])
+args = sys.argv[1:]
+
+class Paced:
+    def __init__(self, output, speed):
+        self.output, self.speed, self.started, self.written = output, speed, time.time(), 0
+    def write(self, data):
+        self.output.write(data)
+        self.written += len(data)
+        if self.speed:
+            delay = self.started + float(self.written) / self.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+def baseBlock(seed, size=1024 * 1024):
+    # Rows drawn from a few thousand distinct ones, cheap to generate and about as compressible as a real dump
+    generator = random.Random(seed)
+    distinct = ["'%s',%d)" % (' '.join(generator.sample(settings['words'], 4)), value) for value in range(4096)]
+    rows = []
+    length = 0
+    while length < size:
+        rows.append("(%d,%s" % (len(rows), distinct[generator.getrandbits(12)]))
+        length += len(rows[-1]) + 1
+    return ','.join(rows)
+
+def blocks(name, size):
+    # The same blocks every day but a few, chosen by the day
+    base = baseBlock(name)
+    for index in range(max(1, size // len(base))):
+        version = settings['day'] if (index * 7919 + settings['day'] * 104729) % settings['changeEvery'] == 0 else 0
+        yield "INSERT INTO `%s` VALUES (%d,'block %d version %d',0),%s;\\n" % (name, -index - 1, index, version, base)
+'''
+
+STUBS = {}
+STUBS['mysqldump'] = '''
+output = Paced(sys.stdout, settings['speed'])
+#The values of -u, -h and -P are not positional
+positional = [arg for index, arg in enumerate(args)
+              if not arg.startswith('-') and (index == 0 or args[index - 1] not in ['-u', '-h', '-P'])]
+database, tables = positional[0], positional[1:]
+output.write("-- MySQL dump 10.13\\n/*!40101 SET NAMES utf8 */;\\n")
+if '--master-data=2' in args:
+    output.write("-- CHANGE MASTER TO MASTER_LOG_FILE='mysql-bin.000001', MASTER_LOG_POS=4;\\n")
+if '--no-data' not in args:
+    tables = tables or ['table%d' % index for index in range(settings['tables'])]
+    for table in tables:
+        output.write("\\n--\\n-- Table structure for table `%s`\\n--\\n\\nCREATE TABLE `%s` (id int);\\n" % (table, table))
+        for block in blocks(table, settings['dumpSize'] // settings['tables']):
+            output.write(block)
+output.write("-- Dump completed\\n")
+'''
+STUBS['mysql'] = '''
+if '-e' in args:
+    query = args[args.index('-e') + 1]
+    if 'information_schema' in query:
+        for index in range(settings['tables']):
+            sys.stdout.write("table%d\\tBASE TABLE\\t%d\\n" % (index, settings['dumpSize'] // settings['tables']))
+    elif 'SHOW DATABASES' in query:
+        sys.stdout.write("bench_db\\n")
+    elif 'MASTER STATUS' in query:
+        sys.stdout.write("mysql-bin.000001\\t4\\t\\t\\t\\n")
+elif '--unbuffered' in args:
+    #Lock session, answers once locked
+    for line in iter(sys.stdin.readline, ''):
+        if 'MASTER STATUS' in line:
+            sys.stdout.write("mysql-bin.000001\\t4\\t\\t\\t\\n")
+        if 'locked' in line:
+            sys.stdout.write("locked\\n")
+            sys.stdout.flush()
+else:
+    sys.stdin.read()
+'''
+STUBS['mongodump'] = '''
+database = args[args.index('--db') + 1]
+#Two collections of the same size, dumped together or one by one
+collections = [args[args.index('--collection') + 1]] if '--collection' in args else ['collection0', 'collection1']
+size = settings['mongoSize'] // 2
+out = [arg[6:] for arg in args if arg.startswith('--out=')]
+for collection in collections:
+    if out:
+        folder = os.path.join(out[0], database)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        output = Paced(open(os.path.join(folder, collection + '.bson'), 'wb'), settings['speed'])
+    else:
+        output = Paced(sys.stdout, settings['speed'])
+    for block in blocks(collection, size):
+        output.write(block)
+'''
+STUBS['mongo'] = '''
+if 'getCollectionNames' in ' '.join(args):
+    sys.stdout.write("collection0\\ncollection1\\n")
+'''
+STUBS['rsync'] = '''
+import shutil
+output = Paced(open(os.devnull, 'wb'), settings['bandwidth'])
+positional = [arg for arg in args if not arg.startswith('-')]
+sources, destination = positional[:-1], positional[-1]
+removeSourceFiles = '--remove-source-files' in args
+ignoreExisting = '--ignore-existing' in args
+listed = [arg.split('=', 1)[1] for arg in args if arg.startswith('--files-from=')]
+seeds = [arg.split('=', 1) for arg in args if arg.startswith('--link-dest=') or arg.startswith('--copy-dest=')]
+
+def unchanged(path, copy):
+    #Same quick check as rsync: size and modification time
+    return os.path.exists(copy) and os.stat(copy).st_size == os.stat(path).st_size and \
+        int(os.stat(copy).st_mtime) == int(os.stat(path).st_mtime)
+sent = total = 0
+for source in sources:
+    target = destination if source.endswith('/') else os.path.join(destination, os.path.basename(source))
+    paths = [(source, target)] if os.path.isfile(source) else []
+    if listed:
+        paths = [(os.path.join(source, name), os.path.join(target, name)) for name in open(listed[0]).read().split()]
+    for root, folders, files in [] if listed else os.walk(source):
+        for name in files:
+            path = os.path.join(root, name)
+            paths.append((path, os.path.join(target, os.path.relpath(path, source))))
+    for path, copy in paths:
+        if ignoreExisting and os.path.exists(copy):
+            continue
+        sourceStat = os.stat(path)
+        total += sourceStat.st_size
+        if not os.path.isdir(os.path.dirname(copy)):
+            os.makedirs(os.path.dirname(copy))
+        basis = os.path.join(seeds[0][1], os.path.relpath(copy, destination)) if seeds else None
+        if basis and not unchanged(path, copy) and unchanged(path, basis):
+            (os.link if seeds[0][0] == '--link-dest' else shutil.copy2)(basis, copy)
+        elif not unchanged(path, copy):
+            with open(path, 'rb') as data:
+                for chunk in iter(lambda: data.read(1024 * 1024), ''):
+                    output.write(chunk)
+            shutil.copy2(path, copy)
+            sent += sourceStat.st_size
+        if removeSourceFiles:
+            os.remove(path)
+sys.stdout.write("sent %d bytes  received 0 bytes\\ntotal size is %d  speedup is 1.00\\n" % (sent, total))
+'''
+STUBS['gpg'] = '''
+#Reads the passphrase, then copies its input as it is
+if '--passphrase-fd' in args:
+    os.read(int(args[args.index('--passphrase-fd') + 1]), 1024)
+output = Paced(sys.stdout, settings['speed'])
+for chunk in iter(lambda: sys.stdin.read(1024 * 1024), ''):
+    output.write(chunk)
+'''
+
+
+def writeStubs(folder, realTools):
+    os.makedirs(folder)
+    for name, body in STUBS.items():
+        if realTools and name in ['rsync', 'gpg'] and find_executable(name):
+            continue
+        path = os.path.join(folder, name)
+        with open(path, 'w') as stub:
+            stub.write("#!%s\n%s\n%s" % (sys.executable, STUB_PREAMBLE, body))
+        os.chmod(path, 0755)
+
+
+def createTree(folder, smallFiles, hugeFiles, hugeSize):
+    random.seed(0)
+    for index in range(smallFiles):
+        path = os.path.join(folder, 'small', str(index % 50), 'file%d.txt' % index)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        writeSmallFile(path)
+    os.makedirs(os.path.join(folder, 'huge'))
+    block = ' '.join(random.choice(WORDS) for i in range(200000))
+    for index in range(hugeFiles):
+        with open(os.path.join(folder, 'huge', 'data%d.csv' % index), 'wb') as huge:
+            for i in range(max(1, hugeSize // len(block))):
+                huge.write(block)
+
+
+def writeSmallFile(path):
+    with open(path, 'w') as small:
+        small.write('\n'.join(' '.join(random.sample(WORDS, 5)) for i in range(random.randrange(20, 200))))
+
+
+def evolveTree(folder, smallFiles, day):
+    # A few small files change and the huge files grow a little, their modification time moves forward
+    random.seed(day)
+    for index in random.sample(range(smallFiles), max(1, smallFiles // 100)):
+        writeSmallFile(os.path.join(folder, 'small', str(index % 50), 'file%d.txt' % index))
+    for name in os.listdir(os.path.join(folder, 'huge')):
+        with open(os.path.join(folder, 'huge', name), 'ab') as huge:
+            huge.write(' '.join(random.choice(WORDS) for i in range(100000)))
+    later = time.time() + day
+    for root, folders, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.stat(path).st_mtime > time.time() - 60:
+                os.utime(path, (later, later))
+
+
+def writeConfig(path, folder, args):
+    config = {'keep': {'days': args.keep, 'month': 1},
+              'destination': os.path.join(folder, 'backups'),
+              'concurrency': {'workers': args.workers},
+              'compression': {'codec': args.codec, 'level': args.level, 'threads': args.threads},
+              'rsync': {'destination': os.path.join(folder, 'remote'), 'delta': args.delta},
+              'projects': {'bench': {
+                  'files': [os.path.join(folder, 'tree', 'huge', '*.csv')],
+                  'folders': [os.path.join(folder, 'tree', 'small')],
+                  'databases': {'names': ['bench_db'], 'usr': 'bench', 'pwd': 'bench'},
+                  'mongodbs': {'host': 'localhost', 'port': 27017, 'names': ['bench_mongo'], 'output': 'archive'}}}}
+    project = config['projects']['bench']
+    if args.parallel:
+        project['databases']['parallel'] = args.parallel
+        project['mongodbs']['parallel'] = True
+    if args.incremental:
+        project['incremental'] = True
+    if args.repository:
+        project['repository'] = True
+    if args.encrypt:
+        config['rsync']['encrypt_files'] = {'encryptionPassword': PASSWORD}
+    with open(path, 'w') as configFile:
+        yaml.safe_dump(config, configFile, default_flow_style=False)
+
+
+def runDay(folder, configPath, stubs, day, args):
+    settings = {'day': day, 'speed': parseSize(args.speed), 'bandwidth': parseSize(args.bandwidth),
+                'dumpSize': parseSize(args.dump_size), 'mongoSize': parseSize(args.mongo_size), 'tables': 8,
+                'changeEvery': 50, 'words': WORDS}
+    environment = dict(os.environ)
+    environment['PATH'] = stubs + os.pathsep + environment['PATH']
+    environment['BENCHMARK_STUBS'] = json.dumps(settings)
+    reports = os.path.join(folder, 'backups', 'reports')
+    before = set(os.listdir(reports)) if os.path.isdir(reports) else set()
+    #Snapshot folders are named to the second
+    time.sleep(1.1)
+    with open(os.path.join(folder, 'day%d.log' % day), 'w') as log:
+        subprocess.check_call([sys.executable, '-c', RUNNER, SOURCE_FOLDER, configPath], env=environment,
+                              stdout=log, stderr=subprocess.STDOUT)
+    report = sorted(set(os.listdir(reports)) - before)[-1]
+    with open(os.path.join(reports, report)) as reportFile:
+        return json.load(reportFile)
+
+
+def diskUsage(folder):
+    # Hard-linked files are counted once, as du does
+    inodes = {}
+    for root, folders, files in os.walk(folder):
+        for name in files:
+            fileStat = os.lstat(os.path.join(root, name))
+            inodes[fileStat.st_ino] = fileStat.st_size
+    return sum(inodes.values())
+
+
+def summary(report, folder):
+    stages = {}
+    for stage in report['stages']:
+        total = stages.setdefault(stage['stage'], {'units': 0, 'duration': 0.0, 'cpu': 0.0, 'read': 0, 'written': 0,
+                                                   'peakRss': 0})
+        total['units'] += 1
+        for key in ['duration', 'cpu', 'read', 'written']:
+            total[key] += stage[key]
+        total['peakRss'] = max(total['peakRss'], stage['peakRss'])
+    return {'duration': report['duration'], 'status': report['status'], 'stages': stages,
+            'local': diskUsage(os.path.join(folder, 'backups')), 'remote': diskUsage(os.path.join(folder, 'remote'))}
+
+
+def printDay(day, result, baseline=None):
+    print "day %d: %.1fs, %s, %.1f MB local, %.1f MB remote" % (day, result['duration'], result['status'],
+                                                                  result['local'] / 1048576.0,
+                                                                  result['remote'] / 1048576.0)
+    print "\t%-10s %5s %9s %9s %10s %10s %8s %9s" % ('stage', 'units', 'seconds', 'cpu', 'MB read', 'MB written',
+                                                     'MB/s', 'peak MB')
+    for name in sorted(result['stages']):
+        stage = result['stages'][name]
+        line = "\t%-10s %5d %9.2f %9.2f %10.1f %10.1f %8.1f %9.1f" % (
+            name, stage['units'], stage['duration'], stage['cpu'], stage['read'] / 1048576.0,
+            stage['written'] / 1048576.0, stage['read'] / 1048576.0 / stage['duration'] if stage['duration'] else 0,
+            stage['peakRss'] / 1048576.0)
+        if baseline and name in baseline['stages'] and baseline['stages'][name]['duration']:
+            line += " %+6.1f%%" % (100.0 * (stage['duration'] / baseline['stages'][name]['duration'] - 1))
+        print line
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=3)
+    parser.add_argument('--small-files', type=int, default=2000)
+    parser.add_argument('--huge-files', type=int, default=2)
+    parser.add_argument('--huge-size', default='64M')
+    parser.add_argument('--dump-size', default='200M')
+    parser.add_argument('--mongo-size', default='50M')
+    parser.add_argument('--speed', default='0', help="bytes per second of the dump and gpg stand-ins")
+    parser.add_argument('--bandwidth', default='0', help="bytes per second of the rsync stand-in")
+    parser.add_argument('--codec', default='gzip')
+    parser.add_argument('--level', type=int, default=6)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--parallel', type=int, default=0, help="mysqldump connections per database")
+    parser.add_argument('--keep', type=int, default=2, help="days kept, older snapshots are cleaned up")
+    parser.add_argument('--encrypt', action='store_true')
+    parser.add_argument('--delta', action='store_true')
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--repository', action='store_true', help="store the project in the chunk store")
+    parser.add_argument('--real-tools', action='store_true', help="use rsync and gpg when they are installed")
+    parser.add_argument('--output', help="saves the results to this JSON file")
+    parser.add_argument('--compare', help="JSON file of results to compare with")
+    parser.add_argument('--keep-files', action='store_true', help="keeps the synthetic data and the backups")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as compareFile:
+            baseline = json.load(compareFile)['days']
+
+    folder = tempfile.mkdtemp(prefix='obiba-benchmark-')
+    try:
+        stubs = os.path.join(folder, 'bin')
+        writeStubs(stubs, args.real_tools)
+        createTree(os.path.join(folder, 'tree'), args.small_files, args.huge_files, parseSize(args.huge_size))
+        configPath = os.path.join(folder, 'backup.yml')
+        writeConfig(configPath, folder, args)
+        results = []
+        for day in range(args.days):
+            if day:
+                evolveTree(os.path.join(folder, 'tree'), args.small_files, day)
+            results.append(summary(runDay(folder, configPath, stubs, day, args), folder))
+            printDay(day, results[-1], baseline[day] if baseline and day < len(baseline) else None)
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump({'arguments': vars(args), 'days': results}, output, indent=2, sort_keys=True)
+    finally:
+        if args.keep_files:
+            print "Benchmark files kept in %s" % folder
+        else:
+            shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Compares the bytes sent to the remote server in standard and delta mode, for a synthetic MySQL dump of which a few
+rows change every day.
+
+    python deltaBenchmark.py [--rows 500000] [--days 5] [--changes 20] [--encrypt]
+
+The bytes of the compressed (or encrypted) chunks which are not found in the previous day are printed, an estimate of
+what rsync sends. When rsync is installed, every day is also sent with rsync --no-whole-file --link-dest against the
+previous day and the literal data and total bytes sent reported by rsync --stats are printed.
+"""
+__author__ = 'maelstrom'
+import os
+import sys
+import re
+import random
+import shutil
+import struct
+import argparse
+import tempfile
+import subprocess
+from distutils.spawn import find_executable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'main', 'python'))
+from backup import GzipStage
+from backup import ChunkEncryptStage
+from backup import AesGcm
+from backup import GpgStage
+
+WORDS = ['opal', 'mica', 'agate', 'onyx', 'study', 'variable', 'dataset', 'network', 'population', 'participant']
+
+
+def dump(rows):
+    return ''.join("INSERT INTO `variable` VALUES (%d,'%s',%d);\n" % row for row in rows)
+
+
+def evolve(rows, changes):
+    rows = list(rows)
+    for i in range(changes):
+        index = random.randrange(len(rows))
+        action = random.choice(['update', 'insert', 'delete'])
+        if action == 'update':
+            rows[index] = (rows[index][0], ' '.join(random.sample(WORDS, 4)), random.randrange(1000))
+        elif action == 'insert':
+            rows.insert(index, (len(rows) + i, ' '.join(random.sample(WORDS, 4)), random.randrange(1000)))
+        else:
+            del rows[index]
+    return rows
+
+
+def write(data, path, delta, password, salt):
+    output = open(path, 'wb')
+    if password:
+        if delta:
+            output = ChunkEncryptStage(output, password, salt)
+        else:
+            output = GpgStage(output, password)
+    stage = GzipStage(output, 6, 1, delta)
+    for i in range(0, len(data), 1024 * 1024):
+        stage.write(data[i:i + 1024 * 1024])
+    stage.close()
+
+
+def units(path, encrypted):
+    """
+    The independent pieces of an artifact: encrypted records or gzip members
+    """
+    with open(path, 'rb') as artifact:
+        data = artifact.read()
+    if encrypted:
+        pieces = []
+        offset = len(ChunkEncryptStage.MAGIC) + ChunkEncryptStage.SALT_SIZE
+        header = 8 + AesGcm.NONCE_SIZE + AesGcm.TAG_SIZE
+        while offset < len(data):
+            length = struct.unpack('>Q', data[offset:offset + 8])[0]
+            pieces.append(data[offset:offset + header + length])
+            offset += header + length
+        return pieces
+    return ['\x1f\x8b' + piece for piece in data.split('\x1f\x8b\x08\x00\x00\x00\x00\x00')[1:]] or [data]
+
+
+def rsyncStats(source, previous, target):
+    """
+    The literal data and the total bytes sent reported by rsync --stats
+    """
+    output = subprocess.check_output(["rsync", "-a", "--stats", "--no-whole-file", "--link-dest=" + previous,
+                                      source + os.sep, target])
+    return [int(re.search(name + r': ([\d,]+)', output).group(1).replace(',', ''))
+            for name in ['Literal data', 'Total bytes sent']]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=500000)
+    parser.add_argument('--days', type=int, default=5)
+    parser.add_argument('--changes', type=int, default=20)
+    parser.add_argument('--encrypt', action='store_true')
+    args = parser.parse_args()
+    password = 'benchmark' if args.encrypt else None
+    salt = os.urandom(ChunkEncryptStage.SALT_SIZE)
+    hasRsync = find_executable("rsync") is not None
+    if not hasRsync:
+        print "rsync is not installed, only the reused chunks are reported"
+
+    random.seed(0)
+    rows = [(i, ' '.join(random.sample(WORDS, 4)), random.randrange(1000)) for i in range(args.rows)]
+    days = [rows]
+    for day in range(1, args.days):
+        days.append(evolve(days[-1], args.changes))
+
+    folder = tempfile.mkdtemp()
+    try:
+        for delta in [False, True]:
+            mode = 'delta' if delta else 'standard'
+            previous = None
+            for day, rows in enumerate(days):
+                local = os.path.join(folder, mode, 'local', str(day))
+                os.makedirs(local)
+                artifact = os.path.join(local, 'db.sql.gz' + ('.enc' if delta else '.gpg' if password else ''))
+                write(dump(rows), artifact, delta, password, salt)
+                size = os.path.getsize(artifact)
+                if previous is None:
+                    print "%-8s day %d: %d bytes" % (mode, day, size)
+                else:
+                    known = set(units(previous, delta and password))
+                    sent = sum(len(unit) for unit in units(artifact, delta and password) if unit not in known)
+                    line = "%-8s day %d: %d bytes, %d in new chunks (%.1f%%, estimate)" % (mode, day, size, sent,
+                                                                                          100.0 * sent / size)
+                    if hasRsync:
+                        remote = os.path.join(folder, mode, 'remote')
+                        literal, total = rsyncStats(local, os.path.join(remote, str(day - 1)),
+                                                    os.path.join(remote, str(day)))
+                        line += ", rsync literal data %d, total sent %d (%.1f%%)" % (literal, total,
+                                                                                     100.0 * total / size)
+                    print line
+                if hasRsync and previous is None:
+                    subprocess.check_call(["rsync", "-a", local + os.sep, os.path.join(folder, mode, 'remote', str(day))])
+                previous = artifact
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()